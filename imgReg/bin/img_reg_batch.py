@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Headless registration of the images of an imagedb file, without the workspace (no display, no Tango door).
+
+Every target is registered against its reference at the poses of the input file, and the new Outline and Rotation
+of the targets are written to the output imagedb. Examples::
+
+    python img_reg_batch.py session.imagedb --pair overview.bmp tile_01.tif --pair overview.bmp tile_02.tif
+    python img_reg_batch.py session.imagedb --pairs-file pairs.txt --engine feature --workers 16 -o aligned.imagedb
+
+A pairs file has one "reference target" pair per line, the images are given by their Name or Path.
+"""
+import os
+import sys
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'core', 'src'))
+
+
+def _read_gray(d):
+    from image_loader_module import decode_image
+    from util import gray_array
+    image = decode_image(d)
+    if image is None:
+        raise IOError("Can not read {}".format(d['Path']))
+    return gray_array(image)
+
+
+def register_group(reference_d, target_ds, engine='dft', canvas_size=1024, detector='orb', n_features=5000,
+                   cache_dir=None):
+    """
+    Registers a list of targets against one reference, runs in a worker process. The images are read in the worker,
+    so only the image dictionaries are sent between the processes.
+
+    :param reference_d: image dictionary of the reference
+    :param target_ds: list of image dictionaries of the targets
+    :param engine: 'dft' (see batch_registration_module) or 'feature' (see feature_registration_module)
+    :param canvas_size: size of the registration canvas of the dft engine
+    :param detector: 'orb' or 'akaze', feature engine only
+    :param n_features: maximum number of keypoints, feature engine only
+    :param cache_dir: folder of the registration cache of the dft engine, None to disable the cache
+    :return: list of (d, new_d, error) tuples, see batch_registration_module.register_batch
+    """
+    reference_image = _read_gray(reference_d)
+    targets = []
+    results = []
+    for d in target_ds:
+        try:
+            targets.append((d, _read_gray(d)))
+        except Exception as e:
+            results.append((d, None, str(e)))
+    if engine == 'dft':
+        from batch_registration_module import register_batch
+        from registration_cache_module import RegistrationCache
+        cache = RegistrationCache(cache_dir) if cache_dir else None
+        results += register_batch(reference_image, reference_d, targets, canvas_size, max_workers=1, cache=cache)
+    else:
+        import numpy as np
+        from feature_registration_module import estimate_features_matrix
+        from spatial_registration_module import image_pose_matrix, pose_to_outline
+        reference_size = (reference_image.shape[1], reference_image.shape[0])
+        for d, image in targets:
+            try:
+                m, n_inliers, n_matches = estimate_features_matrix(reference_image, image, detector=detector,
+                                                                   n_features=n_features)
+                pose = image_pose_matrix(reference_d, reference_size).dot(np.vstack([m, [0.0, 0.0, 1.0]]))
+                results.append((d, pose_to_outline(dict(d), pose, (image.shape[1], image.shape[0])), None))
+            except Exception as e:
+                results.append((d, None, str(e)))
+    return results
+
+
+def _find(attr_list, key):
+    for d in attr_list:
+        if key in (d['Name'], d['Path']) or os.path.abspath(key) == os.path.abspath(d['Path']):
+            return d
+    raise KeyError("Image {} not found in the imagedb".format(key))
+
+
+def _read_pairs(path):
+    pairs = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                items = line.split()
+                if len(items) != 2:
+                    raise ValueError("Invalid pair: {}".format(line))
+                pairs.append(items)
+    return pairs
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless registration of the images of an imagedb file")
+    parser.add_argument('imagedb', help="input imagedb file")
+    parser.add_argument('-o', '--output', help="output imagedb file, defaults to the input file")
+    parser.add_argument('--pair', nargs=2, action='append', default=[], metavar=('REFERENCE', 'TARGET'),
+                        help="reference and target images (Name or Path), can be repeated")
+    parser.add_argument('--pairs-file', help="file with one 'reference target' pair per line")
+    parser.add_argument('--engine', choices=('dft', 'feature'), default='dft', help="registration engine")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="number of worker processes")
+    parser.add_argument('--canvas-size', type=int, default=1024, help="registration canvas size (dft engine)")
+    parser.add_argument('--detector', choices=('orb', 'akaze'), default='orb', help="keypoint detector (feature engine)")
+    parser.add_argument('--features', type=int, default=5000, help="maximum number of keypoints (feature engine)")
+    parser.add_argument('--cache-dir', help="registration cache folder (dft engine), no cache by default")
+    parser.add_argument('--dry-run', action='store_true', help="register but do not write the imagedb")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from importmodule import load_im_xml
+    from export_module import write_im_xml
+
+    attr_list = load_im_xml(args.imagedb, exclude_file=[])
+    pairs = list(args.pair) + (_read_pairs(args.pairs_file) if args.pairs_file else [])
+    if not pairs:
+        print("No pair to register, see --pair and --pairs-file")
+        return 2
+    # // the targets are grouped by reference, so a reference is read (and its spectra computed) once per task;
+    # // large groups are split so that all the workers are busy
+    groups = OrderedDict()
+    for reference, target in pairs:
+        groups.setdefault(reference, []).append(_find(attr_list, target))
+    workers = max(1, args.workers)
+    chunk = max(1, -(-len(pairs) // workers))
+    tasks = [(_find(attr_list, reference), targets[k:k + chunk])
+             for reference, targets in groups.items() for k in range(0, len(targets), chunk)]
+    n_failed = 0
+    by_path = {d['Path']: d for d in attr_list}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(register_group, reference_d, targets, args.engine, args.canvas_size,
+                                   args.detector, args.features, args.cache_dir)
+                   for reference_d, targets in tasks]
+        for future in as_completed(futures):
+            for d, new_d, error in future.result():
+                if new_d is None:
+                    n_failed += 1
+                    print("FAILED {}: {}".format(d['Name'], error))
+                    continue
+                by_path[d['Path']].update(new_d)
+                print("{}: Outline {} Rotation {:.3f}".format(
+                    d['Name'], ', '.join('{:.2f}'.format(v) for v in new_d['Outline'][0:4]), new_d['Rotation']))
+    print("{} images registered, {} failed".format(sum(len(t) for t in groups.values()) - n_failed, n_failed))
+    if not args.dry_run:
+        write_im_xml(args.output or args.imagedb, attr_list)
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Speed and accuracy benchmark of the registration engines on synthetic pairs with a known transformation, see
+core/src/benchmark_module.py. The results are written as json, to compare them across releases. Example::
+
+    python img_reg_benchmark.py --sizes 256 512 1024 2048 --cases 5 -o benchmark.json
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'core', 'src'))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the registration engines on synthetic image pairs")
+    parser.add_argument('-o', '--output', help="output json file, the results are printed if not given")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024], help="image sizes in pixels")
+    parser.add_argument('--cases', type=int, default=3, help="number of image pairs per size")
+    parser.add_argument('--engines', nargs='+', help="engines to run (default: all)")
+    parser.add_argument('--overlap', type=float, default=0.8, help="overlap fraction of the pairs along each axis")
+    parser.add_argument('--max-angle', type=float, default=10.0, help="maximum rotation angle in degrees")
+    parser.add_argument('--max-scale', type=float, default=0.1, help="maximum deviation of the scale from 1")
+    parser.add_argument('--noise', type=float, default=0.05, help="noise level, relative to the texture")
+    parser.add_argument('--tolerance', type=float, default=2.0, help="maximum error of a success, in pixels")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from benchmark_module import run_benchmark, engines
+    unknown = set(args.engines or []) - set(engines)
+    if unknown:
+        print("Unknown engines: {} (available: {})".format(', '.join(sorted(unknown)), ', '.join(engines)))
+        return 2
+    report = run_benchmark(args.sizes, args.cases, args.engines, args.overlap, args.max_angle, args.max_scale,
+                           args.noise, args.tolerance, args.seed, log=lambda m: print(m, file=sys.stderr))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
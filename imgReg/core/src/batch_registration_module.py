@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# // registration of many workspace images against one reference image
+import os
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal as Signal
+
+import imreg_fft
+from registration_cache_module import registration_key
+from spatial_registration_module import similarity_matrix_about, image_pose_matrix, pose_to_outline
+
+
+def load_source(source):
+    """
+    :param source: image array, or function returning it (the pixels are then read in the worker and released once
+                   the image is registered)
+    :return: the image array
+    """
+    return source() if callable(source) else source
+
+
+def render_on_canvas(image, m, size):
+    """
+    Warps a grayscale image into a canvas with a 3x3 matrix mapping the image pixels onto the canvas pixels. The
+    canvas is zero mean over the area covered by the image and zero elsewhere, so the uncovered area does not add
+    to the correlation.
+
+    :param image: 2D array
+    :param m: 3x3 matrix, image pixel (column, row) to canvas pixel
+    :param size: (width, height) of the canvas
+    :return: (canvas, coverage) tuple, float32 canvas and the covered fraction of the canvas
+    """
+    image = np.asarray(image, dtype=np.float32)
+    # // reduce first when the image is shrunk a lot, warpAffine only interpolates between neighbours
+    f = min(math.hypot(m[0, 0], m[1, 0]), math.hypot(m[0, 1], m[1, 1]))
+    if f < 0.5:
+        h, w = image.shape[0:2]
+        rw, rh = max(1, int(round(w * f))), max(1, int(round(h * f)))
+        image = cv2.resize(image, (rw, rh), interpolation=cv2.INTER_AREA)
+        m = m.dot(np.diag([w / float(rw), h / float(rh), 1.0]))
+    canvas = cv2.warpAffine(image, m[0:2], tuple(size), flags=cv2.INTER_LINEAR)
+    mask = cv2.warpAffine(np.ones(image.shape[0:2], dtype=np.uint8), m[0:2], tuple(size), flags=cv2.INTER_NEAREST)
+    valid = mask > 0
+    coverage = valid.mean()
+    if coverage > 0:
+        canvas[valid] -= canvas[valid].mean()
+        canvas[~valid] = 0
+    return canvas, coverage
+
+
+class ReferenceCanvas(object):
+    """
+    Reference image resampled on a square canvas, together with its pose in the field coordinates. The spectra of
+    the canvas (FFT and log-polar transform) are computed once and cached by imreg_fft, so every target registered
+    with register() only pays for its own transforms.
+    """
+
+    def __init__(self, image, d, canvas_size=1024):
+        """
+        :param image: grayscale array of the reference
+        :param d: image dictionary of the reference (Outline and Rotation give its pose)
+        :param canvas_size: size of the canvas in pixels, the reference is downscaled to fit
+        """
+        h, w = image.shape[0:2]
+        factor = max(1.0, max(w, h) / float(canvas_size))
+        self.n = int(math.ceil(max(w, h) / factor))
+        # // canvas pixel -> reference pixel -> field
+        self.matrix = image_pose_matrix(d, (w, h)).dot(np.diag([factor, factor, 1.0]))
+        self.inverse = np.linalg.inv(self.matrix)
+        self.image, _ = render_on_canvas(image, np.diag([1.0 / factor, 1.0 / factor, 1.0]), (self.n, self.n))
+        self.image.flags.writeable = False
+        s = imreg_fft.fast_shape(self.image.shape)
+        imreg_fft.reference_spectrum(self.image, s)
+        imreg_fft.reference_logpolar(self.image, s)
+
+    def register(self, image, d, min_coverage=0.05):
+        """
+        Registers one image against the reference. The image is placed on the canvas at its current pose, then the
+        scale and angle (log-polar phase correlation) and the translation (phase correlation) are measured.
+
+        :param image: grayscale array of the target
+        :param d: image dictionary of the target
+        :param min_coverage: minimum fraction of the canvas which must be covered by the target
+        :return: (correction, vector_dict) tuple. correction is the 3x3 matrix to apply to the pose of the target in
+                 the field coordinates, vector_dict holds scale, angle and tvec (in canvas pixels)
+        """
+        h, w = image.shape[0:2]
+        m = self.inverse.dot(image_pose_matrix(d, (w, h)))
+        target, coverage = render_on_canvas(image, m, (self.n, self.n))
+        if coverage < min_coverage:
+            raise ValueError("{} does not overlap the reference".format(d.get('Name', d.get('Path'))))
+        scale, angle = imreg_fft.scale_angle(self.image, target)
+        # // the target is the reference scaled and rotated, undo it about the canvas center
+        center = (self.n / 2.0, self.n / 2.0)
+        undo = similarity_matrix_about(center, 1.0 / scale, -angle)
+        warped = cv2.warpAffine(target, undo[0:2], (self.n, self.n), flags=cv2.INTER_LINEAR)
+        t0, t1 = imreg_fft.translation(self.image, warped)
+        k = similarity_matrix_about(center, 1.0 / scale, -angle, tvec=(t1, t0))
+        correction = self.matrix.dot(k).dot(self.inverse)
+        return correction, {'scale': scale, 'angle': angle, 'tvec': [t0, t1], 'success': coverage}
+
+
+def register_batch(reference_image, reference_d, targets, canvas_size=1024, max_workers=None, progress=None,
+                   cancel_event=None, cache=None):
+    """
+    Registers a list of images against one reference, in a pool of threads (the FFTs and warps release the GIL).
+
+    :param reference_image: grayscale array of the reference, or function returning it (see load_source)
+    :param reference_d: image dictionary of the reference
+    :param targets: list of (image dictionary, grayscale array or function returning it) tuples
+    :param canvas_size: size of the registration canvas, see ReferenceCanvas
+    :param max_workers: number of threads, defaults to the number of cpus
+    :param progress: optional function called with the progress (0-100)
+    :param cancel_event: optional threading.Event, the remaining targets are skipped once it is set
+    :param cache: optional RegistrationCache (see registration_cache_module), a target registered before at the same
+                  pose against the same reference is not registered again
+    :return: list of (d, new_d, error) tuples in the order of targets. new_d is a copy of d with the registered
+             Outline and Rotation, None if the registration failed (error is then the message)
+    """
+    reference = ReferenceCanvas(load_source(reference_image), reference_d, canvas_size)
+    reference_key = registration_key(reference.image, reference.matrix) if cache is not None else None
+    done = [0]
+    lock = threading.Lock()
+
+    def worker(d, image):
+        if cancel_event is not None and cancel_event.is_set():
+            return d, None, 'cancelled'
+        try:
+            image = load_source(image)
+            size = (image.shape[1], image.shape[0])
+            key = None
+            cached = None
+            if cache is not None:
+                key = registration_key(image, image_pose_matrix(d, size), engine='batch', reference=reference_key)
+                cached = cache.get(key)
+            if cached is not None:
+                correction = cached['correction']
+            else:
+                correction, vector_dict = reference.register(image, d)
+                if key is not None:
+                    cache.put(key, dict(vector_dict, correction=correction))
+            new_d = pose_to_outline(dict(d), correction.dot(image_pose_matrix(d, size)), size)
+            result = d, new_d, None
+        except Exception as e:
+            result = d, None, str(e)
+        with lock:
+            done[0] += 1
+            if progress is not None:
+                progress(done[0] / float(len(targets)) * 100)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 4) as executor:
+        futures = [executor.submit(worker, d, image) for d, image in targets]
+        return [f.result() for f in futures]
+
+
+class BatchRegistration(QtCore.QObject):
+    """
+    Runs register_batch in a background thread and reports to the Qt thread.
+    """
+    sig_progress = Signal(float)
+    sig_finished = Signal(object)
+    sig_status = Signal(str)
+
+    def __init__(self, canvas_size=1024, max_workers=None, cache=None, parent=None):
+        super(BatchRegistration, self).__init__(parent)
+        self.canvas_size = canvas_size
+        self.max_workers = max_workers
+        self.cache = cache
+        self._cancel_event = threading.Event()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, reference_image, reference_d, targets):
+        """
+        :param reference_image: grayscale array of the reference, or function returning it (see load_source)
+        :param reference_d: image dictionary of the reference
+        :param targets: list of (image dictionary, grayscale array or function returning it) tuples, the pixels are
+                        read in the worker threads
+        :return:
+        """
+        self.cancel()
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(reference_image, reference_d, targets,
+                                                                self._cancel_event), daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def _run(self, reference_image, reference_d, targets, cancel_event):
+        self.sig_status.emit('Registering {} images against {}..'.format(len(targets), reference_d.get('Name', '')))
+        try:
+            results = register_batch(reference_image, reference_d, targets, self.canvas_size, self.max_workers,
+                                     progress=self.sig_progress.emit, cancel_event=cancel_event, cache=self.cache)
+        except Exception as e:
+            self.sig_status.emit('Batch registration failed: {}'.format(e))
+            self.sig_progress.emit(100)
+            return
+        if not cancel_event.is_set():
+            self.sig_finished.emit(results)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# // speed and accuracy benchmark of the registration engines on synthetic image pairs with a known transformation
+import sys
+import math
+import time
+import platform
+from collections import OrderedDict, defaultdict
+
+import cv2
+import numpy as np
+
+import imreg_fft
+from spatial_registration_module import tdict_to_matrix, transform_img_dict, registration_dft_slice
+
+
+def synthetic_texture(shape, rng):
+    """
+    Random texture with structures at all scales (sum of blurred noise octaves), similar to a microscope image.
+
+    :param shape: (height, width)
+    :param rng: numpy random Generator
+    :return: float32 array, zero mean and unit standard deviation
+    """
+    image = np.zeros(shape, dtype=np.float32)
+    for octave in range(1, 7):
+        sigma = 2.0 ** octave / 2.0
+        noise = rng.standard_normal(shape).astype(np.float32)
+        layer = cv2.GaussianBlur(noise, (0, 0), sigma)
+        image += layer / (layer.std() + 1e-12) * sigma ** 0.5
+    return (image - image.mean()) / image.std()
+
+
+def synthetic_pair(size, scale=1.0, angle=0.0, overlap=0.8, noise=0.05, seed=0):
+    """
+    Generates a pair of images (reference and moving image) of a random texture. The moving image is the reference
+    scaled and rotated about its center and shifted so that the images only overlap on the given fraction of their
+    width and height.
+
+    :param size: size of the square images, in pixels
+    :param scale: scale factor
+    :param angle: rotation angle in degrees (counter-clockwise on screen)
+    :param overlap: overlap fraction along each axis
+    :param noise: standard deviation of the gaussian noise added to both images, relative to the texture
+    :param seed: random seed
+    :return: (im0, im1, tdict) tuple, tdict is the ground truth in the convention of imreg_dft (transform_img_dict
+             of im1 with tdict gives im0 on the overlap)
+    """
+    rng = np.random.default_rng(seed)
+    margin = int(size * (1.5 - min(overlap, 1.0)))
+    base = synthetic_texture((size + 2 * margin, size + 2 * margin), rng)
+    shift = (1.0 - overlap) * size
+    direction = rng.uniform(0, 2 * np.pi)
+    tdict = {'scale': scale, 'angle': angle,
+             'tvec': np.array([shift * math.sin(direction), shift * math.cos(direction)])}
+    im0 = base[margin:margin + size, margin:margin + size].copy()
+    # // im1(p) = im0(M p), read from the larger base image so that the area outside of im0 is textured as well
+    m = np.array([[1.0, 0.0, margin], [0.0, 1.0, margin], [0.0, 0.0, 1.0]]).dot(tdict_to_matrix(tdict, im0.shape))
+    im1 = cv2.warpAffine(base, m[0:2], (size, size), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+    im0 += rng.standard_normal(im0.shape).astype(np.float32) * noise
+    im1 += rng.standard_normal(im1.shape).astype(np.float32) * noise
+    return im0, im1, tdict
+
+
+def _engine_dft(im0, im1, levels=1, mode='similarity'):
+    vector_dict = registration_dft_slice(im0, im1, mode=mode, iterations=5, display=False, progressbar=None,
+                                         levels=levels)
+    return tdict_to_matrix(vector_dict, im1.shape)
+
+
+def _engine_translation(im0, im1):
+    # // im0 is im1 shifted by t, so the pixel q of im1 is at q + t in im0
+    t0, t1 = imreg_fft.translation(im0, im1)
+    return np.array([[1.0, 0.0, t1], [0.0, 1.0, t0], [0.0, 0.0, 1.0]])
+
+
+def _engine_fft_canvas(im0, im1):
+    from batch_registration_module import ReferenceCanvas
+    h, w = im0.shape
+    # // pixel coordinates as field coordinates
+    d = {'Outline': [0, w, 0, h, 0, 0], 'Rotation': 0}
+    correction, vector_dict = ReferenceCanvas(im0, d, canvas_size=max(w, h)).register(im1, d)
+    return correction
+
+
+def _engine_feature(im0, im1):
+    from feature_registration_module import estimate_features_matrix
+    m, n_inliers, n_matches = estimate_features_matrix(im0, im1)
+    return np.vstack([m, [0.0, 0.0, 1.0]])
+
+
+# // registration engines: function of (im0, im1) returning the 3x3 matrix of the pixels of im1 onto im0, and
+# // whether the engine supports rotation and scaling
+engines = OrderedDict([
+    ('dft', (_engine_dft, True)),
+    ('dft_pyramid', (lambda im0, im1: _engine_dft(im0, im1, levels=3), True)),
+    ('dft_rigid', (lambda im0, im1: _engine_dft(im0, im1, mode='rigid'), False)),
+    ('dft_translation', (lambda im0, im1: _engine_dft(im0, im1, mode='translation'), False)),
+    ('fft_canvas', (_engine_fft_canvas, True)),
+    ('feature', (_engine_feature, True)),
+    ('translation', (_engine_translation, False)),
+])
+
+
+def matrix_error(m, m_true, shape):
+    """
+    :return: rms distance (in pixels) between the corners and the center of the image mapped with m and m_true
+    """
+    h, w = shape[0:2]
+    pts = np.array([[0, w - 1, w - 1, 0, (w - 1) / 2.0], [0, 0, h - 1, h - 1, (h - 1) / 2.0], [1, 1, 1, 1, 1]])
+    return float(np.sqrt(np.mean(np.sum((m.dot(pts) - m_true.dot(pts))[0:2] ** 2, axis=0))))
+
+
+def _decompose(m):
+    return math.hypot(m[0, 0], m[1, 0]), math.degrees(math.atan2(m[1, 0], m[0, 0]))
+
+
+def benchmark_warp(im0, im1, tdict):
+    """
+    Times transform_img_dict and measures the residual of im1 warped with the ground truth against im0.
+
+    :return: (time in s, normalized rms residual on the overlap)
+    """
+    t = time.perf_counter()
+    warped = transform_img_dict(im1, tdict, bgval=np.nan)
+    elapsed = time.perf_counter() - t
+    valid = np.isfinite(warped)
+    # // one pixel margin, the interpolation at the border of the overlap mixes in the background
+    valid[1:-1, 1:-1] &= valid[:-2, 1:-1] & valid[2:, 1:-1] & valid[1:-1, :-2] & valid[1:-1, 2:]
+    residual = float(np.sqrt(np.mean((warped[valid] - im0[valid]) ** 2)) / im0.std()) if valid.any() else None
+    return elapsed, residual
+
+
+def run_benchmark(sizes=(256, 512, 1024), n_cases=3, engine_names=None, overlap=0.8, max_angle=10.0,
+                  max_scale=0.1, noise=0.05, tolerance=2.0, seed=0, log=None):
+    """
+    Runs the registration engines on synthetic pairs. For every size, the first case is a pure translation, the
+    other ones have a random rotation and scaling as well (the engines which can not register them are skipped).
+    The caches of the reference spectra and of the keypoints are cleared before every run, so the times are the
+    ones of a first registration.
+
+    :param sizes: sizes of the images
+    :param n_cases: number of pairs per size
+    :param engine_names: list of engines (see engines), None for all
+    :param overlap: overlap fraction of the pairs along each axis
+    :param max_angle: maximum rotation angle in degrees
+    :param max_scale: maximum deviation of the scale factor from 1
+    :param noise: standard deviation of the noise, relative to the texture
+    :param tolerance: maximum error (in pixels) of a successful registration
+    :param seed: random seed
+    :param log: optional function called with a message after every run
+    :return: dictionary with the environment, the settings, the results of every run and a summary per engine and
+             size, ready to be dumped as json
+    """
+    from feature_registration_module import feature_cache
+    engine_names = list(engine_names or engines.keys())
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        for case in range(n_cases):
+            if case == 0:
+                scale, angle = 1.0, 0.0
+            else:
+                scale = float(1.0 + rng.uniform(-max_scale, max_scale))
+                angle = float(rng.uniform(-max_angle, max_angle))
+            case_seed = int(rng.integers(2 ** 31))
+            im0, im1, tdict = synthetic_pair(size, scale, angle, overlap, noise, case_seed)
+            m_true = tdict_to_matrix(tdict, im1.shape)
+            base = OrderedDict([('size', size), ('case', case), ('seed', case_seed), ('scale', scale),
+                                ('angle', angle), ('tvec', [float(v) for v in tdict['tvec']])])
+            for name in engine_names:
+                func, similarity = engines[name]
+                if not similarity and case > 0:
+                    continue
+                imreg_fft.clear_spectrum_cache()
+                feature_cache.clear()
+                r = OrderedDict(base, engine=name)
+                t = time.perf_counter()
+                try:
+                    m = func(im0, im1)
+                    r['time_s'] = time.perf_counter() - t
+                    s, a = _decompose(m)
+                    s_true, a_true = _decompose(m_true)
+                    r['error_px'] = matrix_error(m, m_true, im1.shape)
+                    r['scale_error'] = s - s_true
+                    r['angle_error'] = (a - a_true + 180.0) % 360.0 - 180.0
+                    r['success'] = r['error_px'] <= tolerance
+                except Exception as e:
+                    r['time_s'] = time.perf_counter() - t
+                    r['success'] = False
+                    r['error'] = str(e)
+                results.append(r)
+                if log is not None:
+                    log('{engine} size {size} case {case}: {time_s:.3f} s, error {0} px'.format(
+                        '{:.3f}'.format(r['error_px']) if 'error_px' in r else r.get('error'), **r))
+            elapsed, residual = benchmark_warp(im0, im1, tdict)
+            results.append(OrderedDict(base, engine='transform_img_dict', time_s=elapsed, residual=residual))
+    return OrderedDict([('environment', environment()),
+                        ('settings', OrderedDict([('sizes', list(sizes)), ('n_cases', n_cases), ('overlap', overlap),
+                                                  ('max_angle', max_angle), ('max_scale', max_scale),
+                                                  ('noise', noise), ('tolerance', tolerance), ('seed', seed)])),
+                        ('results', results),
+                        ('summary', summarize(results))])
+
+
+def summarize(results):
+    """
+    :return: list of the median time, median error and success rate per engine and size
+    """
+    groups = defaultdict(list)
+    for r in results:
+        groups[r['engine'], r['size']].append(r)
+    summary = []
+    for (engine, size), rs in groups.items():
+        s = OrderedDict([('engine', engine), ('size', size), ('runs', len(rs)),
+                         ('median_time_s', float(np.median([r['time_s'] for r in rs])))])
+        errors = [r['error_px'] for r in rs if 'error_px' in r]
+        if errors:
+            s['median_error_px'] = float(np.median(errors))
+        if any('success' in r for r in rs):
+            s['success_rate'] = sum(bool(r.get('success')) for r in rs) / float(len(rs))
+        residuals = [r['residual'] for r in rs if r.get('residual') is not None]
+        if residuals:
+            s['median_residual'] = float(np.median(residuals))
+        summary.append(s)
+    return summary
+
+
+def environment():
+    """
+    :return: versions of python and of the libraries, and the machine, to compare results across releases
+    """
+    env = OrderedDict([('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')), ('python', sys.version.split()[0]),
+                       ('platform', platform.platform()), ('processor', platform.processor()),
+                       ('numpy', np.__version__), ('opencv', cv2.__version__)])
+    try:
+        import imreg_dft
+        env['imreg_dft'] = getattr(imreg_dft, '__version__', '')
+    except ImportError:
+        pass
+    env['fft_backend'] = dict(imreg_fft._fft_backend)
+    return env
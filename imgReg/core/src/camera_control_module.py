@@ -6,6 +6,7 @@ import pyqtgraph as pg
 from taurus.qt.qtgui.tpg import ForcedReadTool
 from taurus.core import TaurusEventType, TaurusTimeVal
 from showOrHide import VisuaTool
+from drift_tracking_module import DriftTracker
 
 
 class camera_control_panel(object):
@@ -27,6 +28,17 @@ class camera_control_panel(object):
                 if not hasattr(self, viewerWidgetName):
                     setattr(self, viewerWidgetName,TaurusImageItem())
                     getattr(self, gridLayoutWidgetName).addWidget(getattr(self, viewerWidgetName))
+                    self.configure_drift_tracker(getattr(self, viewerWidgetName).drift_tracker)
+
+    def configure_drift_tracker(self, tracker):
+        tracker.every = int(self.settings_object.value("Camaras/driftTrackingEvery", 1))
+        tracker.correction_threshold = float(self.settings_object.value("Camaras/driftCorrectionThreshold", 2.0))
+        tracker.correction_interval = float(self.settings_object.value("Camaras/driftCorrectionInterval", 5.0))
+        tracker.sig_correction_report.connect(self.report_drift_correction)
+
+    def report_drift_correction(self, d0, d1):
+        # // the correction is only reported, no stage is driven from the camera panel
+        self.statusbar.showMessage('drift correction: shift the image by {:.2f}, {:.2f} pixels'.format(d0, d1))
 
     def connect_slots_cam(self):
         self.pushButton_camera.clicked.connect(self.control_cam)
@@ -118,6 +130,50 @@ class TaurusImageItem(GraphicsLayoutWidget, TaurusBaseComponent):
         self.fr.attachToPlotItem(self.img_viewer)
         self.vt = VisuaTool(self, properties = ['prof_hoz','prof_ver'])
         self.vt.attachToPlotItem(self.img_viewer)
+        #for drift tracking
+        self.drift_tracker = DriftTracker(self)
+        self.drift_tracker.sig_drift.connect(self.update_drift_plot)
+        self._take_drift_reference = False
+        self.drift_roi = pg.RectROI([100, 100], [128, 128], pen='y')
+        self.drift_roi.hide()
+        self.img_viewer.addItem(self.drift_roi, ignoreBounds = True)
+        self.drift_plot = self.addPlot(row = 7, col = 1, colspan = 10)
+        self.drift_plot.setLabel('bottom', 'time', units = 's')
+        self.drift_plot.setLabel('left', 'drift', units = 'px')
+        self.drift_plot.addLegend()
+        self.drift_curve_x = self.drift_plot.plot(pen = 'r', name = 'x')
+        self.drift_curve_y = self.drift_plot.plot(pen = 'g', name = 'y')
+        self.drift_plot.hide()
+        menu = self.img_viewer.getViewBox().menu
+        self.action_track_drift = menu.addAction('Track drift in the yellow region')
+        self.action_track_drift.setCheckable(True)
+        self.action_track_drift.toggled.connect(self.track_drift)
+        self.action_reset_drift = menu.addAction('Reset drift reference')
+        self.action_reset_drift.triggered.connect(self.reset_drift_reference)
+        self.action_report_drift = menu.addAction('Report drift corrections')
+        self.action_report_drift.setCheckable(True)
+        self.action_report_drift.toggled.connect(lambda checked: setattr(self.drift_tracker, 'report_corrections', checked))
+
+    def track_drift(self, checked):
+        """
+        Starts or stops the drift tracking, the reference region is taken from the next frame
+        """
+        self.drift_roi.setVisible(checked)
+        self.drift_plot.setVisible(checked)
+        if checked:
+            self.reset_drift_reference()
+        else:
+            self._take_drift_reference = False
+            self.drift_tracker.clear_reference()
+
+    def reset_drift_reference(self):
+        if self.action_track_drift.isChecked():
+            self._take_drift_reference = True
+
+    def update_drift_plot(self, *args):
+        t, d0, d1 = self.drift_tracker.drift_history()
+        self.drift_curve_x.setData(t, d0)
+        self.drift_curve_y.setData(t, d1)
 
     def handleEvent(self, evt_src, evt_type, evt_val):
         """Reimplemented from :class:`TaurusImageItem`"""
@@ -127,6 +183,12 @@ class TaurusImageItem(GraphicsLayoutWidget, TaurusBaseComponent):
         try:
             data = evt_val.rvalue.to_base_units().magnitude
             self.img.setImage(data)
+            if self._take_drift_reference:
+                self._take_drift_reference = False
+                region, _ = self.drift_roi.getArraySlice(data, self.img)
+                self.drift_tracker.set_reference(data, region)
+            else:
+                self.drift_tracker.push(data)
             hor_region_down,  hor_region_up= self.region_cut_hor.getRegion()
             ver_region_l, ver_region_r = self.region_cut_ver.getRegion()
             hor_region_down,  hor_region_up = int(hor_region_down),  int(hor_region_up)
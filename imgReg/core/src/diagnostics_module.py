@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# // capture of intermediate frames of the registration pipelines, written to disk in the background for debugging
+import os
+import time
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+from util import to_uint8
+
+_prefix = 'diag_'
+
+
+class DiagnosticsRecorder(object):
+    """
+    Debug capture of intermediate frames (padded sub frames, transformed target, ...). When the capture is disabled,
+    capture() returns immediately and nothing is kept. When it is enabled, the frames are copied into a ring in
+    memory and a background thread writes them as images into the diagnostics folder; frames are dropped from the
+    ring when the writer lags behind, and the oldest files are deleted when the folder exceeds its quota. The caller
+    never does any image I/O.
+    """
+
+    def __init__(self, folder=None, enabled=False, ring_size=16, quota_bytes=200 * 2 ** 20, ext='.jpg'):
+        """
+        :param folder: diagnostics folder, created on the first write
+        :param enabled: debug capture switch
+        :param ring_size: maximum number of frames waiting to be written
+        :param quota_bytes: maximum size of the diagnostics files in the folder
+        :param ext: image format of the files
+        """
+        self.folder = folder
+        self.enabled = enabled
+        self.quota_bytes = quota_bytes
+        self.ext = ext
+        self._ring = deque(maxlen=ring_size)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._seq = 0
+        self._files = None
+
+    def configure(self, folder=None, enabled=None, ring_size=None, quota_bytes=None):
+        with self._cond:
+            if folder is not None and folder != self.folder:
+                self.folder = folder
+                self._files = None
+            if enabled is not None:
+                self.enabled = enabled
+                if not enabled:
+                    self._ring.clear()
+            if ring_size is not None and ring_size != self._ring.maxlen:
+                self._ring = deque(self._ring, maxlen=ring_size)
+            if quota_bytes is not None:
+                self.quota_bytes = quota_bytes
+
+    def capture(self, name, array):
+        """
+        Queues a frame for writing, does nothing when the capture is disabled
+        :param name: name of the frame, used in the file name
+        :param array: image array, it is copied
+        :return:
+        """
+        if not self.enabled or array is None or not self.folder:
+            return
+        frame = np.array(array, copy=True)
+        with self._cond:
+            self._seq += 1
+            self._ring.append((self._seq, time.strftime('%Y%m%d_%H%M%S'), name, frame))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ring:
+                    self._cond.wait()
+                seq, stamp, name, frame = self._ring.popleft()
+                folder = self.folder
+            try:
+                self._write(folder, '{}{}_{:05d}_{}{}'.format(_prefix, stamp, seq, name, self.ext), frame)
+            except Exception as e:
+                print('Failed to write the diagnostics frame {}: {}'.format(name, e))
+
+    def _write(self, folder, filename, frame):
+        os.makedirs(folder, exist_ok=True)
+        if frame.ndim == 3 and frame.shape[2] in (3, 4):
+            frame = cv2.cvtColor(to_uint8(frame), cv2.COLOR_RGB2BGR if frame.shape[2] == 3 else cv2.COLOR_RGBA2BGRA)
+        else:
+            frame = to_uint8(frame)
+        path = os.path.join(folder, filename)
+        if not cv2.imwrite(path, frame):
+            raise IOError('cv2 can not write {}'.format(path))
+        if self._files is None:
+            self._files = deque(sorted((e.path, e.stat().st_size) for e in os.scandir(folder)
+                                       if e.name.startswith(_prefix)))
+        else:
+            self._files.append((path, os.path.getsize(path)))
+        # // the names start with the time stamp, so the oldest files are on the left
+        total = sum(size for p, size in self._files)
+        while total > self.quota_bytes and len(self._files) > 1:
+            p, size = self._files.popleft()
+            total -= size
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+
+diagnostics = DiagnosticsRecorder()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# // drift tracking of a live camera stream against a reference region, by phase correlation in a worker thread
+import time
+import threading
+from collections import deque
+
+import numpy as np
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal as Signal
+
+import imreg_fft
+
+
+class DriftTracker(QtCore.QObject):
+    """
+    Measures the drift of the frames of a camera stream against a reference region of interest. The spectrum of the
+    (windowed) reference region is computed once, so a frame costs one forward and one inverse FFT of the region in
+    the worker thread. The worker only keeps the latest frame: a frame arriving while the previous one is being
+    correlated replaces the waiting one instead of queuing, so the tracker never lags behind the stream. The FFTs
+    run on a single thread, so the tracker does not compete with the registrations for the other cores.
+
+    The drift is the displacement (along the axes 0 and 1 of the frames, in pixels) of the image content since the
+    reference was taken. It must stay below half of the region size, larger drifts wrap around.
+    """
+    # // time since the reference (s), drift along the axes 0 and 1 (pixels)
+    sig_drift = Signal(float, float, float)
+    # // report of the shift along the axes 0 and 1 (pixels) which would compensate the drift, see report_corrections.
+    # // The tracker does not move anything, the receiver decides what to do with it
+    sig_correction_report = Signal(float, float)
+
+    def __init__(self, parent=None, every=1, upsample=10, history=3600):
+        """
+        :param every: only every Nth frame is correlated
+        :param upsample: subpixel precision of the drift, 1/upsample pixel
+        :param history: number of drift measurements kept in history
+        """
+        super(DriftTracker, self).__init__(parent)
+        self.every = every
+        self.upsample = upsample
+        # // corrections are reported with sig_correction_report once the drift exceeds the threshold (pixels), at
+        # // most once per interval (s)
+        self.report_corrections = False
+        self.correction_threshold = 2.0
+        self.correction_interval = 5.0
+        self.history = deque(maxlen=history)
+        self._cond = threading.Condition()
+        self._reference = None
+        self._frame = None
+        self._count = 0
+        self._last_correction = 0.0
+        self._thread = None
+
+    def set_reference(self, frame, region):
+        """
+        Takes the reference region and starts the tracking, the history is cleared.
+        :param frame: 2D array
+        :param region: (axis 0 slice, axis 1 slice) of the reference region in the frame
+        :return:
+        """
+        roi = np.asarray(frame[region], dtype=np.float32)
+        if roi.ndim != 2 or min(roi.shape) < 8:
+            raise ValueError("The drift reference region must be a 2D region of 8x8 pixels at least")
+        # // the window suppresses the edges of the region, which do not move with the image content
+        window = np.outer(np.hanning(roi.shape[0]), np.hanning(roi.shape[1])).astype(np.float32)
+        spectrum = imreg_fft.fft2((roi - roi.mean()) * window, imreg_fft.fast_shape(roi.shape), workers=1)
+        with self._cond:
+            self._reference = (tuple(region), roi.shape, window, spectrum, time.monotonic())
+            self._frame = None
+            self._count = 0
+            self._last_correction = 0.0
+            self.history.clear()
+
+    def clear_reference(self):
+        """
+        Stops the tracking, the frame being correlated is dropped.
+        :return:
+        """
+        with self._cond:
+            self._reference = None
+            self._frame = None
+
+    def drift_history(self):
+        """
+        :return: (times, drifts along the axis 0, drifts along the axis 1) arrays of the measurements since the
+                 reference was taken
+        """
+        with self._cond:
+            history = np.array(self.history, dtype=np.float64).reshape(-1, 3)
+        return history[:, 0], history[:, 1], history[:, 2]
+
+    def is_tracking(self):
+        return self._reference is not None
+
+    def push(self, frame):
+        """
+        Hands a frame of the stream to the tracker, returns immediately. Only the reference region is copied.
+        :param frame: 2D array, same shape as the frame of the reference
+        :return:
+        """
+        with self._cond:
+            reference = self._reference
+            if reference is None:
+                return
+            self._count += 1
+            if (self._count - 1) % max(1, int(self.every)):
+                return
+        roi = np.array(frame[reference[0]], dtype=np.float32)
+        if roi.shape != reference[1]:
+            return
+        with self._cond:
+            if self._reference is not reference:
+                return
+            self._frame = (reference, time.monotonic(), roi)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._frame is None:
+                    self._cond.wait()
+                reference, t, roi = self._frame
+                self._frame = None
+            try:
+                drift = self._measure(reference, roi)
+            except Exception as e:
+                print('Drift measurement failed: {}'.format(e))
+                continue
+            with self._cond:
+                if self._reference is not reference:
+                    continue
+                elapsed = t - reference[4]
+                self.history.append((elapsed, drift[0], drift[1]))
+                correct = (self.report_corrections and np.hypot(*drift) > self.correction_threshold
+                           and t - self._last_correction > self.correction_interval)
+                if correct:
+                    self._last_correction = t
+            self.sig_drift.emit(elapsed, drift[0], drift[1])
+            if correct:
+                self.sig_correction_report.emit(-drift[0], -drift[1])
+
+    def _measure(self, reference, roi):
+        region, shape, window, spectrum, t0 = reference
+        # // the reference region is the frame region shifted by t, so the content moved by -t
+        t = imreg_fft.spectrum_translation(spectrum, (roi - roi.mean()) * window, self.upsample, workers=1)
+        return -float(t[0]), -float(t[1])
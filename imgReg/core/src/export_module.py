@@ -40,6 +40,17 @@ def generate_xml_attr(dset_list):
     pass
 
 
+def update_geometry_from_outline(d):
+    # // recalculate_all the center and size based on the given outline
+    d["Center"] = [0] * 3
+    d["Size"] = [0] * 2
+    d["Size"][0] = abs(d["Outline"][1] - d["Outline"][0])
+    d["Size"][1] = abs(d["Outline"][3] - d["Outline"][2])
+    d["Center"][0] = d["Size"][0] / 2 + d["Outline"][0]
+    d["Center"][1] = d["Size"][1] / 2 + d["Outline"][2]
+    d['Focus'] = d["Outline"][4]
+
+
 def write_im_xml(xml_path, attrList, distributed=False):
     '''
     Parameters
@@ -50,7 +61,8 @@ def write_im_xml(xml_path, attrList, distributed=False):
 
     Notes
     -----
-    none
+    The file is written to a temporary file first and then renamed, so an interrupted write never leaves a truncated
+    imagedb behind.
 
     Examples
     --------
@@ -91,14 +103,7 @@ def write_im_xml(xml_path, attrList, distributed=False):
         particle_noise_size.text = '2' if 'noise_size' not in d else str(d['noise_size'])
         particle_threshold.text = '10' if 'threshold' not in d else str(d['threshold'])
 
-        # // recalculate_all the center and size based on the given outline
-        d["Center"] = [0] * 3
-        d["Size"] = [0] * 2
-        d["Size"][0] = abs(d["Outline"][1] - d["Outline"][0])
-        d["Size"][1] = abs(d["Outline"][3] - d["Outline"][2])
-        d["Center"][0] = d["Size"][0] / 2 + d["Outline"][0]
-        d["Center"][1] = d["Size"][1] / 2 + d["Outline"][2]
-        d['Focus'] = d["Outline"][4]
+        update_geometry_from_outline(d)
         Center = ET.SubElement(imageitem, "Center")
         Size = ET.SubElement(imageitem, "Size")
         Focus = ET.SubElement(imageitem, "Focus")
@@ -125,6 +130,8 @@ def write_im_xml(xml_path, attrList, distributed=False):
         basefolder.text = xml_path
 
     tree = ET.ElementTree(data)
-    tree.write(xml_path, pretty_print=True, xml_declaration=True, encoding="Windows-1252")
+    tmp_path = xml_path + '.tmp'
+    tree.write(tmp_path, pretty_print=True, xml_declaration=True, encoding="Windows-1252")
+    os.replace(tmp_path, xml_path)
 
 
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# // feature based registration (ORB/AKAZE keypoints, RANSAC similarity), alternative to the DFT registration
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from job_runner_module import JobRunner
+from registration_cache_module import registration_key
+from spatial_registration_module import matrix_to_tdict
+
+# // FLANN index of binary descriptors (locality sensitive hashing)
+FLANN_INDEX_LSH = 6
+
+
+class FeatureCache(object):
+    """
+    Keypoints and descriptors of the last images, keyed by the content of the image and the detector settings, so an
+    image registered against several others is only detected once.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def put(self, key, features):
+        with self._lock:
+            self._entries[key] = features
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+feature_cache = FeatureCache()
+
+
+def _to_uint8(image, mask=None):
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY if image.shape[2] == 3 else cv2.COLOR_RGBA2GRAY)
+    if image.dtype == np.uint8:
+        return image
+    m = None if mask is None else mask.astype(np.uint8)
+    return cv2.normalize(image.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U, mask=m)
+
+
+def _create_detector(detector, n_features):
+    if detector == 'orb':
+        return cv2.ORB_create(nfeatures=n_features)
+    elif detector == 'akaze':
+        return cv2.AKAZE_create()
+    raise ValueError("Unknown feature detector: {}".format(detector))
+
+
+def detect_features(image, mask=None, detector='orb', n_features=5000, max_size=2048):
+    """
+    Detects the keypoints of an image. Images larger than max_size are reduced first, the keypoints are returned in
+    full resolution pixels. The result is cached (see FeatureCache).
+
+    :param image: grayscale or RGB(A) array
+    :param mask: optional boolean array, keypoints are only detected where it is True (e.g. not in the padding)
+    :param detector: 'orb' or 'akaze'
+    :param n_features: maximum number of keypoints (ORB only)
+    :param max_size: maximum size of the image used for the detection, in pixels
+    :return: (points, descriptors) tuple, points is a Nx2 float32 array of (x, y) coordinates
+    """
+    key = registration_key(image, mask, detector=detector, n_features=n_features, max_size=max_size)
+    features = feature_cache.get(key)
+    if features is not None:
+        return features
+    im = _to_uint8(image, mask)
+    m = None if mask is None else mask.astype(np.uint8) * 255
+    h, w = im.shape[0:2]
+    factor = max(1.0, max(w, h) / float(max_size))
+    if factor > 1:
+        size = (max(1, int(round(w / factor))), max(1, int(round(h / factor))))
+        im = cv2.resize(im, size, interpolation=cv2.INTER_AREA)
+        if m is not None:
+            m = cv2.resize(m, size, interpolation=cv2.INTER_NEAREST)
+    if m is not None:
+        # // no keypoints on the edge of the mask, its descriptors would see the padding
+        m = cv2.erode(m, np.ones((31, 31), dtype=np.uint8))
+    keypoints, descriptors = _create_detector(detector, n_features).detectAndCompute(im, m)
+    points = np.array([k.pt for k in keypoints], dtype=np.float32).reshape(-1, 2)
+    # // pixel centers of the reduced image on the full resolution grid
+    points = (points + 0.5) * np.float32(factor) - 0.5
+    features = (points, descriptors)
+    feature_cache.put(key, features)
+    return features
+
+
+def match_features(des0, des1, ratio=0.75, matcher='flann'):
+    """
+    Matches binary descriptors with the ratio test of Lowe.
+
+    :param des0: descriptors of the reference
+    :param des1: descriptors of the image to register
+    :param ratio: maximum distance ratio of the best to the second best match
+    :param matcher: 'flann' (approximate, LSH index) or 'bf' (brute force)
+    :return: (index0, index1) tuple of arrays of the matched descriptors
+    """
+    if des0 is None or des1 is None or len(des0) < 2 or len(des1) < 2:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    if matcher == 'flann':
+        m = cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1),
+                                  dict(checks=50))
+    else:
+        m = cv2.BFMatcher(cv2.NORM_HAMMING)
+    pairs = m.knnMatch(des1, des0, k=2)
+    good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < ratio * p[1].distance]
+    return (np.array([g.trainIdx for g in good], dtype=int), np.array([g.queryIdx for g in good], dtype=int))
+
+
+def estimate_features_matrix(im0, im1, mask0=None, mask1=None, detector='orb', n_features=5000, max_size=2048,
+                             matcher='flann', ratio=0.75, threshold=3.0, min_inliers=10):
+    """
+    Feature based registration of im1 against im0: keypoints are matched and a similarity transformation
+    (translation, rotation and uniform scale) is fitted with RANSAC. The images only need to overlap partially.
+
+    :param im0: reference image
+    :param im1: image to register
+    :param mask0: optional boolean array of the valid pixels of im0
+    :param mask1: optional boolean array of the valid pixels of im1
+    :param detector: 'orb' or 'akaze'
+    :param n_features: maximum number of keypoints per image (ORB only)
+    :param max_size: maximum size of the images used for the detection, in pixels
+    :param matcher: 'flann' or 'bf'
+    :param ratio: ratio test threshold
+    :param threshold: RANSAC reprojection threshold, in full resolution pixels
+    :param min_inliers: minimum number of inliers of a valid registration
+    :return: (m, n_inliers, n_matches) tuple, m is the 2x3 matrix mapping the pixels (column, row) of im1 onto im0
+    """
+    p0, des0 = detect_features(im0, mask0, detector, n_features, max_size)
+    p1, des1 = detect_features(im1, mask1, detector, n_features, max_size)
+    i0, i1 = match_features(des0, des1, ratio, matcher)
+    if len(i0) < min_inliers:
+        raise ValueError("Not enough matching features ({})".format(len(i0)))
+    m, inliers = cv2.estimateAffinePartial2D(p1[i1], p0[i0], method=cv2.RANSAC, ransacReprojThreshold=threshold,
+                                             maxIters=2000, confidence=0.995)
+    n_inliers = 0 if inliers is None else int(inliers.sum())
+    if m is None or n_inliers < min_inliers:
+        raise ValueError("No consistent transformation found ({} inliers)".format(n_inliers))
+    return m, n_inliers, len(i0)
+
+
+def registration_features(im0, im1, mask0=None, mask1=None, **kwargs):
+    """
+    Feature based registration of im1 against im0, see estimate_features_matrix for the parameters.
+
+    :return: vector dictionary of imreg_dft (scale, angle, tvec, success) about the center of im1, with the number
+             of inliers
+    """
+    m, n_inliers, n_matches = estimate_features_matrix(im0, im1, mask0, mask1, **kwargs)
+    vector_dict = matrix_to_tdict(m, im1.shape)
+    vector_dict['success'] = n_inliers / float(n_matches)
+    vector_dict['inliers'] = n_inliers
+    return vector_dict
+
+
+class FeatureRegistration(JobRunner):
+    """
+    Feature based registration of the reference and target frames in a worker thread (see job_runner_module), the
+    vector dictionary is sent with sig_finished like the one of DFTRegistration.
+    """
+
+    def __init__(self, detector='orb', n_features=5000, max_size=2048):
+        super().__init__()
+        self.detector = detector
+        self.n_features = n_features
+        self.max_size = max_size
+        self.reference = None
+        self.target = None
+        self.masks = None
+
+    def prepare(self, reference, target, masks=None):
+        """
+        :param reference: reference frame
+        :param target: target frame
+        :param masks: optional (reference mask, target mask) of the valid pixels (the padding is False)
+        :return:
+        """
+        self.reference = reference
+        self.target = target
+        self.masks = masks
+
+    def start(self):
+        """
+        :return: the CancelToken of the registration
+        """
+        mask0, mask1 = self.masks if self.masks else (None, None)
+        return self.submit(self.perform, self.reference, self.target, mask0, mask1, detector=self.detector,
+                           n_features=self.n_features, max_size=self.max_size)
+
+    @staticmethod
+    def perform(token, reference, target, mask0=None, mask1=None, **kwargs):
+        token.status('Start feature registration..')
+        vector_dict = registration_features(reference, target, mask0, mask1, **kwargs)
+        token.status('Feature registration is finished: {} matching features'.format(vector_dict['inliers']))
+        return vector_dict
@@ -17,7 +17,11 @@ from pathlib import Path
 import qimage2ndarray
 import cv2
 import imreg_dft as ird
-from util import PandasModel, submit_jobs
+from util import PandasModel, submit_jobs, array_to_qimage, to_uint8
+from diagnostics_module import diagnostics
+from registration_cache_module import registration_cache, registration_key
+from job_runner_module import JobRunner
+from feature_registration_module import FeatureRegistration
 
 
 ui_file_folder = Path(__file__).parent.parent / 'ui'
@@ -140,28 +144,73 @@ def mdi_field_imreg_show(self):
     self.mdi_field_registration_widget.show()
     self.mdi_field_registration_widget.exec_()
 
-class DFTRegistration(QtCore.QObject):
-
-    sig_dft_finished = QtCore.pyqtSignal(object)
-    sig_dft_status = QtCore.pyqtSignal(str)
+class DFTRegistration(JobRunner):
+    """
+    DFT registration of the reference and target frames in a worker thread (see job_runner_module). A new
+    registration supersedes the one still running, which stops at its next pyramid level.
+    """
 
     def __init__(self):
         super().__init__()
         self.reference_sub_frame = None
         self.target_zoom_frame = None
-
-    def prepare_dft(self, reference, target):
+        # // coarse-to-fine registration settings (see registration_dft_slice), levels=1 disables the pyramid
+        self.levels = 1
+        self.tolerance = 0.5
+        self.masks = None
+        self.center_offset = None
+        # // registration mode and search windows (see registration_dft_slice), a window of None is unconstrained
+        self.mode = 'similarity'
+        self.angle_window = None
+        self.scale_window = None
+
+    def prepare_dft(self, reference, target, levels=None, tolerance=None, masks=None, center_offset=None,
+                    mode='similarity', angle_window=None, scale_window=None):
         self.reference_sub_frame = reference
         self.target_zoom_frame = target
-
-    def perform_dft(self):
-        from spatial_registration_module import registration_dft_slice
-        self.sig_dft_status.emit('Start DFT registration..')
-        vector_dict = registration_dft_slice(self.reference_sub_frame, self.target_zoom_frame, iterations=5, \
-                                                display=False,  progressbar=None,
-                                                display_window=None)
-        self.sig_dft_status.emit('DFT registration is finished!')
-        self.sig_dft_finished.emit(vector_dict)
+        self.mode = mode
+        self.angle_window = angle_window
+        self.scale_window = scale_window
+        # // (reference mask, target mask) of the valid pixels for the masked registration, None to use all pixels
+        self.masks = masks
+        # // (x, y) offset of the center of the frames from the center of the union region when they are cropped
+        self.center_offset = center_offset
+        if levels is not None:
+            self.levels = levels
+        if tolerance is not None:
+            self.tolerance = tolerance
+
+    def start(self):
+        """
+        Registers the prepared frames, the vector dictionary is sent with sig_finished
+        :return: the CancelToken of the registration
+        """
+        return self.submit(self.perform_dft, self.reference_sub_frame, self.target_zoom_frame, self.masks,
+                           self.center_offset, self.levels, self.tolerance, self.mode, self.angle_window,
+                           self.scale_window)
+
+    @staticmethod
+    def perform_dft(token, reference, target, masks=None, center_offset=None, levels=1, tolerance=0.5,
+                    mode='similarity', angle_window=None, scale_window=None):
+        from spatial_registration_module import registration_dft_slice, recenter_tdict
+        mask0, mask1 = masks if masks else (None, None)
+        key = registration_key(reference, target, mask0, mask1, engine='dft', iterations=5, levels=levels,
+                               tolerance=tolerance, mode=mode, angle_window=angle_window, scale_window=scale_window)
+        vector_dict = registration_cache.get(key)
+        if vector_dict is not None:
+            token.status('DFT registration result found in cache')
+        else:
+            token.status('Start DFT registration ({})..'.format(mode))
+            vector_dict = registration_dft_slice(reference, target, angle=(0, angle_window), scale=(1, scale_window),
+                                                 mode=mode, iterations=5, display=False, progressbar=None,
+                                                 display_window=None, levels=levels, tolerance=tolerance,
+                                                 mask0=mask0, mask1=mask1, cancel_event=token,
+                                                 progress=lambda v: token.progress(v / 100.0))
+            registration_cache.put(key, vector_dict)
+        if center_offset is not None:
+            vector_dict = recenter_tdict(vector_dict, center_offset)
+        token.status('DFT registration is finished!')
+        return vector_dict
 
 class MdiFieldImreg_Wrapper(object):
     """
@@ -182,9 +231,7 @@ class MdiFieldImreg_Wrapper(object):
         self.reference_frame = np.zeros((0, 0))
         self.reference_outline = [0,0,0,0,0,0]
         self.dft_reg_instance = DFTRegistration()
-        self.dft_reg_thread = QtCore.QThread()
-        self.dft_reg_instance.moveToThread(self.dft_reg_thread)
-        self.dft_reg_thread.started.connect(self.dft_reg_instance.perform_dft)
+        self.orb_reg_instance = FeatureRegistration()
         self.init_scan_list()
         self.scaling_ft_along_height = 1
         self.scaling_ft_along_width = 1
@@ -308,8 +355,12 @@ class MdiFieldImreg_Wrapper(object):
         self.bt_add_target.clicked.connect(self.add_target)
         self.pushButton_roi_on_target.clicked.connect(self.extract_target_sub_frame)
         self.pushButton_roi_on_reference.clicked.connect(self.extract_ref_sub_frame)
-        self.dft_reg_instance.sig_dft_status.connect(self.update_status)
-        self.dft_reg_instance.sig_dft_finished.connect(self.dft_imreg2)
+        self.dft_reg_instance.sig_status.connect(self.update_status)
+        self.dft_reg_instance.sig_progress.connect(self.progressUpdate_sig)
+        self.dft_reg_instance.sig_finished.connect(self.dft_imreg2)
+        self.orb_reg_instance.sig_status.connect(self.update_status)
+        self.orb_reg_instance.sig_progress.connect(self.progressUpdate_sig)
+        self.orb_reg_instance.sig_finished.connect(self.dft_imreg2)
         self.comboBox_ref_frame_pos.currentIndexChanged.connect(self.update_beam_pos_vp)
         self.pushButton_cal_sf.clicked.connect(self.cal_scaling_factors)
         self.pushButton_add_row.clicked.connect(lambda:self.generate_scan_macro(mot_name_along_width='samy', mot_name_along_height='samz'))
@@ -370,7 +421,7 @@ class MdiFieldImreg_Wrapper(object):
         self.outl_target = current_loc['Outline']
         if isinstance(current_loc, dict):
             self.target_attrs = current_loc
-            self.target_frame = qt_image_to_array(self.target_image.pixmap.toImage())
+            self.target_frame = self.target_image.gray_array()
             # // grayscale conversion
             # self.target_frame = np.dot(self.target_frame[..., :3], [0.299, 0.587, 0.114])
             self.ent_target.setText(current_loc["Path"])
@@ -401,7 +452,7 @@ class MdiFieldImreg_Wrapper(object):
         self.outl_reference = current_loc['Outline']
         if isinstance(current_loc, dict):
             self.reference_attrs = current_loc
-            self.reference_frame = qt_image_to_array(self.reference_image.pixmap.toImage())
+            self.reference_frame = self.reference_image.gray_array()
             # // grayscale conversion
             # self.reference_frame = np.dot(self.reference_frame[..., :3], [0.299, 0.587, 0.114])
             self.ent_ref.setText(current_loc["Path"])
@@ -534,11 +585,40 @@ class MdiFieldImreg_Wrapper(object):
         translation_vector = QtCore.QPointF(dx, dy)
         self.move_box.setPos(translation_vector + self.move_box.pos())
 
-    def _padding_to_union_size(self, array_frame, outline, union_outline):
+    def _padding_to_union_size(self, array_frame, outline, union_outline, return_mask=False):
         x_min, x_max, y_min, y_max = union_outline
         x0, x1, y0, y1 = [int(round(each)) for each in outline]
         # print([(y0-y_min, y_max-y1),(x0-x_min, x_max-x1)])
-        return np.pad(array_frame, pad_width=[(y0-y_min, y_max-y1),(x0-x_min, x_max-x1)], mode='constant', constant_values=250)
+        pad_width = [(y0-y_min, y_max-y1),(x0-x_min, x_max-x1)]
+        padded = np.pad(array_frame, pad_width=pad_width, mode='constant', constant_values=250)
+        if return_mask:
+            # // mask of the pixels of the frame itself, the padding is False
+            mask = np.pad(np.ones(array_frame.shape[0:2], dtype=bool), pad_width=pad_width, mode='constant',
+                          constant_values=False)
+            return padded, mask
+        return padded
+
+    def _crop_to_overlap(self, masks, margin=0.1):
+        """
+        Region of the union frame used by the masked registration: the overlap of the valid pixels of both frames,
+        extended by a margin (the translation search range) and rounded up to fast FFT sizes
+        :param masks: list of the boolean masks of the frames (same shape)
+        :param margin: margin as a fraction of the overlap size
+        :return: tuple of slices, or None to use the whole frame
+        """
+        from imreg_fft import fast_shape
+        overlap = np.logical_and(*masks)
+        if not overlap.any():
+            return None
+        rows = np.flatnonzero(overlap.any(axis=1))
+        cols = np.flatnonzero(overlap.any(axis=0))
+        crop = []
+        for (lo, hi), n_max in zip(((rows[0], rows[-1] + 1), (cols[0], cols[-1] + 1)), overlap.shape):
+            n = int(np.ceil((hi - lo) * (1 + 2 * margin)))
+            n = min(n_max, fast_shape((n,))[0])
+            start = int(np.clip((lo + hi - n) // 2, 0, n_max - n))
+            crop.append(slice(start, start + n))
+        return tuple(crop)
     
     def prepare_dft(self):
         assert hasattr(self, 'reference_sub_outline'), "reference sub frame not yet selected"
@@ -547,15 +627,28 @@ class MdiFieldImreg_Wrapper(object):
         # // determine the image registration transform
         #do pading here
         union_outline = self.cal_union_region_target_and_reference()
-        self.target_zoom_frame = self._padding_to_union_size(self.target_sub_frame,self.target_sub_outline,union_outline)
-        self.reference_sub_frame = self._padding_to_union_size(self.reference_sub_frame,self.reference_sub_outline,union_outline)
+        self.target_zoom_frame, target_mask = self._padding_to_union_size(self.target_sub_frame,self.target_sub_outline,union_outline, return_mask=True)
+        self.reference_sub_frame, reference_mask = self._padding_to_union_size(self.reference_sub_frame,self.reference_sub_outline,union_outline, return_mask=True)
         min_y_dim = min([self.target_zoom_frame.shape[0],self.reference_sub_frame.shape[0]])
         min_x_dim = min([self.target_zoom_frame.shape[1],self.reference_sub_frame.shape[1]])
         #trim it down
         self.target_zoom_frame = self.target_zoom_frame[0:min_y_dim,0:min_x_dim]
         self.reference_sub_frame = self.reference_sub_frame[0:min_y_dim,0:min_x_dim]
-
-        cv2.imwrite(os.path.join(self.settings_object.value("FileManager/currentimagedbDir"),"target_sub_frame_downscaled.jpg"), self.target_zoom_frame)
+        masks = None
+        center_offset = None
+        if self.checkBox_dft_masked.isChecked():
+            # // masked mode: the padding is ignored and the FFTs only cover the overlap of the features
+            masks = [reference_mask[0:min_y_dim,0:min_x_dim], target_mask[0:min_y_dim,0:min_x_dim]]
+            crop = self._crop_to_overlap(masks)
+            if crop is not None:
+                self.target_zoom_frame = self.target_zoom_frame[crop]
+                self.reference_sub_frame = self.reference_sub_frame[crop]
+                masks = [m[crop] for m in masks]
+                # // the rotation and scaling are found about the crop center, they are applied about the union center
+                center_offset = [(crop[1].start + crop[1].stop - min_x_dim) / 2.0,
+                                 (crop[0].start + crop[0].stop - min_y_dim) / 2.0]
+
+        diagnostics.capture("target_sub_frame_downscaled", self.target_zoom_frame)
         #print("shapes:{}{}".format(self.target_zoom_frame.shape,self.reference_sub_frame.shape))
         output_text.append("shapes:{}{}".format(self.target_zoom_frame.shape,self.reference_sub_frame.shape))
         # // match the shape of reference (template) frame and current frame (image to be transformed
@@ -575,16 +668,46 @@ class MdiFieldImreg_Wrapper(object):
         #     output_text.append("no padding required")
         output_text.append("shapes:{}{}".format(self.target_zoom_frame.shape, self.reference_sub_frame.shape))
 
-        cv2.imwrite(os.path.join(self.settings_object.value("FileManager/currentimagedbDir"),"reference_sub_frame.jpg"), self.reference_sub_frame)
+        diagnostics.capture("reference_sub_frame", self.reference_sub_frame)
+        diagnostics.capture("target_zoom_frame_padded", self.target_zoom_frame)
+        self.dft_reg_instance.prepare_dft(self.reference_sub_frame, self.target_zoom_frame, masks=masks,
+                                          center_offset=center_offset,
+                                          levels=int(self.settings_object.value("Registration/pyramidLevels", 1)),
+                                          tolerance=float(self.settings_object.value("Registration/pyramidTolerance", 0.5)),
+                                          **self._dft_mode_settings())
+        self.dft_reg_instance.start()
 
-        # import cv2
-        cv2.imwrite(os.path.join(self.settings_object.value("FileManager/currentimagedbDir"),"target_zoom_frame_padded.jpg"), self.target_zoom_frame)
-        self.dft_reg_instance.prepare_dft(self.reference_sub_frame, self.target_zoom_frame)
-        try:
-            self.dft_reg_thread.terminate()
-        except:
-            pass
-        self.dft_reg_thread.start()
+    def _dft_mode_settings(self):
+        """
+        Registration mode and search windows of the DFT panel, a window of 0 leaves the parameter unconstrained
+        :return: keyword arguments of DFTRegistration.prepare_dft
+        """
+        angle_window = self.doubleSpinBox_dft_angle_window.value()
+        scale_window = self.doubleSpinBox_dft_scale_window.value()
+        return dict(mode=self.comboBox_dft_mode.currentText(), angle_window=angle_window or None,
+                    scale_window=scale_window or None)
+
+    def prepare_orb(self):
+        """
+        Feature based registration of the target sub frame against the reference sub frame. The padding of the union
+        region is excluded from the keypoint detection, the result is applied by dft_imreg2 like the DFT result.
+        :return:
+        """
+        assert hasattr(self, 'reference_sub_outline'), "reference sub frame not yet selected"
+        assert hasattr(self, 'target_sub_outline'), "target sub frame not yet selected"
+        union_outline = self.cal_union_region_target_and_reference()
+        target, target_mask = self._padding_to_union_size(self.target_sub_frame, self.target_sub_outline,
+                                                          union_outline, return_mask=True)
+        reference, reference_mask = self._padding_to_union_size(self.reference_sub_frame, self.reference_sub_outline,
+                                                                union_outline, return_mask=True)
+        ny = min(target.shape[0], reference.shape[0])
+        nx = min(target.shape[1], reference.shape[1])
+        self.target_zoom_frame = target[0:ny, 0:nx]
+        self.orb_reg_instance.detector = str(self.settings_object.value("Registration/featureDetector", 'orb'))
+        self.orb_reg_instance.n_features = int(self.settings_object.value("Registration/featureCount", 5000))
+        self.orb_reg_instance.prepare(reference[0:ny, 0:nx], self.target_zoom_frame,
+                                      masks=[reference_mask[0:ny, 0:nx], target_mask[0:ny, 0:nx]])
+        self.orb_reg_instance.start()
 
     @QtCore.pyqtSlot(object)
     def dft_imreg2(self, vector_dict):
@@ -644,9 +767,10 @@ class MdiFieldImreg_Wrapper(object):
             self.scale_factor = vector_dict["scale"]
             # // correct for pixel size to calculate the correct scale factor
 
-            arr = ird.imreg.transform_img_dict(self.target_zoom_frame, tdict=vector_dict, bgval=None, order=1,
-                                               invert=False)
-            cv2.imwrite(os.path.join(self.settings_object.value("FileManager/currentimagedbDir"),"target_sub_frame_transformed.jpg"), arr)
+            if diagnostics.enabled:
+                diagnostics.capture("target_sub_frame_transformed",
+                                    ird.imreg.transform_img_dict(self.target_zoom_frame, tdict=vector_dict, bgval=None,
+                                                                 order=1, invert=False))
 
             output_text.append("tvec: {}".format(vector_dict["tvec"]))
             output_text.append("angle: {}, {}".format(vector_dict["angle"], self.target_attrs["Rotation"]))
@@ -726,7 +850,7 @@ class MdiFieldImreg(QtWidgets.QDialog):
         self.outl_target = current_loc['Outline']
         if isinstance(current_loc, dict):
             self.target_attrs = current_loc
-            self.target_frame = qt_image_to_array(self.target_image.pixmap.toImage())
+            self.target_frame = self.target_image.gray_array()
             # // grayscale conversion
             # self.target_frame = np.dot(self.target_frame[..., :3], [0.299, 0.587, 0.114])
             self.ent_target.setText(current_loc["Path"])
@@ -752,7 +876,7 @@ class MdiFieldImreg(QtWidgets.QDialog):
         self.outl_reference = current_loc['Outline']
         if isinstance(current_loc, dict):
             self.reference_attrs = current_loc
-            self.reference_frame = qt_image_to_array(self.reference_image.pixmap.toImage())
+            self.reference_frame = self.reference_image.gray_array()
             # // grayscale conversion
             # self.reference_frame = np.dot(self.reference_frame[..., :3], [0.299, 0.587, 0.114])
             self.ent_ref.setText(current_loc["Path"])
@@ -887,7 +1011,7 @@ class MdiFieldImreg(QtWidgets.QDialog):
         assert hasattr(self, 'target_frame'), "No target frame has been registered!"
         self.target_sub_frame = self.roi.getArrayRegion(self.target_frame, self.target_image)
         self.target_sub_outline = self.current_roi_outline
-        cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\target_sub_frame.jpg", self.target_sub_frame)
+        diagnostics.capture("target_sub_frame", self.target_sub_frame)
 
     def _update_outl(self):
         #outl should only reflect the width and the height of roi with the right rotation center
@@ -948,7 +1072,7 @@ class MdiFieldImreg(QtWidgets.QDialog):
             self.reference_sub_frame = ndii.zoom(self.reference_sub_frame, (pixel_scale_target/pixel_scale_ref))
             self.target_zoom_frame = self.target_sub_frame
         '''
-        cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\target_sub_frame_downscaled.jpg", self.target_zoom_frame)
+        diagnostics.capture("target_sub_frame_downscaled", self.target_zoom_frame)
 
         print("shapes:", self.target_zoom_frame.shape, self.reference_sub_frame.shape)
         # // match the shape of reference (template) frame and current frame (image to be transformed
@@ -969,10 +1093,10 @@ class MdiFieldImreg(QtWidgets.QDialog):
         print("shapes:", self.target_zoom_frame.shape, self.reference_sub_frame.shape)
         # self.target_image.setImage(self.target_frame)
         # import cv2
-        cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\reference_sub_frame.jpg", self.reference_sub_frame)
+        diagnostics.capture("reference_sub_frame", self.reference_sub_frame)
 
         # import cv2
-        cv2.imwrite(r"C:\\Users\\qiucanro\Downloads\\target_zoom_frame_padded.jpg", self.target_zoom_frame)
+        diagnostics.capture("target_zoom_frame_padded", self.target_zoom_frame)
 
         # // get different frames (taking into account the scaling)
         
@@ -990,9 +1114,10 @@ class MdiFieldImreg(QtWidgets.QDialog):
             self.scale_factor = vector_dict["scale"]
             # // correct for pixel size to calculate the correct scale factor
 
-            arr = ird.imreg.transform_img_dict(self.target_sub_frame, tdict=vector_dict, bgval=None, order=1,
-                                               invert=False)
-            cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\target_sub_frame_transformed.jpg", arr)
+            if diagnostics.enabled:
+                diagnostics.capture("target_sub_frame_transformed",
+                                    ird.imreg.transform_img_dict(self.target_sub_frame, tdict=vector_dict,
+                                                                 bgval=None, order=1, invert=False))
 
             print('DFT registration results:')
             print("tvec: ", vector_dict["tvec"])
@@ -1088,7 +1213,7 @@ class MdiFieldImreg(QtWidgets.QDialog):
         #self.target_sub_frame = self.roi.getArrayRegion(self.target_frame, self.target_image)
         self.reference_sub_frame = self.reference_frame
         self.target_sub_frame = self.target_frame
-        cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\target_sub_frame.jpg", self.target_sub_frame)
+        diagnostics.capture("target_sub_frame", self.target_sub_frame)
         # // downscale the target frame to the resolution of the reference frame (in order to have comparable
         # resolution across the images ( resolution in pixel per micron). Having a greater resolution than the
         # reference target won't really help in getting a more accurate registration.
@@ -1105,7 +1230,7 @@ class MdiFieldImreg(QtWidgets.QDialog):
             self.reference_sub_frame = ndii.zoom(self.reference_sub_frame, (pixel_scale_target/pixel_scale_ref))
             self.target_zoom_frame = self.target_sub_frame
         import cv2
-        cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\target_sub_frame_downscaled.jpg", self.target_zoom_frame)
+        diagnostics.capture("target_sub_frame_downscaled", self.target_zoom_frame)
 
         print("shapes:", self.target_zoom_frame.shape, self.reference_sub_frame.shape)
         # // match the shape of reference (template) frame and current frame (image to be transformed
@@ -1126,10 +1251,10 @@ class MdiFieldImreg(QtWidgets.QDialog):
         print("shapes:", self.target_zoom_frame.shape, self.reference_sub_frame.shape)
         # self.target_image.setImage(self.target_frame)
         import cv2
-        cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\reference_sub_frame.jpg", self.reference_sub_frame)
+        diagnostics.capture("reference_sub_frame", self.reference_sub_frame)
 
         import cv2
-        cv2.imwrite(r"C:\\Users\\qiucanro\Downloads\\target_zoom_frame_padded.jpg", self.target_zoom_frame)
+        diagnostics.capture("target_zoom_frame_padded", self.target_zoom_frame)
 
         # // get different frames (taking into account the scaling)
         
@@ -1167,17 +1292,16 @@ class MdiFieldImreg(QtWidgets.QDialog):
             vector_dict["tvec"] *= (pixel_scale_target / pixel_scale_ref)
             arr = ird.imreg.transform_img_dict(self.target_sub_frame, tdict=vector_dict, bgval=None, order=1,
                                                invert=False)
-            import cv2
-            cv2.imwrite(r"C:\\Users\\qiucanro\Downloads\\target_sub_frame_transformed.jpg", arr)
-            self.target_image.setPixmap(QtGui.QPixmap(r"C:\\Users\qiucanro\\Downloads\\target_sub_frame_transformed.jpg"))
+            diagnostics.capture("target_sub_frame_transformed", arr)
+            self.target_image.setPixmap(QtGui.QPixmap.fromImage(array_to_qimage(np.ascontiguousarray(to_uint8(arr)))))
             self.target_image.setPos(self.roi.pos())
             self.target_image.scale(target_x_size / arr.shape[0], target_y_size / arr.shape[1])
         else:
             import imreg_dft as ird
-            arr = ird.imreg.transform_img_dict(self.target_sub_frame, tdict=vector_dict, bgval=None, order=1,
-                                               invert=False)
-            import cv2
-            cv2.imwrite(r"C:\\Users\\qiucanro\\Downloads\\target_sub_frame_transformed.jpg", arr)
+            if diagnostics.enabled:
+                diagnostics.capture("target_sub_frame_transformed",
+                                    ird.imreg.transform_img_dict(self.target_sub_frame, tdict=vector_dict,
+                                                                 bgval=None, order=1, invert=False))
 
             # self.target_attrs["Rotation"] = full_rotation_degrees
 
@@ -4,7 +4,6 @@ from pathlib import Path
 from PyQt5 import QtCore, QtGui, QtWidgets, uic
 from PyQt5.QtCore import pyqtSignal as Signal
 from spatial_registration_module import rotatePoint
-from util import qt_image_to_array
 import pyqtgraph as pg
 import numpy as np
 import math
@@ -42,9 +41,9 @@ class geometry_widget_wrapper(object):
     #callback whenever switch to a different image, being called once
     def update_geo(self):
         self.attrs_geo = self.update_field_current.loc
-        self.img_array_gray = qt_image_to_array(self.update_field_current.pixmap.toImage())
+        self.img_array_gray = self.update_field_current.gray_array()
         #array dimension
-        self.shape_geo = (self.update_field_current.pixmap.width(), self.update_field_current.pixmap.height(), 1)
+        self.shape_geo = (*self.update_field_current.pixel_size(), 1)
         # % get length from outline
         if not 'Outline' in self.attrs_geo.keys():
             self.attrs_geo['Outline'] = [0, self.shape_geo[self.axis_geo[0]], 0, self.shape_geo[self.axis_geo[1]], 0,
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import tifffile
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import pyqtSignal as Signal
+from tile_pyramid_module import TilePyramid
+from importmodule import read_tiff
+
+
+def decode_image(d):
+    """
+    Decodes the image file referenced by an image dictionary into one array (gray, RGB or RGBA). TIFF files keep their
+    native data type and are memory mapped, the other formats are decoded to uint8. The file is
+    decoded only once, the QImage used for display is a view on this array (see util.array_to_qimage). This function
+    does not touch the scene graph, so it is safe to run it in a worker thread.
+
+    :param d: the image dictionary, it must have a Path key
+    :return: the numpy array of the image, None if the file can not be decoded
+    """
+    image = None
+    if not os.path.exists(d['Path']):
+        QtCore.qDebug("Path not found")
+        return image
+
+    ext = os.path.splitext(d['Path'])[-1].lower()
+    if ext in (".bmp", ".jpg", ".jpeg", ".png"):
+        # // cv2 checks the file signature, so a PNG which is actually a BMP is decoded as well
+        image = cv2.imread(d['Path'], cv2.IMREAD_UNCHANGED)
+        if image is not None:
+            if image.dtype != np.uint8:
+                image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            # // convert in place from the cv2 channel order to the display order
+            if image.ndim == 3 and image.shape[2] == 3:
+                cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+            elif image.ndim == 3 and image.shape[2] == 4:
+                cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA, dst=image)
+    elif ext in (".tif", ".tiff"):
+        # // memory mapped, native data type; the display levels are set by the image item (see util.quick_level)
+        image = read_tiff(d['Path'])
+        # // keep the first frame of stacks
+        while image.ndim > 3 or (image.ndim == 3 and image.shape[2] not in (3, 4)):
+            image = image[0]
+    else:
+        QtCore.qDebug("Image format not supported")
+
+    if image is not None and not image.flags['C_CONTIGUOUS']:
+        image = np.ascontiguousarray(image)
+    return image
+
+
+def load_image(d, pyramid_threshold=None, cache_dir=None):
+    """
+    Loads the pixel data of an image dictionary. Images larger than pyramid_threshold pixels are served from a tile
+    pyramid: a cached pyramid is opened without decoding the source file, otherwise it is generated once from the
+    decoded image. The returned image is then the memory mapped full resolution level of the pyramid.
+
+    :param d: the image dictionary, it must have a Path key
+    :param pyramid_threshold: number of pixels above which a tile pyramid is used, None to disable
+    :param cache_dir: folder of the pyramid cache
+    :return: (image, pyramid) tuple, pyramid is None for images drawn directly
+    """
+    if pyramid_threshold:
+        pyramid = TilePyramid.open_cached(d['Path'], cache_dir)
+        if pyramid is not None:
+            return pyramid.level(0), pyramid
+    image = decode_image(d)
+    if pyramid_threshold and image is not None and image.shape[0] * image.shape[1] > pyramid_threshold:
+        pyramid = TilePyramid.build(d['Path'], image, cache_dir)
+        return pyramid.level(0), pyramid
+    return image, None
+
+
+def read_image_shape(d, cache_dir=None):
+    """
+    Reads the pixel dimensions of an image from the file header, without decoding the pixel data.
+
+    :param d: the image dictionary, it must have a Path key
+    :param cache_dir: folder of the tile pyramid cache, a cached pyramid gives the shape without opening the file
+    :return: (height, width) tuple, None if the file can not be read
+    """
+    if not os.path.exists(d['Path']):
+        QtCore.qDebug("Path not found")
+        return None
+    pyramid = TilePyramid.open_cached(d['Path'], cache_dir)
+    if pyramid is not None:
+        return pyramid.shapes[0][0:2]
+    ext = os.path.splitext(d['Path'])[-1].lower()
+    if ext in (".tif", ".tiff"):
+        with tifffile.TiffFile(d['Path']) as tif:
+            return tif.pages[0].shape[0:2]
+    size = QtGui.QImageReader(d['Path']).size()
+    if size.isValid():
+        return size.height(), size.width()
+    return None
+
+
+class ImageLoader(QtCore.QObject):
+    """
+    Runs a load function (load_image by default) on a list of image dictionaries in a pool of worker threads and
+    streams the results back to the Qt thread in batches of (d, result) tuples, in the order of the input list. Only
+    the decoding is done in the pool; the receiver of sig_batch_ready is expected to do the (cheap) insertion into
+    the scene graph.
+    """
+    sig_batch_ready = Signal(object)
+    sig_progress = Signal(float)
+    sig_finished = Signal(bool)
+    # // internal signals, tagged with the job id so that batches of a cancelled job still queued are dropped
+    _sig_batch = Signal(int, object)
+    _sig_progress = Signal(int, float)
+    _sig_finished = Signal(int, bool)
+
+    def __init__(self, max_workers=None, batch_size=8, batch_interval=0.1, pyramid_threshold=None, cache_dir=None,
+                 func=None, parent=None):
+        """
+        :param max_workers: number of decoding threads, defaults to the number of cpus
+        :param batch_size: max number of decoded images sent to the Qt thread at once
+        :param batch_interval: max time (in s) a decoded image is held back before the batch is sent
+        :param pyramid_threshold: number of pixels above which images are drawn from a tile pyramid (see load_image)
+        :param cache_dir: folder of the tile pyramid cache
+        :param func: function called with the image dictionary in the pool, defaults to load_image
+        :param parent: parent QObject
+        """
+        super(ImageLoader, self).__init__(parent)
+        self.max_workers = max_workers or os.cpu_count() or 4
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.func = func or partial(load_image, pyramid_threshold=pyramid_threshold, cache_dir=cache_dir)
+        self._cancel_event = threading.Event()
+        self._thread = None
+        self._job = 0
+        self._sig_batch.connect(self._on_batch)
+        self._sig_progress.connect(self._on_progress)
+        self._sig_finished.connect(self._on_finished)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, dict_list):
+        """
+        Starts decoding the images in dict_list. A running job is cancelled first.
+        :param dict_list: list or iterable of image dictionaries. An iterable (e.g. importmodule.iter_im_xml) is
+                          consumed lazily by the dispatcher thread, its progress attribute (0-1) is reported when it
+                          has no length
+        :return:
+        """
+        self.cancel()
+        self._job += 1
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._job, dict_list, self._cancel_event),
+                                        daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """
+        Requests the running job to stop. Images which are already decoded are dropped.
+        :return:
+        """
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _on_batch(self, job, batch):
+        if job == self._job and not self._cancel_event.is_set():
+            self.sig_batch_ready.emit(batch)
+
+    def _on_progress(self, job, value):
+        if job == self._job:
+            self.sig_progress.emit(value)
+
+    def _on_finished(self, job, cancelled):
+        if job == self._job:
+            self.sig_finished.emit(cancelled or self._cancel_event.is_set())
+
+    def _run(self, job, dict_list, cancel_event):
+        n = len(dict_list) if hasattr(dict_list, '__len__') else None
+        batch = []
+        last_emit = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # // only a window of images is in flight, so a streamed input is never read ahead completely
+        window = self.max_workers * 4
+        pending = deque()
+        it = iter(dict_list)
+        exhausted = False
+        i = -1
+        try:
+            while not cancel_event.is_set():
+                while not exhausted and len(pending) < window:
+                    try:
+                        d = next(it)
+                    except StopIteration:
+                        exhausted = True
+                    except Exception as e:
+                        QtCore.qDebug("Failed to read the image list: {}".format(e))
+                        exhausted = True
+                    else:
+                        pending.append((d, executor.submit(self.func, d)))
+                if not pending:
+                    break
+                d, future = pending.popleft()
+                i += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    QtCore.qDebug("Failed to decode {}: {}".format(d.get('Path'), e))
+                    result = None
+                batch.append((d, result))
+                if len(batch) >= self.batch_size or (time.monotonic() - last_emit) > self.batch_interval:
+                    if cancel_event.is_set():
+                        break
+                    self._sig_batch.emit(job, batch)
+                    if n:
+                        self._sig_progress.emit(job, (i + 1) / n * 100)
+                    else:
+                        self._sig_progress.emit(job, getattr(dict_list, 'progress', 0) * 100)
+                    batch = []
+                    last_emit = time.monotonic()
+            if batch and not cancel_event.is_set():
+                self._sig_batch.emit(job, batch)
+        finally:
+            # // shutdown(cancel_futures=True) needs python 3.9
+            for d, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+        if not cancel_event.is_set():
+            self._sig_progress.emit(job, 100)
+        self._sig_finished.emit(job, cancel_event.is_set())
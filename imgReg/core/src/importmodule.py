@@ -26,6 +26,28 @@ while decrement:
         maxInt = int(maxInt / 10)
         decrement = True
 
+def read_tiff(path_str):
+    '''
+	Reads a tiff file in its native data type. Uncompressed files are memory mapped, other files are decoded into a
+	temporary memory map, so that the data is never held in RAM as a whole.
+
+	Parameters
+	----------
+	path_str: string
+		path of the tiff file
+
+	Returns
+	-------
+	numpy.memmap
+	'''
+    import tifffile
+    try:
+        return tifffile.memmap(path_str, mode='r')
+    except ValueError:
+        # // compressed or non contiguous image data can not be mapped directly
+        with tifffile.TiffFile(path_str) as tif:
+            return tif.asarray(out='memmap')
+
 def load_tiff(path_str, mode=0, mono=False, dgroup='', node='', progressbar='', pos=[0, 0]):
     '''
 	Generic loader for tiff files into HDF5
@@ -35,7 +57,9 @@ def load_tiff(path_str, mode=0, mono=False, dgroup='', node='', progressbar='',
 	path_str: string
 		path of file or folder containing file
 	mode: int, optional
-		dimensionality of the data
+		dimensionality of the data. With mode 1, the image written to the node is a read-only view on the memory
+		mapped file (see read_tiff), in the native data type of the file (not float64); copy it (e.g.
+		np.array(image, dtype=np.float64)) before modifying it in place
 	DTYPE: string, optional
 		Determines how the array is imported. 3 types are available: signal, voi, reference, and mask
 	dgroup: hdf5 group, optional
@@ -57,45 +81,37 @@ def load_tiff(path_str, mode=0, mono=False, dgroup='', node='', progressbar='',
 	--------
 
 	'''
-    from tifffile import TiffFile
     if mode == 1:
-        tif = TiffFile(path_str)
-        arr = tif.asarray()
+        # // the 5D image is a view on the (memory mapped) tiff data, in its native data type
+        arr = read_tiff(path_str)
         if len(arr.shape) == 4:
             w = arr.shape[3]
             h = arr.shape[2]
 
             if arr.shape[0] < 5:
-                image = np.zeros((1, arr.shape[0], arr.shape[1], arr.shape[2], arr.shape[3]))
-                image[0] = arr
+                image = arr[np.newaxis]
             else:
-                image = np.zeros((1, arr.shape[1], arr.shape[0], arr.shape[2], arr.shape[3]))
-                image[0] = np.transpose(arr, (1, 0, 2, 3))
+                image = np.transpose(arr, (1, 0, 2, 3))[np.newaxis]
 
         elif len(arr.shape) == 3:
             if arr.shape[2] < 5:
                 w = arr.shape[1]
                 h = arr.shape[0]
                 if mono:
-                    image = np.zeros((1, 1, 1, arr.shape[0], arr.shape[1]))
-                    image[0, 0, 0] = np.sum(arr, axis=2)
+                    image = np.sum(arr, axis=2)[np.newaxis, np.newaxis, np.newaxis]
                 else:
-                    image = np.zeros((1, arr.shape[2], 1, arr.shape[0], arr.shape[1]))
-                    image[0, :, 0] = np.transpose(arr, (2, 0, 1))
+                    image = np.transpose(arr, (2, 0, 1))[np.newaxis, :, np.newaxis]
             else:
                 w = arr.shape[2]
                 h = arr.shape[1]
                 if mono:
-                    image = np.zeros((1, 1, 1, arr.shape[1], arr.shape[2]))
-                    image[0, 0, 0] = np.sum(arr, axis=0)
+                    image = np.sum(arr, axis=0)[np.newaxis, np.newaxis, np.newaxis]
                 else:
-                    image = np.zeros((1, arr.shape[0], 1, arr.shape[1], arr.shape[2]))
-                    image[0, :, 0] = arr
+                    image = arr[np.newaxis, :, np.newaxis]
 
 
         elif len(arr.shape) == 2:
-            image = np.zeros((1, 1, 1, arr.shape[0], arr.shape[1]))
-            image[0, 0, 0] = arr
+            image = arr[np.newaxis, np.newaxis, np.newaxis]
             w = arr.shape[1]
             h = arr.shape[0]
 
@@ -107,7 +123,6 @@ def load_tiff(path_str, mode=0, mono=False, dgroup='', node='', progressbar='',
                                dgroup="Microscope Image", node=node, overwrite=True)
         dset_node.parent.attrs['NodeType'] = 'MultiplexedImage'
         dset_node.attrs["Outline"] = [pos[0] - w / 2, w / 2 + pos[0], pos[1] - h / 2, h / 2 + pos[1], 0, 1]
-        tif.close()
     elif mode == 2:
         from tifffile import TiffFile
         import cv2
@@ -170,6 +185,119 @@ def load_align_xml(xml_path):
                 attrs['Focus'] = 0
             return attrs
 
+def _parse_image_element(elem, path):
+    """
+    Builds the attribute dictionary of one <ImageN> element of an imagedb file, in a single pass over its children.
+
+    :param elem: the lxml element
+    :param path: folder of the imagedb file
+    :return: the attribute dictionary
+    """
+    children = {c.tag: c for c in elem}
+    filename = children["Filename"].text
+    attrs = {'Path': os.path.join(path, filename),
+             'Name': filename}
+    if "Opacity" in children:
+        attrs['Opacity'] = int(children["Opacity"].text)
+    else:
+        attrs['Opacity'] = 100
+    if "Visible" in children:
+        attrs["Visible"] = 'TRUE' in children["Visible"].text
+    else:
+        attrs["Visible"] = True
+    if "Rotation" in children:
+        attrs['Rotation'] = np.float64(children["Rotation"].text)
+    else:
+        attrs['Rotation'] = 0
+    if "Center" in children:
+        attrs['Center'] = np.array([np.float64(k) for k in children["Center"].text.split(',')],
+                                   dtype=np.float64)
+    else:
+        attrs["Center"] = [np.array([50000, 50000])]
+    if "Size" in children:
+        attrs['Size'] = np.array([np.float64(k) for k in children["Size"].text.split(',')])
+    else:
+        attrs["Size"] = [np.array([0, 0])]
+    if "Focus" in children:
+        attrs['Focus'] = np.float64(children["Focus"].text)
+    else:
+        attrs['Focus'] = 0
+
+    if "BaseFolder" in children:
+        attrs['BaseFolder'] = children["BaseFolder"].text
+        attrs['Path'] = os.path.join(attrs['BaseFolder'], filename)
+    if 'Particle' in children:
+        for child_par in children['Particle']:
+            attrs[child_par.tag] = child_par.text
+    c = attrs['Center']
+    s = attrs['Size']
+    #z is not used
+    z = attrs['Focus']
+    outline = [(c[0] - s[0] / 2.0), (c[0] + s[0] / 2.0), (c[1] - s[1] / 2.0), (c[1] + s[1] / 2.0), -0.5, 0.5]
+    attrs['Outline'] = outline
+    attrs['Parent'] = ""
+    attrs['NodeType'] = 'RGBA'
+    return attrs
+
+class XmlImageIterator(object):
+    """
+    Streams the attribute dictionaries of an imagedb file with lxml iterparse. Every top level element is cleared once
+    parsed, so the memory use does not grow with the file size. The progress attribute (0-1) is the fraction of the
+    file read so far.
+
+    Notes
+    -----
+    The BaseFolder of the trailing <Data> element is also set on the dictionaries which were already yielded.
+    """
+
+    def __init__(self, xml_path, exclude_file=[]):
+        self.xml_path = xml_path
+        self.exclude_file = exclude_file
+        self.progress = 0.
+
+    def __iter__(self):
+        from lxml import etree as ET
+        path = os.path.split(self.xml_path)[0]
+        size = max(1, os.path.getsize(self.xml_path))
+        yielded = []
+        with open(self.xml_path, 'rb') as f:
+            depth = 0
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                # // a complete top level element
+                if 'Image' in elem.tag:
+                    filename = elem.find("Filename")
+                    if filename is not None and os.path.join(path, filename.text) not in self.exclude_file:
+                        attrs = _parse_image_element(elem, path)
+                        yielded.append(attrs)
+                        self.progress = min(1., f.tell() / size)
+                        yield attrs
+                elif 'Data' in elem.tag:
+                    base_folder = elem.find("BaseFolder")
+                    if base_folder is not None:
+                        for k in yielded:
+                            k["BaseFolder"] = base_folder.text
+                # // release the parsed element and the references kept by the root
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        self.progress = 1.
+
+def iter_im_xml(xml_path, exclude_file=[]):
+    """
+    Streaming version of load_im_xml, see XmlImageIterator.
+
+    :param xml_path: path of the imagedb file
+    :param exclude_file: list of image paths to be skipped
+    :return: XmlImageIterator
+    """
+    return XmlImageIterator(xml_path, exclude_file)
+
 def load_im_xml(xml_path, exclude_file, progressbar=''):
     """
 
@@ -178,76 +306,13 @@ def load_im_xml(xml_path, exclude_file, progressbar=''):
     :param progressbar:
     :return:
     """
-    path = os.path.split(xml_path)[0]
-    from lxml import etree as ET
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+    it = iter_im_xml(xml_path, exclude_file)
     attr_list = []
-    v = len(root.findall(".//Center"))
-    for i, child in enumerate(root):
-        if 'Image' in child.tag:
-            if root[i].find("Filename") is not None:
-                if os.path.join(path, root[i].find("Filename").text) not in exclude_file:
-                    attrs = {'Path': os.path.join(path, root[i].find("Filename").text),
-                             'Name': root[i].find("Filename").text}
-                    # // build the tag list
-                    tag_list = [c.tag for c in root[i]]
-                    if "Opacity" in tag_list:
-                        attrs['Opacity'] = int(root[i].find("Opacity").text)
-                    else:
-                        attrs['Opacity'] = 100
-                    if "Visible" in tag_list:
-                        if 'TRUE' in root[i].find("Visible").text:
-                            attrs["Visible"] = True
-                        else:
-                            attrs["Visible"] = False
-                    else:
-                        attrs["Visible"] = True
-                    if "Rotation" in tag_list:
-                        attrs['Rotation'] = np.float64(root[i].find("Rotation").text)
-                    else:
-                        attrs['Rotation'] = 0
-                    if "Center" in tag_list:
-                        attrs['Center'] = np.array([np.float64(k) for k in root[i].find("Center").text.split(',')],
-                                                   dtype=np.float64)
-                    else:
-                        attrs["Center"] = [np.array([50000, 50000])]
-                    if "Size" in tag_list:
-                        attrs['Size'] = np.array([np.float64(k) for k in root[i].find("Size").text.split(',')])
-                    else:
-                        attrs["Size"] = [np.array([0, 0])]
-                    if "Focus" in tag_list:
-                        attrs['Focus'] = np.float64(root[i].find("Focus").text)
-                    else:
-                        attrs['Focus'] = 0
-
-                    if "BaseFolder" in tag_list:
-                        attrs['BaseFolder'] = root[i].find("BaseFolder").text
-                        attrs['Path'] = os.path.join(attrs['BaseFolder'], root[i].find("Filename").text)
-                    if 'Particle' in tag_list:
-                        for jj, child_par in enumerate(root[i].find('Particle')):
-                            attrs[child_par.tag] = child_par.text
-                    c = attrs['Center']
-                    s = attrs['Size']
-                    #z is not used
-                    z = attrs['Focus']
-                    outline = [(c[0] - s[0] / 2.0), (c[0] + s[0] / 2.0), (c[1] - s[1] / 2.0), (c[1] + s[1] / 2.0), -0.5, 0.5]
-                    attrs['Outline'] = outline
-                    attrs['Parent'] = ""
-                    attrs['NodeType'] = 'RGBA'
-                    attr_list.append(attrs)
-        elif 'Data' in child.tag:
-            for j in root[i]:
-                if j.tag == "BaseFolder":
-                    for k in attr_list:
-                        k["BaseFolder"] = root[i][1].text
-                        p = os.path.join(k['BaseFolder'], k["Name"])
-                    # if os.path.exists(p):
-                    #     k['Path'] = p
-
+    for attrs in it:
+        attr_list.append(attrs)
         if progressbar:
             try:
-                progressbar.setValue(i / v * 100)
+                progressbar.setValue(it.progress * 100)
             except:
                 pass
     return attr_list
@@ -83,26 +83,173 @@ Examples
 """
 
 import math
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
 
 import numpy
-from numpy.fft import fft2, ifft2, fftshift
+from numpy.fft import fftshift
 
 try:
     import scipy.ndimage.interpolation as ndii
 except ImportError:
     import ndimage.interpolation as ndii
 
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
 __version__ = '2013.01.18'
 __docformat__ = 'restructuredtext en'
-__all__ = ['translation', 'similarity']
+__all__ = ['translation', 'masked_translation', 'spectrum_translation',
+           'similarity', 'scale_angle', 'set_fft_backend',
+           'reference_spectrum', 'reference_logpolar']
+
+# FFT backend: scipy.fft (multithreaded) when available, else numpy.fft.
+# Images are zero padded to the next fast FFT length when 'pad' is set.
+_fft_backend = {'name': 'scipy' if scipy_fft is not None else 'numpy',
+                'workers': os.cpu_count() or 1,
+                'pad': True}
+
+
+def set_fft_backend(name=None, workers=None, pad=None):
+    """Select the FFT backend.
+
+    name: 'scipy' or 'numpy'.
+    workers: number of threads used by the scipy backend (-1 for all cpus).
+    pad: zero pad the images to the next fast FFT length.
+
+    """
+    if name is not None:
+        if name == 'scipy' and scipy_fft is None:
+            raise ValueError("scipy.fft is not available")
+        if name not in ('scipy', 'numpy'):
+            raise ValueError("Unknown FFT backend: {}".format(name))
+        _fft_backend['name'] = name
+    if workers is not None:
+        _fft_backend['workers'] = workers
+    if pad is not None:
+        _fft_backend['pad'] = pad
+    clear_spectrum_cache()
+
+
+def fast_shape(shape):
+    """Return the shape used for the FFTs of images of the given shape."""
+    if not _fft_backend['pad'] or scipy_fft is None:
+        return tuple(shape)
+    return tuple(scipy_fft.next_fast_len(int(n)) for n in shape)
+
+
+def fft2(a, s=None, workers=None):
+    """Return 2D FFT of a, zero padded to shape s, using the current backend.
+
+    workers overrides the number of threads of the backend for this call.
+
+    """
+    if _fft_backend['name'] == 'scipy':
+        return scipy_fft.fft2(a, s=s, workers=workers or _fft_backend['workers'])
+    return numpy.fft.fft2(a, s=s)
+
+
+def ifft2(a, s=None, workers=None):
+    """Return 2D inverse FFT of a using the current backend."""
+    if _fft_backend['name'] == 'scipy':
+        return scipy_fft.ifft2(a, s=s, workers=workers or _fft_backend['workers'])
+    return numpy.fft.ifft2(a, s=s)
+
+
+# Content keyed LRU cache of reference spectra, bounded by the total number
+# of bytes of the cached arrays (the spectra are padded complex128 arrays).
+_spectrum_cache = OrderedDict()
+_spectrum_cache_lock = threading.Lock()
+_spectrum_cache_nbytes = [0]
+spectrum_cache_bytes = 256 * 2 ** 20
+
+
+def clear_spectrum_cache():
+    """Empty the reference spectrum cache."""
+    with _spectrum_cache_lock:
+        _spectrum_cache.clear()
+        _spectrum_cache_nbytes[0] = 0
+
+
+def _nbytes(value):
+    """Return the number of bytes of the arrays of a cached value."""
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    return getattr(value, 'nbytes', 0)
+
+
+def _cached(key, func):
+    """Return func() from the reference cache, computing it on a miss.
 
+    Values larger than the whole cache are returned without being cached.
 
-def translation(im0, im1):
-    """Return translation vector to register images."""
-    shape = im0.shape
-    f0 = fft2(im0)
-    f1 = fft2(im1)
-    ir = abs(ifft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1))))
+    """
+    with _spectrum_cache_lock:
+        value = _spectrum_cache.get(key)
+        if value is not None:
+            _spectrum_cache.move_to_end(key)
+            return value
+    value = func()
+    size = _nbytes(value)
+    if size > spectrum_cache_bytes:
+        return value
+    with _spectrum_cache_lock:
+        if key not in _spectrum_cache:
+            _spectrum_cache[key] = value
+            _spectrum_cache_nbytes[0] += size
+        while (_spectrum_cache_nbytes[0] > spectrum_cache_bytes and
+               len(_spectrum_cache) > 1):
+            _, old = _spectrum_cache.popitem(last=False)
+            _spectrum_cache_nbytes[0] -= _nbytes(old)
+    return value
+
+
+def _content_key(im, s):
+    im = numpy.ascontiguousarray(im)
+    digest = hashlib.blake2b(im.view(numpy.uint8).reshape(-1)).hexdigest()
+    return (digest, im.shape, im.dtype.str, tuple(s) if s is not None else None,
+            _fft_backend['name'])
+
+
+def reference_spectrum(im, s=None):
+    """Return the (read-only) FFT of a reference image, zero padded to shape s.
+
+    The spectrum is cached by image content, so registering several images
+    against the same reference computes its forward transform only once.
+
+    """
+    def compute():
+        f = fft2(im, s)
+        f.flags.writeable = False
+        return f
+    return _cached(('fft',) + _content_key(im, s), compute)
+
+
+def _logpolar_spectrum(f):
+    """Return FFT of the log-polar transformed, high-pass filtered amplitude
+    spectrum f, and the log base."""
+    f = fftshift(abs(f))
+    f *= highpass(f.shape)
+    f, log_base = logpolar(f)
+    return fft2(f), log_base
+
+
+def reference_logpolar(im, s=None):
+    """Return the (read-only) log-polar spectrum of a reference image and the
+    log base (see _logpolar_spectrum), cached like reference_spectrum."""
+    def compute():
+        f, log_base = _logpolar_spectrum(reference_spectrum(im, s))
+        f.flags.writeable = False
+        return f, log_base
+    return _cached(('logpolar',) + _content_key(im, s), compute)
+
+
+def _peak_to_shift(ir, shape):
+    """Return the shift of the correlation peak, wrapped to [-n/2, n/2]."""
     t0, t1 = numpy.unravel_index(numpy.argmax(ir), shape)
     if t0 > shape[0] // 2:
         t0 -= shape[0]
@@ -111,20 +258,160 @@ def translation(im0, im1):
     return [t0, t1]
 
 
-def similarity(im0, im1):
-    """Return similarity transformed image im1 and transformation parameters.
+# Upsampling factor of the subpixel peak refinement, the translation is
+# estimated to 1/subpixel_upsample pixel (1 disables the refinement).
+subpixel_upsample = 20
 
-    Transformation parameters are: isotropic scale factor, rotation angle (in
-    degrees), and translation vector.
 
-    A similarity transformation is an affine transformation with isotropic
-    scale and without shear.
+def _upsampled_dft(data, region_size, upsample, offsets):
+    """Return the inverse DFT of data, upsampled by a factor upsample, on a
+    region_size window starting at offsets (in upsampled pixels).
 
-    Limitations:
-    Image shapes must be equal and square.
-    All image areas must have same scale, rotation, and shift.
-    Scale change must be less than 1.8.
-    No subpixel precision.
+    The DFT is computed as two small matrix products, its cost is linear in
+    the region size instead of an upsampled FFT of the whole image.
+
+    """
+    for n, size, offset in zip(data.shape[::-1], region_size[::-1],
+                               offsets[::-1]):
+        kernel = ((numpy.arange(size) - offset)[:, None] *
+                  numpy.fft.fftfreq(n, upsample))
+        kernel = numpy.exp(2j * numpy.pi * kernel)
+        data = numpy.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+def _refine_peak(r, shift, upsample):
+    """Return the subpixel shift of the peak of the inverse transform of the
+    cross power spectrum r, refined around the integer shift."""
+    region = int(math.ceil(upsample * 1.5))
+    dftshift = numpy.fix(region / 2.0)
+    shift = numpy.asarray(shift, dtype=numpy.float64)
+    cc = _upsampled_dft(r, (region, region), upsample,
+                        dftshift - shift * upsample)
+    peak = numpy.unravel_index(numpy.argmax(abs(cc)), cc.shape)
+    return list(shift + (numpy.asarray(peak) - dftshift) / upsample)
+
+
+def _phase_correlation(f0, f1, upsample=None, workers=None):
+    """Return the translation of the phase correlation peak of two spectra."""
+    if upsample is None:
+        upsample = subpixel_upsample
+    r = (f0 * f1.conjugate()) / (abs(f0) * abs(f1))
+    ir = abs(ifft2(r, workers=workers))
+    shift = _peak_to_shift(ir, ir.shape)
+    if upsample > 1:
+        shift = _refine_peak(r, shift, upsample)
+    return shift
+
+
+def translation(im0, im1, upsample=None):
+    """Return translation vector to register images.
+
+    im0 is the reference image, its spectrum is cached (see reference_spectrum).
+    The shift is refined to 1/upsample pixel (default subpixel_upsample).
+
+    """
+    s = fast_shape(im0.shape)
+    f0 = reference_spectrum(im0, s)
+    f1 = fft2(im1, s)
+    return _phase_correlation(f0, f1, upsample)
+
+
+def spectrum_translation(f0, im1, upsample=None, workers=None):
+    """Return translation vector to register im1 against a reference
+    image given by its spectrum f0 (padded to the FFT shape, see fast_shape).
+
+    For a stream of images registered against one reference: the reference
+    is neither transformed nor hashed again, each image costs one forward
+    and one inverse FFT, computed with the given number of threads (default:
+    the backend setting).
+
+    """
+    return _phase_correlation(f0, fft2(im1, f0.shape, workers), upsample,
+                              workers)
+
+
+def masked_translation(im0, im1, mask0, mask1, overlap_ratio=0.3):
+    """Return translation vector to register images, using only the pixels
+    where the masks are set.
+
+    Masked normalized cross-correlation (Padfield, IEEE TIP 21, 2012): the
+    padding or any invalid area of either image does not contribute to the
+    correlation. Shifts where the masks overlap on less than overlap_ratio of
+    the maximum overlap are ignored. The correlation peak is refined to
+    subpixel precision by a parabolic fit. The spectra are not cached, the padded
+    spectra of the full correlation are too large to be worth keeping.
+
+    """
+    if im0.shape != im1.shape:
+        raise ValueError("Images must have same shapes.")
+    mask0 = numpy.asarray(mask0, dtype=bool)
+    mask1 = numpy.asarray(mask1, dtype=bool)
+    # im1 is correlated with the flipped im0 (full correlation)
+    fixed = numpy.where(mask1, im1, 0).astype(numpy.float64)
+    rot = numpy.where(mask0, im0, 0).astype(numpy.float64)[::-1, ::-1]
+    rot_mask = mask0[::-1, ::-1].astype(numpy.float64)
+    full = tuple(n0 + n1 - 1 for n0, n1 in zip(im1.shape, im0.shape))
+    s = fast_shape(full)
+    crop = (slice(0, full[0]), slice(0, full[1]))
+
+    fixed_fft = fft2(fixed, s)
+    fixed_mask_fft = fft2(mask1.astype(numpy.float64), s)
+    rot_fft = fft2(rot, s)
+    rot_mask_fft = fft2(rot_mask, s)
+
+    overlap = numpy.round(ifft2(rot_mask_fft * fixed_mask_fft).real[crop])
+    overlap = numpy.maximum(overlap, numpy.finfo(numpy.float64).eps)
+    corr_fixed = ifft2(rot_mask_fft * fixed_fft).real[crop]
+    corr_rot = ifft2(fixed_mask_fft * rot_fft).real[crop]
+    numerator = ifft2(rot_fft * fixed_fft).real[crop]
+    numerator -= corr_fixed * corr_rot / overlap
+
+    fixed_denom = ifft2(rot_mask_fft * fft2(fixed * fixed, s)).real[crop]
+    fixed_denom -= corr_fixed ** 2 / overlap
+    rot_denom = ifft2(fixed_mask_fft * fft2(rot * rot, s)).real[crop]
+    rot_denom -= corr_rot ** 2 / overlap
+    denom = numpy.sqrt(numpy.maximum(fixed_denom, 0) *
+                       numpy.maximum(rot_denom, 0))
+
+    xcorr = numpy.zeros(full)
+    valid = denom > 1e3 * numpy.finfo(numpy.float64).eps * denom.max()
+    xcorr[valid] = numerator[valid] / denom[valid]
+    xcorr[overlap < overlap_ratio * overlap.max()] = 0
+
+    peak = numpy.unravel_index(numpy.argmax(xcorr), xcorr.shape)
+    offset = _parabolic_offset(xcorr, peak)
+    return [im0.shape[0] - 1 - peak[0] - offset[0],
+            im0.shape[1] - 1 - peak[1] - offset[1]]
+
+
+def _parabolic_offset(c, peak):
+    """Return the subpixel offset of the maximum of c around the integer
+    peak, from a parabola through the peak and its neighbours along each
+    axis (0 at the border or where the neighbours are not lower)."""
+    offset = [0.0, 0.0]
+    for axis in range(2):
+        if not 0 < peak[axis] < c.shape[axis] - 1:
+            continue
+        index = list(peak)
+        index[axis] -= 1
+        a = c[tuple(index)]
+        index[axis] += 2
+        b = c[tuple(index)]
+        denom = a - 2 * c[peak] + b
+        if denom < 0:
+            offset[axis] = float(numpy.clip(0.5 * (a - b) / denom,
+                                            -0.5, 0.5))
+    return offset
+
+
+def scale_angle(im0, im1):
+    """Return scale factor and rotation angle (in degrees) to register images.
+
+    im1 is im0 scaled by the scale factor and rotated by the angle, from the
+    column axis towards the row axis, about the image center. The angle is
+    found modulo 180 degrees. im0 is the reference image, its spectra are
+    cached (see reference_logpolar). Image shapes must be equal and square.
 
     """
     if im0.shape != im1.shape:
@@ -132,19 +419,13 @@ def similarity(im0, im1):
     elif len(im0.shape) != 2:
         raise ValueError("Images must be 2 dimensional.")
 
-    f0 = fftshift(abs(fft2(im0)))
-    f1 = fftshift(abs(fft2(im1)))
+    s = fast_shape(im0.shape)
+    f0, log_base = reference_logpolar(im0, s)
+    f1, log_base = _logpolar_spectrum(fft2(im1, s))
+    return _scale_angle(f0, f1, log_base)
 
-    h = highpass(f0.shape)
-    f0 *= h
-    f1 *= h
-    del h
 
-    f0, log_base = logpolar(f0)
-    f1, log_base = logpolar(f1)
-
-    f0 = fft2(f0)
-    f1 = fft2(f1)
+def _scale_angle(f0, f1, log_base):
     r0 = abs(f0) * abs(f1)
     ir = abs(ifft2((f0 * f1.conjugate()) / r0))
     i0, i1 = numpy.unravel_index(numpy.argmax(ir), ir.shape)
@@ -163,6 +444,36 @@ def similarity(im0, im1):
         angle += 180.0
     elif angle > 90.0:
         angle -= 180.0
+    return scale, angle
+
+
+def similarity(im0, im1):
+    """Return similarity transformed image im1 and transformation parameters.
+
+    Transformation parameters are: isotropic scale factor, rotation angle (in
+    degrees), and translation vector.
+
+    A similarity transformation is an affine transformation with isotropic
+    scale and without shear.
+
+    Limitations:
+    Image shapes must be equal and square.
+    All image areas must have same scale, rotation, and shift.
+    Scale change must be less than 1.8.
+    Subpixel precision for the translation only (see subpixel_upsample).
+
+    """
+    if im0.shape != im1.shape:
+        raise ValueError("Images must have same shapes.")
+    elif len(im0.shape) != 2:
+        raise ValueError("Images must be 2 dimensional.")
+
+    s = fast_shape(im0.shape)
+    # the spectra of the reference are computed once, and reused below
+    F0 = reference_spectrum(im0, s)
+    f0, log_base = reference_logpolar(im0, s)
+    f1, log_base = _logpolar_spectrum(fft2(im1, s))
+    scale, angle = _scale_angle(f0, f1, log_base)
 
     im2 = ndii.zoom(im1, 1.0/scale)
     im2 = ndii.rotate(im2, angle)
@@ -174,15 +485,8 @@ def similarity(im0, im1):
     elif im2.shape > im0.shape:
         im2 = im2[:im0.shape[0], :im0.shape[1]]
 
-    f0 = fft2(im0)
-    f1 = fft2(im2)
-    ir = abs(ifft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1))))
-    t0, t1 = numpy.unravel_index(numpy.argmax(ir), ir.shape)
-
-    if t0 > f0.shape[0] // 2:
-        t0 -= f0.shape[0]
-    if t1 > f0.shape[1] // 2:
-        t1 -= f0.shape[1]
+    f1 = fft2(im2, s)
+    t0, t1 = _phase_correlation(F0, f1)
 
     im2 = ndii.shift(im2, [t0, t1])
 
@@ -219,14 +523,11 @@ def similarity_matrix(scale, angle, vector):
     return numpy.dot(T, numpy.dot(R, S))
 
 
-def logpolar(image, angles=None, radii=None):
-    """Return log-polar transformed image and log base."""
-    shape = image.shape
+@functools.lru_cache(maxsize=16)
+def _logpolar_coords(shape, angles, radii):
+    """Return read-only float32 sampling coordinates and log base of the
+    log-polar transform, cached by shape."""
     center = shape[0] / 2, shape[1] / 2
-    if angles is None:
-        angles = shape[0]
-    if radii is None:
-        radii = shape[1]
     theta = numpy.empty((angles, radii), dtype=numpy.float64)
     theta.T[:] = -numpy.linspace(0, numpy.pi, angles, endpoint=False)
     #d = radii
@@ -235,19 +536,43 @@ def logpolar(image, angles=None, radii=None):
     radius = numpy.empty_like(theta)
     radius[:] = numpy.power(log_base, numpy.arange(radii,
                                                    dtype=numpy.float64)) - 1.0
-    x = radius * numpy.sin(theta) + center[0]
-    y = radius * numpy.cos(theta) + center[1]
-    output = numpy.empty_like(x)
-    ndii.map_coordinates(image, [x, y], output=output)
+    coords = numpy.empty((2, angles, radii), dtype=numpy.float32)
+    coords[0] = radius * numpy.sin(theta) + center[0]
+    coords[1] = radius * numpy.cos(theta) + center[1]
+    coords.flags.writeable = False
+    return coords, log_base
+
+
+def logpolar(image, angles=None, radii=None):
+    """Return log-polar transformed image and log base."""
+    shape = image.shape
+    if angles is None:
+        angles = shape[0]
+    if radii is None:
+        radii = shape[1]
+    coords, log_base = _logpolar_coords(tuple(shape), angles, radii)
+    output = numpy.empty(coords.shape[1:], dtype=numpy.float64)
+    ndii.map_coordinates(image, coords, output=output)
     return output, log_base
 
 
-def highpass(shape):
-    """Return highpass filter to be multiplied with fourier transform."""
+@functools.lru_cache(maxsize=16)
+def _highpass(shape):
     x = numpy.outer(
         numpy.cos(numpy.linspace(-math.pi/2., math.pi/2., shape[0])),
         numpy.cos(numpy.linspace(-math.pi/2., math.pi/2., shape[1])))
-    return (1.0 - x) * (2.0 - x)
+    h = (1.0 - x) * (2.0 - x)
+    h.flags.writeable = False
+    return h
+
+
+def highpass(shape):
+    """Return highpass filter to be multiplied with fourier transform.
+
+    The filter is cached by shape and read-only.
+
+    """
+    return _highpass(tuple(shape))
 
 
 def imread(fname, norm=True):
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# // background jobs with cooperative cancellation, used by the registration and particle tracking tools
+import threading
+from concurrent.futures import CancelledError
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal as Signal
+
+
+class CancelToken(object):
+    """
+    Handed to a job as first argument. The job calls check() between its steps (pyramid levels, tiles, ...) and
+    reports its progress with progress(); a cancelled job stops at its next check, threads are never killed.
+    is_set has the signature of threading.Event.is_set, so a token can be passed as the cancel_event of the
+    registration functions.
+    """
+
+    def __init__(self, progress=None, status=None):
+        """
+        :param progress: function called with the progress (0-100)
+        :param status: function called with a status message
+        """
+        self._event = threading.Event()
+        self._progress = progress
+        self._status = status
+
+    def cancel(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    is_cancelled = is_set
+
+    def check(self):
+        """
+        :raise CancelledError: if the token is cancelled
+        """
+        if self._event.is_set():
+            raise CancelledError()
+
+    def progress(self, fraction):
+        """
+        :param fraction: progress of the job, between 0 and 1
+        """
+        if self._progress is not None and not self._event.is_set():
+            self._progress(min(max(fraction, 0.0), 1.0) * 100)
+
+    def status(self, message):
+        if self._status is not None and not self._event.is_set():
+            self._status(message)
+
+
+class JobRunner(QtCore.QObject):
+    """
+    Runs jobs one at a time in a worker thread. A job is a function called as func(token, *args, **kwargs), its
+    return value is sent with sig_finished. Submitting a job cancels the running one and supersedes the job still
+    waiting in the queue, so only the latest request is computed; the results, progress and messages of superseded
+    jobs are dropped.
+    """
+    sig_progress = Signal(float)
+    sig_status = Signal(str)
+    sig_finished = Signal(object)
+    # // internal signals, tagged with the job id so that the signals of superseded jobs still queued are dropped
+    _sig_progress = Signal(int, float)
+    _sig_status = Signal(int, str)
+    _sig_finished = Signal(int, object)
+
+    def __init__(self, parent=None):
+        super(JobRunner, self).__init__(parent)
+        self._cond = threading.Condition()
+        self._pending = None
+        self._token = None
+        self._thread = None
+        self._job = 0
+        self._sig_progress.connect(self._on_progress)
+        self._sig_status.connect(self._on_status)
+        self._sig_finished.connect(self._on_finished)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a job, the running job is cancelled and a job still waiting is dropped.
+        :param func: function called as func(token, *args, **kwargs) in the worker thread
+        :return: the CancelToken of the job
+        """
+        with self._cond:
+            self._job += 1
+            job = self._job
+            self._cancel_locked()
+            token = CancelToken(progress=lambda v: self._sig_progress.emit(job, v),
+                                status=lambda m: self._sig_status.emit(job, m))
+            self._pending = (job, token, func, args, kwargs)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return token
+
+    def cancel(self):
+        """
+        Cancels the running job and the job waiting in the queue.
+        :return:
+        """
+        with self._cond:
+            running = self._token is not None or self._pending is not None
+            self._cancel_locked()
+            self._pending = None
+        if running:
+            self.sig_progress.emit(100)
+
+    def _cancel_locked(self):
+        if self._token is not None:
+            self._token.cancel()
+        if self._pending is not None:
+            self._pending[1].cancel()
+
+    def is_running(self):
+        with self._cond:
+            return self._token is not None or self._pending is not None
+
+    def _on_progress(self, job, value):
+        if job == self._job:
+            self.sig_progress.emit(value)
+
+    def _on_status(self, job, message):
+        if job == self._job:
+            self.sig_status.emit(message)
+
+    def _on_finished(self, job, result):
+        if job == self._job:
+            self.sig_finished.emit(result)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                job, token, func, args, kwargs = self._pending
+                self._pending = None
+                self._token = token
+            try:
+                result = func(token, *args, **kwargs)
+                if not token.is_set():
+                    self._sig_progress.emit(job, 100)
+                    self._sig_finished.emit(job, result)
+            except CancelledError:
+                pass
+            except Exception as e:
+                self._sig_status.emit(job, 'Job failed: {}'.format(e))
+                self._sig_progress.emit(job, 100)
+            finally:
+                with self._cond:
+                    self._token = None
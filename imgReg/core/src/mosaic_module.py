@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# // global alignment of a mosaic: pairwise registration of the overlapping images, then one least squares solve
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+import cv2
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import lsqr
+
+from batch_registration_module import ReferenceCanvas, load_source
+from job_runner_module import JobRunner
+from spatial_registration_module import image_pose_matrix, pose_to_outline
+
+
+def image_bounds(d, pixel_size):
+    """
+    :return: (x0, x1, y0, y1) bounding box of the image in the field coordinates, the rotation is taken into account
+    """
+    w, h = pixel_size
+    corners = image_pose_matrix(d, pixel_size).dot([[0, w, w, 0], [0, 0, h, h], [1, 1, 1, 1]])
+    return corners[0].min(), corners[0].max(), corners[1].min(), corners[1].max()
+
+
+def overlapping_pairs(bounds, min_overlap=0.05):
+    """
+    Lists the pairs of overlapping bounding boxes. The boxes are hashed on a grid of the median box size, so only
+    boxes sharing a grid cell are compared.
+
+    :param bounds: list of (x0, x1, y0, y1) boxes
+    :param min_overlap: minimum area of the intersection, as a fraction of the smaller box
+    :return: list of (i, j, (x0, x1, y0, y1)) tuples with i < j and the intersection box
+    """
+    if len(bounds) < 2:
+        return []
+    b = np.asarray(bounds, dtype=np.float64)
+    cell = max(np.median(b[:, 1] - b[:, 0]), np.median(b[:, 3] - b[:, 2]), 1e-12)
+    grid = defaultdict(list)
+    for k, (x0, x1, y0, y1) in enumerate(b):
+        for gx in range(int(np.floor(x0 / cell)), int(np.floor(x1 / cell)) + 1):
+            for gy in range(int(np.floor(y0 / cell)), int(np.floor(y1 / cell)) + 1):
+                grid[gx, gy].append(k)
+    candidates = set()
+    for members in grid.values():
+        for n, i in enumerate(members):
+            for j in members[n + 1:]:
+                candidates.add((min(i, j), max(i, j)))
+    pairs = []
+    for i, j in sorted(candidates):
+        x0, x1 = max(b[i, 0], b[j, 0]), min(b[i, 1], b[j, 1])
+        y0, y1 = max(b[i, 2], b[j, 2]), min(b[i, 3], b[j, 3])
+        if x1 <= x0 or y1 <= y0:
+            continue
+        area = min((b[i, 1] - b[i, 0]) * (b[i, 3] - b[i, 2]), (b[j, 1] - b[j, 0]) * (b[j, 3] - b[j, 2]))
+        if (x1 - x0) * (y1 - y0) >= min_overlap * area:
+            pairs.append((i, j, (x0, x1, y0, y1)))
+    return pairs
+
+
+def register_pairs(items, pairs, canvas_size=512, max_workers=None, progress=None, cancel_event=None):
+    """
+    Registers the overlapping pairs in a pool of threads. The pairs are grouped by their first image, so the
+    reference canvas (and its spectra) of an image is computed once. The pixels are read in the workers (see
+    batch_registration_module.load_source) and released once the image is registered, only the reduced reference
+    canvases are kept while their group is registered.
+
+    :param items: list of (image dictionary, grayscale array or function returning it, (width, height)) tuples
+    :param pairs: list of (i, j, box) tuples, see overlapping_pairs
+    :param canvas_size: size of the registration canvas, see ReferenceCanvas
+    :param max_workers: number of threads, defaults to the number of cpus
+    :param progress: optional function called with the progress (0-100)
+    :param cancel_event: optional threading.Event (or CancelToken), the remaining pairs are skipped once it is set
+    :return: (measurements, failures) tuple. measurements is the list of (i, j, box, correction, success) tuples of
+             the registered pairs, correction is the 3x3 matrix moving image j onto image i in the field coordinates.
+             failures is the list of (i, j, error) tuples of the pairs which could not be registered
+    """
+    groups = defaultdict(list)
+    for i, j, box in pairs:
+        groups[i].append((j, box))
+    done = [0]
+    lock = threading.Lock()
+
+    def worker(i):
+        results = []
+        failures = []
+        if cancel_event is not None and cancel_event.is_set():
+            return results, failures
+        try:
+            reference = ReferenceCanvas(load_source(items[i][1]), items[i][0], canvas_size)
+            reference_error = None
+        except (OSError, ValueError, cv2.error) as e:
+            reference = None
+            reference_error = 'reference {}: {}'.format(items[i][0].get('Name', items[i][0]['Path']), e)
+        for j, box in groups[i]:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if reference is None:
+                failures.append((i, j, reference_error))
+            else:
+                try:
+                    correction, vector_dict = reference.register(load_source(items[j][1]), items[j][0])
+                    results.append((i, j, box, correction, vector_dict['success']))
+                except (OSError, ValueError, cv2.error) as e:
+                    failures.append((i, j, str(e)))
+            with lock:
+                done[0] += 1
+                if progress is not None:
+                    progress(done[0] / float(len(pairs)) * 100)
+        return results, failures
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 4) as executor:
+        futures = [executor.submit(worker, i) for i in groups]
+        done_groups = [f.result() for f in futures]
+    return [r for results, failures in done_groups for r in results], \
+           [r for results, failures in done_groups for r in failures]
+
+
+def solve_poses(n, measurements, anchor=0, prior_weight=1e-3, anchor_weight=1e3):
+    """
+    Solves the similarity corrections of all images at once. The correction of image k is the matrix
+    [[p, -q, tx], [q, p, ty]], which is linear in its parameters. Every pair measurement asks that the points of the
+    overlap moved by the pairwise correction land at the same place with the corrections of both images:
+    G_j x = G_i C_ij x. The sparse linear system is solved with lsqr, the anchor image is held in place and a weak
+    prior keeps the images without measurements where they are.
+
+    :param n: number of images
+    :param measurements: list of (i, j, box, correction, weight) tuples, see register_pairs
+    :param anchor: index of the image which is not moved
+    :param prior_weight: weight of the prior towards no correction
+    :param anchor_weight: weight of the anchor
+    :return: (corrections, residuals) tuple, list of n 3x3 matrices in the field coordinates and the rms residual
+             of each measurement (in field units)
+    """
+    # // normalized coordinates, for the conditioning of the system
+    boxes = np.array([m[2] for m in measurements], dtype=np.float64).reshape(-1, 4)
+    if len(boxes):
+        c = np.array([boxes[:, 0:2].mean(), boxes[:, 2:4].mean()])
+        s = max(np.abs(boxes[:, 0:2] - c[0]).max(), np.abs(boxes[:, 2:4] - c[1]).max(), 1e-12)
+    else:
+        c, s = np.zeros(2), 1.0
+    to_norm = np.array([[1 / s, 0, -c[0] / s], [0, 1 / s, -c[1] / s], [0, 0, 1]])
+    from_norm = np.linalg.inv(to_norm)
+
+    rows, cols, vals, rhs = [], [], [], []
+
+    def add(entries, value):
+        r = len(rhs)
+        for col, v in entries:
+            rows.append(r)
+            cols.append(col)
+            vals.append(v)
+        rhs.append(value)
+
+    samples = []
+    for i, j, (x0, x1, y0, y1), correction, weight in measurements:
+        w = np.sqrt(max(weight, 1e-3))
+        pts = np.array([[x0, x1, x1, x0, (x0 + x1) / 2.0], [y0, y0, y1, y1, (y0 + y1) / 2.0], [1, 1, 1, 1, 1]])
+        xs = to_norm.dot(pts)
+        ys = to_norm.dot(correction.dot(pts))
+        samples.append((i, j, xs, ys))
+        for (x, y, _), (u, v, _) in zip(xs.T, ys.T):
+            # // p_j x - q_j y + tx_j - (p_i u - q_i v + tx_i) = 0
+            add([(4 * j, w * x), (4 * j + 1, -w * y), (4 * j + 2, w), (4 * i, -w * u), (4 * i + 1, w * v),
+                 (4 * i + 2, -w)], 0.0)
+            # // q_j x + p_j y + ty_j - (q_i u + p_i v + ty_i) = 0
+            add([(4 * j + 1, w * x), (4 * j, w * y), (4 * j + 3, w), (4 * i + 1, -w * u), (4 * i, -w * v),
+                 (4 * i + 3, -w)], 0.0)
+    for k in range(n):
+        wk = anchor_weight if k == anchor else prior_weight
+        for p, value in enumerate((1.0, 0.0, 0.0, 0.0)):
+            add([(4 * k + p, wk)], wk * value)
+    a = coo_matrix((vals, (rows, cols)), shape=(len(rhs), 4 * n)).tocsr()
+    x = lsqr(a, np.asarray(rhs), atol=1e-12, btol=1e-12)[0]
+
+    corrections = []
+    for k in range(n):
+        p, q, tx, ty = x[4 * k:4 * k + 4]
+        g = np.array([[p, -q, tx], [q, p, ty], [0.0, 0.0, 1.0]])
+        corrections.append(from_norm.dot(g).dot(to_norm))
+    residuals = []
+    for i, j, xs, ys in samples:
+        gi = to_norm.dot(corrections[i]).dot(from_norm)
+        gj = to_norm.dot(corrections[j]).dot(from_norm)
+        residuals.append(np.sqrt(np.mean(np.sum((gj.dot(xs) - gi.dot(ys))[0:2] ** 2, axis=0))) * s)
+    return corrections, np.array(residuals)
+
+
+def align_mosaic(items, anchor=0, canvas_size=512, min_overlap=0.05, max_workers=None, outlier_factor=3.0,
+                 progress=None, cancel_event=None):
+    """
+    Global alignment of overlapping images: the overlapping pairs are found on a grid index, registered in
+    parallel, and the poses of all images are solved at once (see solve_poses). The pairs whose residual is larger
+    than outlier_factor times the median residual are dropped and the poses solved again.
+
+    :param items: list of (image dictionary, grayscale array or function returning it, (width, height)) tuples, the
+                  size is the one of the full resolution pixels, the images are only read when registered
+    :param anchor: index of the image which is not moved
+    :param canvas_size: size of the registration canvas of the pairs
+    :param min_overlap: minimum overlap of a pair, as a fraction of the smaller image
+    :param max_workers: number of threads
+    :param progress: optional function called with the progress (0-100)
+    :param cancel_event: optional threading.Event (or CancelToken)
+    :return: list of (d, new_d, error) tuples in the order of items (see register_batch). new_d is None for the
+             images which are not connected to the anchor by registered pairs. error lists the pairs of the image
+             which could not be registered, it is also set for an aligned image whose other pairs were registered
+    """
+    pairs = overlapping_pairs([image_bounds(d, size) for d, source, size in items], min_overlap)
+    measurements, failures = register_pairs(items, pairs, canvas_size, max_workers,
+                                            progress=(lambda v: progress(v * 0.9)) if progress else None,
+                                            cancel_event=cancel_event)
+    if cancel_event is not None and cancel_event.is_set():
+        raise CancelledError()
+    corrections, residuals = solve_poses(len(items), measurements, anchor)
+    if len(residuals) > 2 and outlier_factor:
+        keep = residuals <= outlier_factor * max(np.median(residuals), 1e-12)
+        if not keep.all():
+            measurements = [m for m, k in zip(measurements, keep) if k]
+            corrections, residuals = solve_poses(len(items), measurements, anchor)
+    connected = {anchor} | {m[0] for m in measurements} | {m[1] for m in measurements}
+    names = [d.get('Name', d['Path']) for d, source, size in items]
+    errors = defaultdict(list)
+    for i, j, error in failures:
+        errors[i].append('pair with {}: {}'.format(names[j], error))
+        errors[j].append('pair with {}: {}'.format(names[i], error))
+    results = []
+    for k, (d, source, size) in enumerate(items):
+        error = '; '.join(errors[k]) or None
+        if k not in connected:
+            results.append((d, None, error or 'no overlapping image registered'))
+            continue
+        new_d = pose_to_outline(dict(d), corrections[k].dot(image_pose_matrix(d, size)), size)
+        results.append((d, new_d, error))
+    if progress:
+        progress(100)
+    return results
+
+
+class MosaicAlignment(JobRunner):
+    """
+    Runs align_mosaic in a worker thread (see job_runner_module), the results are sent with sig_finished.
+    """
+
+    def __init__(self, canvas_size=512, max_workers=None, parent=None):
+        super(MosaicAlignment, self).__init__(parent)
+        self.canvas_size = canvas_size
+        self.max_workers = max_workers
+
+    def start(self, items, anchor=0):
+        """
+        :param items: list of (image dictionary, grayscale array or function returning it, (width, height)) tuples,
+                      see align_mosaic
+        :param anchor: index of the image which is not moved
+        :return: the CancelToken of the alignment
+        """
+        return self.submit(self._align, items, anchor, self.canvas_size, self.max_workers)
+
+    @staticmethod
+    def _align(token, items, anchor, canvas_size, max_workers):
+        token.status('Aligning {} images..'.format(len(items)))
+        return align_mosaic(items, anchor, canvas_size, max_workers=max_workers,
+                            progress=lambda v: token.progress(v / 100.0), cancel_event=token)
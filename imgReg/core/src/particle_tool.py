@@ -8,16 +8,16 @@ from spatial_registration_module import rotatePoint
 import pyqtgraph as pg
 import numpy as np
 import math
-from util import qt_image_to_array, PandasModel
+from util import PandasModel
 import pandas as pd
 import copy
-from spatial_registration_module import rotatePoint
-import time
-
-class TrackParticle(QtCore.QObject):
+from job_runner_module import JobRunner
 
-    sig_status_update = QtCore.pyqtSignal(str)
-    sig_particle_info_update = QtCore.pyqtSignal(object)
+class TrackParticle(JobRunner):
+    """
+    Particle tracking (trackpy) in a worker thread (see job_runner_module). A new request supersedes the tracking
+    still running, its result is dropped.
+    """
 
     def __init__(self, parent, get_img_array_func, get_kwargs_func, get_method_str_func):
         super().__init__()
@@ -27,28 +27,35 @@ class TrackParticle(QtCore.QObject):
         self.get_method_str_func = get_method_str_func
 
     def prepare_tracking(self, img_buffer, call_back):
-        self.np_array_gray = self.get_img_array_func(img_buffer.pixmap.toImage())
+        self.np_array_gray = self.get_img_array_func(img_buffer)
         self.kwargs = self.get_kwargs_func()
         self.method_str = self.get_method_str_func()
         self.call_back = call_back
-        self.sig_status_update.emit('Done with preparation for particle tracking!')
+        self.sig_status.emit('Done with preparation for particle tracking!')
         # self.parent.statusbar.showMessage('Done with preparation for particle tracking!')
 
-    def track_particle(self):
+    def start(self):
+        """
+        Tracks the particles of the prepared image, the particle table is sent with sig_finished
+        :return: the CancelToken of the tracking
+        """
+        return self.submit(self.track_particle, self.np_array_gray, self.kwargs, self.method_str)
+
+    @staticmethod
+    def track_particle(token, np_array_gray, kwargs, method_str):
         import trackpy as tp
-        self.sig_status_update.emit('Working on particle tracking now...It takes a while.')
-        if self.method_str == 'locate_brightfield_ring':
+        token.status('Working on particle tracking now...It takes a while.')
+        token.progress(0.1)
+        if method_str == 'locate_brightfield_ring':
             # this tracking algorithm is unstable
             # particle_info = tp.locate_brightfield_ring(np_array_gray, kwargs['diameter']).round(1)
-            particle_info = tp.locate(self.np_array_gray, **self.kwargs).round(1)
+            particle_info = tp.locate(np_array_gray, **kwargs).round(1)
         else:
-            particle_info = tp.locate(self.np_array_gray, **self.kwargs).round(1)
-        self.sig_status_update.emit('Sleep for 3 seconds')
-        time.sleep(3)
-        self.sig_status_update.emit('Particle tracking finished! Check results in the table viewer.')
-        # self.call_back(particle_info)
-        self.sig_particle_info_update.emit(particle_info)
-        # self.parent.init_pandas_model(particle_info)
+            particle_info = tp.locate(np_array_gray, **kwargs).round(1)
+        # // tp.locate can not be interrupted, a superseded result is dropped here
+        token.check()
+        token.status('Particle tracking finished! Check results in the table viewer.')
+        return particle_info
 
 
 class particle_widget_wrapper(object):
@@ -67,14 +74,12 @@ class particle_widget_wrapper(object):
         # // enable field view
         self.setEnabled(True)
         self.track_partikle_instance = TrackParticle(parent= self,
-                                                     get_img_array_func=qt_image_to_array,
+                                                     get_img_array_func=lambda img_buffer: img_buffer.gray_array(),
                                                      get_kwargs_func=self.extract_kwargs_for_locating_particle,
                                                      get_method_str_func=self.comboBox_locate_method.currentText)
-        self.thread_track_particle = QtCore.QThread()
-        self.track_partikle_instance.moveToThread(self.thread_track_particle)
-        self.thread_track_particle.started.connect(self.track_partikle_instance.track_particle)
-        self.track_partikle_instance.sig_status_update.connect(self.update_status)
-        self.track_partikle_instance.sig_particle_info_update.connect(self.update_particle_info)
+        self.track_partikle_instance.sig_status.connect(self.update_status)
+        self.track_partikle_instance.sig_progress.connect(self.progressUpdate_sig)
+        self.track_partikle_instance.sig_finished.connect(self.update_particle_info)
         #self.init_pandas_model()
 
     @QtCore.pyqtSlot(str)
@@ -129,13 +134,9 @@ class particle_widget_wrapper(object):
 
     def track_particle(self):
         self.track_partikle_instance.prepare_tracking(self.update_field_current, self.init_pandas_model)
-        try:
-            self.thread_track_particle.terminate()
-        except:
-            pass
-        self.thread_track_particle.start()
+        self.track_partikle_instance.start()
         '''
-        np_array_gray = qt_image_to_array(self.update_field_current.pixmap.toImage())
+        np_array_gray = self.update_field_current.gray_array()
         kwargs = self.extract_kwargs_for_locating_particle()
         method_str = self.comboBox_locate_method.currentText()
         if method_str == 'locate_brightfield_ring':
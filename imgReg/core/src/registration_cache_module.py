@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# // persistent cache of registration results, keyed by the content of the registered frames
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+default_cache_dir = os.path.join(tempfile.gettempdir(), 'imgReg_registration')
+
+
+def registration_key(*arrays, **params):
+    """
+    Key of a registration result: hash of the content, shape and type of the arrays (reference and target frames,
+    masks, ...) and of the registration parameters.
+
+    :param arrays: numpy arrays, None items are allowed
+    :param params: registration parameters, must be json serializable
+    :return: hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for a in arrays:
+        if a is None:
+            h.update(b'None')
+            continue
+        a = np.ascontiguousarray(a)
+        h.update('{}|{}'.format(a.shape, a.dtype.str).encode('utf-8'))
+        h.update(a.view(np.uint8).reshape(-1))
+    h.update(json.dumps(params, sort_keys=True, default=_to_json).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _to_json(v):
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(v)))
+
+
+class RegistrationCache(object):
+    """
+    Registration results (vector dictionaries) stored as small json files in a cache folder, so they survive a
+    restart. The number of entries is bounded, the least recently used entries are evicted (a hit refreshes the
+    modification time of the file). Arrays other than small vectors (e.g. the transformed image of imreg_dft) are not
+    stored.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=2000):
+        self.cache_dir = cache_dir or default_cache_dir
+        self.max_entries = max_entries
+        self.enabled = True
+        self._n_entries = None
+        self._lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """
+        :param key: see registration_key
+        :return: the cached vector dictionary, None if not cached
+        """
+        if not self.enabled:
+            return None
+        path = self._file(key)
+        try:
+            with open(path, 'r') as f:
+                d = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        for k in ('tvec', 'correction'):
+            if k in d:
+                d[k] = np.array(d[k], dtype=np.float64)
+        return d
+
+    def put(self, key, vector_dict):
+        """
+        Stores a vector dictionary, the large arrays are left out
+        :param key: see registration_key
+        :param vector_dict: registration result
+        :return:
+        """
+        if not self.enabled:
+            return
+        d = {k: v for k, v in vector_dict.items() if not (isinstance(v, np.ndarray) and v.size > 16)}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._file(key)
+        tmp = path + '.{}.tmp'.format(threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(d, f, default=_to_json)
+        with self._lock:
+            is_new = not os.path.exists(path)
+            os.replace(tmp, path)
+            if self._n_entries is None:
+                self._n_entries = len(self._entries())
+            elif is_new:
+                self._n_entries += 1
+            if self._n_entries > self.max_entries:
+                self._evict()
+
+    def _entries(self):
+        try:
+            return [e for e in os.scandir(self.cache_dir) if e.name.endswith('.json')]
+        except OSError:
+            return []
+
+    def _evict(self):
+        # // drop the oldest entries down to 90% of the limit, so that eviction does not run on every put
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        n_remove = len(entries) - int(self.max_entries * 0.9)
+        for e in entries[0:max(0, n_remove)]:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+        self._n_entries = len(entries) - max(0, n_remove)
+
+    def clear(self):
+        with self._lock:
+            for e in self._entries():
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+            self._n_entries = 0
+
+
+registration_cache = RegistrationCache()
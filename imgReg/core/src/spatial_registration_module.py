@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+from concurrent.futures import CancelledError
 
 
 import numpy as np
@@ -17,11 +18,169 @@ from PyQt5 import QtCore, QtGui
 import pyqtgraph as pg
 
 
+def _stack_slice(dset, k, z_axis, channel, channel_axis):
+	"""
+	2D reference image of slice k of a stack: the selected channel, or the sum of all channels if channel == (-1,)
+	"""
+	sl = [slice(None)] * dset.ndim
+	sl[z_axis] = k
+	if channel_axis is not None and channel_axis < dset.ndim:
+		if channel[0] == -1:
+			im = np.asarray(dset[tuple(sl)], dtype=np.float32).sum(axis=channel_axis - (channel_axis > z_axis))
+		else:
+			sl[channel_axis] = channel[0]
+			im = np.asarray(dset[tuple(sl)], dtype=np.float32)
+	else:
+		im = np.asarray(dset[tuple(sl)], dtype=np.float32)
+	return np.squeeze(im)
+
+
+def _pairwise_dft_worker(im0, im1, iterations, levels):
+	"""
+	Registers slice im1 onto slice im0, runs in a worker process of registration_dft_stack
+	:return: dictionary with scale, angle, tvec
+	"""
+	vector_dict = registration_dft_slice(im0, im1, iterations=iterations, display=False, levels=levels)
+	return {'scale': float(vector_dict['scale']), 'angle': float(vector_dict['angle']),
+			'tvec': [float(t) for t in vector_dict['tvec']]}
+
+
+def tdict_to_matrix(tdict, shape):
+	"""
+	Matrix of a transformation dictionary of imreg_dft (scale and angle about the image center, then tvec), mapping
+	the pixel coordinates (column, row) of the transformed image onto the reference image.
+
+	:param tdict: dictionary with scale, angle (degrees, counter-clockwise on screen) and tvec (row, column)
+	:param shape: image shape
+	:return: 3x3 array
+	"""
+	center = ((shape[1] - 1) / 2.0, (shape[0] - 1) / 2.0)
+	tvec = tdict.get('tvec', (0, 0))
+	return similarity_matrix_about(center, tdict.get('scale', 1.0), -tdict.get('angle', 0.0),
+								   tvec=(tvec[1], tvec[0]))
+
+
+def matrix_to_tdict(m, shape):
+	"""
+	Transformation dictionary of imreg_dft of a similarity matrix, inverse of tdict_to_matrix.
+
+	:param m: 2x3 or 3x3 similarity matrix, mapping the pixel coordinates (column, row) of the transformed image
+			  onto the reference image
+	:param shape: image shape
+	:return: dictionary with scale, angle (degrees, counter-clockwise on screen) and tvec (row, column)
+	"""
+	import math
+	m = np.asarray(m, dtype=np.float64)
+	a, b = m[0, 0], m[1, 0]
+	cx, cy = (shape[1] - 1) / 2.0, (shape[0] - 1) / 2.0
+	tx = m[0, 2] - (cx - a * cx + b * cy)
+	ty = m[1, 2] - (cy - b * cx - a * cy)
+	return {'scale': math.hypot(a, b), 'angle': -math.degrees(math.atan2(b, a)), 'tvec': np.array([ty, tx])}
+
+
+def recenter_tdict(tdict, offset):
+	"""
+	Converts a transformation dictionary found on a crop of a frame to the whole frame. The scale and angle are
+	about the crop center, the returned dictionary has them about the frame center.
+
+	:param tdict: dictionary with scale, angle and tvec (row, column)
+	:param offset: (x, y) offset of the crop center from the frame center, in pixels
+	:return: new dictionary
+	"""
+	a = similarity_matrix_about((0, 0), tdict.get('scale', 1.0), -tdict.get('angle', 0.0))[0:2, 0:2]
+	d = -np.asarray(offset, dtype=np.float64)
+	tx, ty = np.asarray([tdict['tvec'][1], tdict['tvec'][0]], dtype=np.float64) + (a - np.identity(2)).dot(d)
+	return dict(tdict, tvec=np.array([ty, tx]))
+
+
+def _warp_region(src, m_inv, x0, y0, w, h, flags, bgval):
+	"""
+	Warps the output region (x0, y0, w, h) from the part of src it maps from, m_inv maps output pixels to src pixels
+	"""
+	import cv2
+	# // bounding box of the region in the source, with a margin for the interpolation
+	corners = m_inv.dot(np.array([[x0, x0 + w, x0, x0 + w], [y0, y0, y0 + h, y0 + h], [1, 1, 1, 1]], dtype=np.float64))
+	sx0 = int(max(0, np.floor(corners[0].min()) - 2))
+	sy0 = int(max(0, np.floor(corners[1].min()) - 2))
+	sx1 = int(min(src.shape[1], np.ceil(corners[0].max()) + 3))
+	sy1 = int(min(src.shape[0], np.ceil(corners[1].max()) + 3))
+	if sx1 <= sx0 or sy1 <= sy0:
+		return None
+	a = np.array([[1.0, 0.0, -sx0], [0.0, 1.0, -sy0], [0.0, 0.0, 1.0]]).dot(m_inv).dot(
+		np.array([[1.0, 0.0, x0], [0.0, 1.0, y0], [0.0, 0.0, 1.0]]))
+	part = np.ascontiguousarray(src[sy0:sy1, sx0:sx1])
+	return cv2.warpAffine(part, a[0:2], (w, h), flags=flags | cv2.WARP_INVERSE_MAP,
+						  borderMode=cv2.BORDER_CONSTANT, borderValue=bgval)
+
+
+def warp_slice(image, m, out=None, bgval=0, order=1, tile_size=4096):
+	"""
+	Warps a 2D image (optionally with channels last) with a 3x3 matrix mapping the image pixels onto the output
+	pixels, in one interpolation pass. Large images are processed tile by tile, each tile only reads the part of the
+	source it maps from, so memory mapped images can be warped with a bounded amount of memory.
+
+	:param image: 2D or 3D array
+	:param m: 3x3 matrix
+	:param out: optional preallocated output array of the same shape (may be a memory map)
+	:param bgval: value of the pixels mapped from outside of the image
+	:param order: interpolation order, 0 (nearest), 1 (linear) or 3 (cubic)
+	:param tile_size: size of the output tiles
+	:return: warped array
+	"""
+	import cv2
+	flags = {0: cv2.INTER_NEAREST, 1: cv2.INTER_LINEAR, 3: cv2.INTER_CUBIC}[order]
+	h, w = image.shape[0:2]
+	src = image
+	if src.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+		src = np.asarray(src, dtype=np.float32)
+	if src.ndim > 3:
+		src = src.reshape(h, w, -1)
+	n_channels = src.shape[2] if src.ndim > 2 else 1
+	if out is None:
+		out = np.empty(image.shape, dtype=image.dtype)
+	# // more than one channel axis: work on a (h, w, channels) buffer, copied to out at the end
+	res = out if out.ndim <= 3 else np.empty((h, w, n_channels), dtype=out.dtype)
+	m_inv = np.linalg.inv(np.asarray(m, dtype=np.float64))
+	for y0 in range(0, h, tile_size):
+		for x0 in range(0, w, tile_size):
+			th, tw = min(tile_size, h - y0), min(tile_size, w - x0)
+			# // cv2 warps up to 4 channels at once
+			for c in range(0, n_channels, 4):
+				part = src[:, :, c:c + 4] if src.ndim > 2 else src
+				tile = _warp_region(part, m_inv, x0, y0, tw, th, flags, bgval)
+				if src.ndim > 2:
+					dst = res[y0:y0 + th, x0:x0 + tw, c:c + 4]
+					dst[...] = bgval if tile is None else tile.reshape(dst.shape)
+				else:
+					res[y0:y0 + th, x0:x0 + tw] = bgval if tile is None else tile
+	if res is not out:
+		out[...] = res.reshape(out.shape)
+	return out
+
+
+def _writable_copy(dset, chunk_size=16):
+	"""
+	Writable copy of a read-only stack. A memory map is copied into a temporary memory map, chunk by chunk along the
+	first axis, so the stack is never held in RAM as a whole.
+	"""
+	if not isinstance(dset, np.memmap):
+		return np.array(dset)
+	import tempfile
+	out = np.memmap(tempfile.TemporaryFile(), dtype=dset.dtype, mode='w+', shape=dset.shape)
+	for k in range(0, dset.shape[0], chunk_size):
+		out[k:k + chunk_size] = dset[k:k + chunk_size]
+	return out
+
+
 def registration_dft_stack(dset, z_axis=(2,),channel=(0,), channel_axis=(3,), scale=[1,0], angle=[0,0], tx=[0,0], ty=[0,0], \
-	iterations=100, display=True, quiet=False, simulation=False, progressbar='', display_window=''):
+	iterations=100, display=True, quiet=False, simulation=False, progressbar='', display_window='', max_workers=None,
+	levels=1, chunk_size=16, progress=None, cancel_event=None, return_transforms=False):
 	'''
 	Image registration of all slices in a zstack (3-4D) using a dft model. Imreg_dft is based on the code by Christoph Gohlke.
 
+	The transforms between neighbouring slices are computed in a pool of processes, then accumulated into one
+	transform per slice relative to the middle slice, and finally applied to all channels, chunk by chunk of slices.
+
 	Parameters
 	---------- 
 	z_axis: tuple int, optional
@@ -29,108 +188,192 @@ def registration_dft_stack(dset, z_axis=(2,),channel=(0,), channel_axis=(3,), sc
 	channel: tuple of ints, optional
 		contains the indices of the channels in the channel_axis to use as a reference. If 
 		channel == (-1), the integrated channels are used.
-	mode: string, optional
-		determines what operations are allowed during registration:
-		1) translation
-		2) rotation
-		3) scaling
-		4) rigid: translation+rotation
-		5) all: translation+rotation+scaling
+	channel_axis: tuple int, optional
+		appoints the channel axis of the array, None for stacks without channels
 	iterations: int, ioptional
 		number of iterations in the dft algorithm (more == better registration, at a higher computational cost)
 	display: boolean, optional
-		enables user supervision through display
+		enables user supervision through display (the projection of the registered stack)
 	quiet: boolean, optional
 		enable additional info on stdout
 	simulation: boolean, optional
-		only produces a registration on selected channels. Does not actually change the data
+		only computes the registration. Does not actually change the data
 	progressbar: variable (optional)
 		this is a variable that can be linked to a progressbar
 	display_window: pyqtgraph.imageview window
 		window to connect in order to display images; works in conjunction with the display boolean
+	max_workers: int, optional
+		number of worker processes, defaults to the number of cpus
+	levels: int, optional
+		number of pyramid levels of each pairwise registration (see registration_dft_slice)
+	chunk_size: int, optional
+		number of slices transformed at once
+	progress: function, optional
+		called with the progress (0-100)
+	cancel_event: threading.Event, optional
+		the registration stops as soon as possible once it is set. When set before the transforms are applied the
+		stack is returned unchanged, otherwise only the chunks already done are transformed
+	return_transforms: boolean, optional
+		also return the 3x3 matrices mapping each slice onto the middle slice
 	Returns
 	-------
-		returns the registred stack (all channels have been registred)
+		returns the registred stack (all channels have been registred), and the list of matrices if
+		return_transforms is set. The stack is transformed in place, a read-only stack (e.g. a memory mapped tiff)
+		is copied first (see _writable_copy) and the copy is returned
 
 	Notes
 	-----
-	none
+	Slices are registered to their neighbour towards the middle slice, which is the reference.
 
 	Examples
 	--------
 	>>> 
 
 	'''
-	# select the middle slice as a reference
-	rank=len(dset.shape)
+	from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 	if isinstance(z_axis, tuple):
 		z_axis=z_axis[0]
-	if not isinstance(channel_axis, tuple):
-		channel_axis=(channel_axis)
-		
-	_z = dset.shape[z_axis]//2
+	if isinstance(channel_axis, tuple):
+		channel_axis=channel_axis[0]
+	if not isinstance(channel, tuple):
+		channel=(channel,)
+
+	def report(value):
+		if progress:
+			progress(value)
+		if progressbar:
+			progressbar.setValue(int(value))
+
+	def cancelled():
+		return cancel_event is not None and cancel_event.is_set()
+
+	n = dset.shape[z_axis]
+	_z = n//2
 	if not quiet:
 		QtCore.qDebug('Reference slice {} selected'.format(_z))
-	
+
+	# // pairs (reference, moving), always towards the middle slice
+	pairs = [(k, k-1) for k in range(_z, 0, -1)] + [(k, k+1) for k in range(_z, n-1)]
+	pairwise = {}
+	workers = max_workers or os.cpu_count() or 4
+	executor = ProcessPoolExecutor(max_workers=workers)
+	try:
+		# // only a window of pairs is in flight, so the slices are not all copied to the workers at once
+		todo = list(pairs)
+		running = {}
+		while todo or running:
+			while todo and len(running) < 2 * workers:
+				k0, k1 = todo.pop(0)
+				running[executor.submit(_pairwise_dft_worker, _stack_slice(dset, k0, z_axis, channel, channel_axis),
+										_stack_slice(dset, k1, z_axis, channel, channel_axis), iterations,
+										levels)] = (k0, k1)
+			future = next(as_completed(running))
+			pairwise[running.pop(future)] = future.result()
+			if cancelled():
+				for f in running:
+					f.cancel()
+				break
+			report(len(pairwise) / max(1, len(pairs)) * 80)
+	finally:
+		# // on cancel, do not wait for the pairs still running in the workers
+		executor.shutdown(wait=not cancelled())
+	if cancelled():
+		return (dset, None) if return_transforms else dset
+
+	# // accumulate the transforms towards the middle slice
+	shape = _stack_slice(dset, _z, z_axis, channel, channel_axis).shape
+	transforms = [None] * n
+	transforms[_z] = np.identity(3)
+	for k0, k1 in pairs:
+		transforms[k1] = transforms[k0].dot(tdict_to_matrix(pairwise[(k0, k1)], shape))
+
+	if not simulation:
+		if not dset.flags.writeable:
+			# // e.g. the read-only memory map of load_tiff
+			dset = _writable_copy(dset)
+		# // put z first and the image axes next, the slice views are then (h, w, ...) arrays
+		spatial = [ax for ax in range(dset.ndim) if ax != z_axis and ax != channel_axis][0:2]
+		rest = [ax for ax in range(dset.ndim) if ax != z_axis and ax not in spatial]
+		view = np.transpose(dset, [z_axis] + spatial + rest)
+
+		def apply(k):
+			if not np.allclose(transforms[k], np.identity(3)):
+				view[k] = warp_slice(np.ascontiguousarray(view[k]), transforms[k])
+
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			for c in range(0, n, chunk_size):
+				if cancelled():
+					break
+				list(executor.map(apply, range(c, min(n, c + chunk_size))))
+				report(80 + min(n, c + chunk_size) / n * 20)
+
 	if display:
 		if not display_window:
 			win = pg.GraphicsWindow(title="Overlay registration")
 			win.resize(800,800)
 			p1 = win.addPlot()
 			# Item for displaying image data
-			imv = pg.ImageItem()
-			p1.addItem(imv)
+			display_window = pg.ImageItem()
+			p1.addItem(display_window)
 			win.show()
-			pg.QtGui.QApplication.processEvents()
-			display_window=imv
-
-	for k in range(_z,0,-1):
-		# // get channels summed
-		reg_slice=[slice(None)]*rank
-		ref_slice=[slice(None)]*rank
-		ref_slice[z_axis]=k
-		reg_slice[z_axis]=k-1
-		if z_axis>channel_axis[0]:
-			channel_axis_alt = channel_axis
-		else:
-			channel_axis_alt = channel_axis-1
-		dset[reg_slice] = registration_dft_slice(im0=dset[ref_slice],im1=dset[reg_slice],channel=(0,), channel_axis=channel_axis_alt, scale=scale, angle=angle, tx=tx, ty=ty, \
-	iterations=iterations, display=display, quiet=quiet, simulation=simulation, progressbar='', display_window=display_window)
-		if progressbar:
-			progressbar.setValue(_z-k/z_axis*100)
-
-	for k in range(_z,dset.shape[z_axis]-1,1):
-
-		if progressbar:
-			progressbar.setValue(k/z_axis*100)
-	if progressbar:
-			progressbar.setValue(100)
+		display_window.setImage(sum(_stack_slice(dset, k, z_axis, channel, channel_axis) for k in range(n)))
+		pg.QtGui.QApplication.processEvents()
+	report(100)
+	if return_transforms:
+		return dset, transforms
 	return dset
 
 
-def transform_img_dict(dset, tdict, invertx=False, inverty=False):
+def transform_img_dict(dset, tdict, invertx=False, inverty=False, out=None, bgval=0, order=1, tile_size=4096):
 	"""
 	reimplementation of transformation operation based on a dictionary of translation/scale/rotation vectors. Also enables invert
 
-	image is 2D
+	image is 2D (optionally with channels last). The flips, scaling, rotation (about the image center) and subpixel
+	translation are combined into one affine matrix and applied in a single pass (see warp_slice), the area mapped
+	from outside of the image is filled with bgval.
 	"""
 	if not tdict:
 		raise ValueError('Error, no vector translation/scale/rotation dictionary found')
+	h, w = dset.shape[0:2]
+	flip = np.identity(3)
 	if inverty:
-		dset=np.flipud(dset)
+		flip = np.array([[1.0, 0.0, 0.0], [0.0, -1.0, h - 1.0], [0.0, 0.0, 1.0]]).dot(flip)
 	if invertx:
-		dset=np.fliplr(dset)
-	if 'angle' in tdict:
-		dset=ndimage.rotate(dset,tdict['angle'],reshape=False)
-	if 'tvec' in tdict:
-		dset = np.roll(dset,shift=int(tdict['tvec'][0]),axis=0)
-	if 'tvec' in tdict:
-		dset = np.roll(dset,shift=int(tdict['tvec'][1]),axis=1)
-	return dset
+		flip = np.array([[-1.0, 0.0, w - 1.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]).dot(flip)
+	m = tdict_to_matrix(tdict, dset.shape).dot(flip)
+	return warp_slice(dset, m, out=out, bgval=bgval, order=order, tile_size=tile_size)
+
+
+def _downscale(im, factor):
+	"""
+	Downscales a 2D image by an integer factor (pixel area averaging)
+	"""
+	if factor == 1:
+		return im
+	import cv2
+	h, w = im.shape[0:2]
+	return cv2.resize(im, (max(1, w // factor), max(1, h // factor)), interpolation=cv2.INTER_AREA)
+
+
+def pyramid_levels(shape, levels, min_size=64):
+	"""
+	Number of pyramid levels which can be used for an image shape, the coarsest level keeps at least min_size pixels
+	along its smallest axis.
+
+	:param shape: image shape
+	:param levels: requested number of levels (1 is full resolution only)
+	:param min_size: minimum size of the coarsest level
+	:return: number of levels
+	"""
+	levels = max(1, int(levels))
+	while levels > 1 and min(shape[0:2]) // 2 ** (levels - 1) < min_size:
+		levels -= 1
+	return levels
 
 
-def registration_dft_slice(im0, im1, scale=[1,0], angle=[0,0], tx=[0,0], ty=[0,0], \
-	iterations=100, display=True, progressbar='', display_window=''):
+def registration_dft_slice(im0, im1, scale=None, angle=None, tx=None, ty=None, mode='similarity', \
+	iterations=100, display=True, progressbar='', display_window='', levels=1, tolerance=0.5, refine_angle=False,
+	mask0=None, mask1=None, progress=None, cancel_event=None):
 	'''
 	Self-contained worker algorithm for image registration of 2 multi-channel slices. Imreg_dft is based on the code by Christoph Gohlke.
 
@@ -138,19 +381,41 @@ def registration_dft_slice(im0, im1, scale=[1,0], angle=[0,0], tx=[0,0], ty=[0,0
 	---------- 
 
 
+	scale, angle, tx, ty: (center, window) tuples, optional
+		search windows of the scale, the angle (degrees) and the translation (pixels, tx along the columns), the
+		registration prefers values within center +- window (see the constraints of imreg_dft.similarity). None, or a
+		window of None, leaves the parameter unconstrained
 	mode: string, optional
 		determines what operations are allowed during registration:
-		1) translation
-		2) rotation
-		3) scaling
-		4) rigid: translation+rotation
-		5) all: translation+rotation+scaling
+		1) translation: translation only, measured by a single phase correlation (no log-polar transform, the
+		   scale, angle, tx and ty windows are ignored)
+		2) rigid: translation+rotation, the scale is fixed to 1
+		3) similarity: translation+rotation+scaling
 	iterations: int, ioptional
 		number of iterations in the dft algorithm (more == better registration, at a higher computational cost)
+	levels: int, optional
+		number of pyramid levels (coarse-to-fine mode). With levels > 1, scale and rotation are estimated on the
+		images downscaled by 2**(levels-1), the translation is then refined level by level up to full resolution.
+		The number of levels is reduced for small images (see pyramid_levels)
+	tolerance: float, optional
+		coarse-to-fine mode only: the refinement stops once a level changes the translation by less than tolerance
+		(in full resolution pixels)
+	refine_angle: boolean, optional
+		coarse-to-fine mode only: the angle (and scale) are refined as well at each level, searching around the
+		previous estimate
+	mask0, mask1: boolean arrays, optional
+		valid pixels of im0 and im1 (masked mode). The invalid pixels (e.g. padding) are set to the mean of the valid
+		ones for the scale and angle search, and the translation is measured by a masked normalized cross-correlation
+		which ignores them (see imreg_fft.masked_translation)
+	progress: function, optional
+		called with the progress (0-100)
+	cancel_event: threading.Event, optional
+		checked between the registration steps (pyramid levels), the registration raises
+		concurrent.futures.CancelledError once it is set
 
 	Returns
 	-------
-		returns the registred im1
+		returns the registration vector dictionary (scale, angle, tvec, success)
 
 	Notes
 	-----
@@ -175,12 +440,44 @@ def registration_dft_slice(im0, im1, scale=[1,0], angle=[0,0], tx=[0,0], ty=[0,0
 			win.show()
 			pg.QtGui.QApplication.processEvents()
 
+	def checkpoint(value):
+		if cancel_event is not None and cancel_event.is_set():
+			raise CancelledError()
+		if progress:
+			progress(value)
+		if progressbar:
+			progressbar.setValue(int(value))
+
 	im1_r = np.float32(normalize(im1))
 	im0_r = np.float32(normalize(im0))
+	masked = mask0 is not None and mask1 is not None
+	if masked:
+		mask0 = np.asarray(mask0, dtype=bool)
+		mask1 = np.asarray(mask1, dtype=bool)
+		im0_r[~mask0] = im0_r[mask0].mean() if mask0.any() else 0
+		im1_r[~mask1] = im1_r[mask1].mean() if mask1.any() else 0
 
 	# // get transformation
-	# vector_dict = ird.similarity(im0_r, im1_r, numiter=int(iterations), constraints={'scale':scale,'angle':angle, 'tx':tx, 'ty':ty})
-	vector_dict = ird.similarity(im0_r, im1_r, numiter=int(iterations))
+	checkpoint(5)
+	if mode == 'translation':
+		vector_dict = {'scale': 1.0, 'angle': 0.0, 'tvec': np.zeros(2), 'success': 1.0}
+		if not masked:
+			import imreg_fft
+			# // same convention as the tvec of imreg_dft: (row, column) shift of im1 which gives im0
+			vector_dict['tvec'] = np.array(imreg_fft.translation(im0_r, im1_r), dtype=np.float64)
+	else:
+		constraints = dft_constraints(mode, scale, angle, tx, ty)
+		levels = pyramid_levels(im0_r.shape, levels)
+		if levels == 1:
+			vector_dict = ird.similarity(im0_r, im1_r, numiter=int(iterations), constraints=constraints)
+		else:
+			vector_dict = _registration_coarse_to_fine(ird, im0_r, im1_r, levels, tolerance, refine_angle, iterations,
+													   checkpoint=lambda f: checkpoint(5 + 75 * f),
+													   constraints=constraints)
+	checkpoint(80)
+	if masked:
+		vector_dict = _refine_translation_masked(ird, im0_r, im1_r, mask0, mask1, vector_dict)
+	checkpoint(100)
 	# // apply transformation to each channel
 	if display:
 		im2_r = ird.imreg.transform_img_dict(im1_r, tdict=vector_dict, bgval=None, order=1, invert=False)
@@ -195,25 +492,120 @@ def registration_dft_slice(im0, im1, scale=[1,0], angle=[0,0], tx=[0,0], ty=[0,0
 			pg.QtGui.QApplication.processEvents()
 	return vector_dict
 
-def apply_imreg_dft(vector_dict, target):
+
+def _refine_translation_masked(ird, im0, im1, mask0, mask1, vector_dict):
+	"""
+	Replaces the translation of a vector dictionary by the one of the masked normalized cross-correlation of im0
+	and im1 warped with the scale and angle of the dictionary.
+	"""
+	import imreg_fft
+	tdict = {'scale': vector_dict['scale'], 'angle': vector_dict['angle'], 'tvec': (0, 0)}
+	warped = ird.imreg.transform_img_dict(im1, tdict=tdict, bgval=0, order=1, invert=False)
+	warped_mask = ird.imreg.transform_img_dict(mask1.astype(np.float32), tdict=tdict, bgval=0, order=1,
+											   invert=False) > 0.5
+	vector_dict['tvec'] = np.asarray(imreg_fft.masked_translation(im0, warped, mask0, warped_mask), dtype=np.float64)
+	return vector_dict
+
+
+def dft_constraints(mode='similarity', scale=None, angle=None, tx=None, ty=None):
+	"""
+	Constraints of imreg_dft.similarity for a registration mode and search windows, see registration_dft_slice.
+
+	:param mode: 'rigid' or 'similarity'
+	:param scale: (center, window) of the scale, or None
+	:param angle: (center, window) of the angle in degrees, or None
+	:param tx: (center, window) of the translation along the columns in pixels, or None
+	:param ty: (center, window) of the translation along the rows in pixels, or None
+	:return: constraints dictionary, None if nothing is constrained
+	"""
+	if mode not in ('rigid', 'similarity'):
+		raise ValueError("Unknown registration mode: {}".format(mode))
+	constraints = {}
+	for key, value in (('scale', scale), ('angle', angle), ('tx', tx), ('ty', ty)):
+		if value is not None and value[1] is not None:
+			constraints[key] = [float(value[0]), float(value[1])]
+	if mode == 'rigid':
+		constraints['scale'] = [1.0, 0]
+	return constraints or None
+
+
+def _registration_coarse_to_fine(ird, im0, im1, levels, tolerance=0.5, refine_angle=False, iterations=5,
+								 checkpoint=None, constraints=None):
+	"""
+	Coarse-to-fine similarity registration. The full similarity search (log-polar transform) only runs on the
+	coarsest level, so its cost is divided by 4**(levels-1). At every finer level, im1 is warped with the current
+	estimate and the remaining translation is measured by phase correlation, which is one FFT pair per level.
+
+	:param ird: the imreg_dft module
+	:param im0: reference image (2D float)
+	:param im1: image to register, same shape as im0
+	:param levels: number of pyramid levels
+	:param tolerance: the refinement stops once a level changes the translation by less than tolerance (in pixels)
+	:param refine_angle: refine the angle and scale at each level as well
+	:param iterations: number of iterations of the coarse similarity search
+	:param checkpoint: optional function called with the fraction of the levels done, after every level (it may
+					   raise to stop the registration)
+	:param constraints: optional constraints of the similarity search (see dft_constraints), in full resolution
+						pixels
+	:return: vector dictionary in full resolution pixels
+	"""
+	factor = 2 ** (levels - 1)
+	if constraints:
+		# // the translation windows are given in full resolution pixels
+		constraints = dict((key, [v / float(factor) for v in value] if key in ('tx', 'ty') else value)
+						   for key, value in constraints.items())
+	vector_dict = ird.similarity(_downscale(im0, factor), _downscale(im1, factor), numiter=int(iterations),
+								 constraints=constraints)
+	# // the coarse result image is not meaningful at full resolution
+	vector_dict.pop('timg', None)
+	fixed_scale = bool(constraints) and constraints.get('scale', [1.0, None])[1] == 0
+	tvec = np.asarray(vector_dict['tvec'], dtype=np.float64) * factor
+	for level in range(levels - 2, -1, -1):
+		if checkpoint is not None:
+			checkpoint((levels - 2 - level + 1) / float(levels))
+		factor = 2 ** level
+		im0_l = _downscale(im0, factor)
+		im1_l = _downscale(im1, factor)
+		if refine_angle:
+			# // search around the current estimate, the angular resolution doubles at each level
+			result = ird.similarity(im0_l, im1_l, numiter=1, constraints={
+				'angle': [vector_dict['angle'], 2.0 * factor],
+				'scale': [vector_dict['scale'], 0 if fixed_scale else 0.02 * factor],
+				'tx': [tvec[1] / factor, 2.0], 'ty': [tvec[0] / factor, 2.0]})
+			vector_dict['angle'] = result['angle']
+			vector_dict['scale'] = result['scale']
+			change = np.asarray(result['tvec'], dtype=np.float64) * factor - tvec
+		else:
+			tdict = dict(vector_dict, tvec=tvec / factor)
+			warped = ird.imreg.transform_img_dict(im1_l, tdict=tdict, bgval=None, order=1, invert=False)
+			result = ird.translation(im0_l, warped)
+			change = np.asarray(result['tvec'], dtype=np.float64) * factor
+		tvec = tvec + change
+		if np.hypot(*change) < tolerance:
+			break
+	vector_dict['tvec'] = tvec
+	return vector_dict
+
+def apply_imreg_dft(vector_dict, target, fast=False):
 	"""
 	Apply dft transformation
 
-	:param vector_dict:
-	:param target:
-	:return:
+	:param vector_dict: transformation dictionary, as returned by registration_dft_slice
+	:param target: array to transform, the first two axes are the image axes, the transformation is applied to every
+				   2D image along the other axes
+	:param fast: use the (interpolating) transformation of imreg_dft
+	:return: transformed array
 	"""
 	import imreg_dft as ird
+	out = np.empty_like(target)
 	# // run through all channels and transform the arrays separately
-	def registration_dft_worker(dset, _axis=(0, 1), tdict=vector_dict, bgval=None, order=1, invert=False, fast=False):
-		# // fast transform compresses the result
+	for idx in np.ndindex(*target.shape[2:]):
+		sl = (slice(None), slice(None)) + idx
 		if fast:
-			return ird.imreg.transform_img_dict(dset, tdict=tdict, bgval=bgval, order=order, invert=invert)
+			out[sl] = ird.imreg.transform_img_dict(target[sl], tdict=vector_dict, bgval=None, order=1, invert=False)
 		else:
-			return transform_img_dict(dset, tdict=tdict)
-
-	return mp_worker(registration_dft_worker, dset=target, _axis=tuple([x for x in range(target.ndim) if x != 1]),
-						 tdict=vector_dict, bgval=None, order=1, invert=False)
+			out[sl] = transform_img_dict(target[sl], tdict=vector_dict)
+	return out
 
 
 # // test image
@@ -449,4 +841,64 @@ def rotatePoint(centerPoint,point,angle):
 	temp_point = point[0]-centerPoint[0] , point[1]-centerPoint[1]
 	temp_point = ( temp_point[0]*math.cos(angle)-temp_point[1]*math.sin(angle) , temp_point[0]*math.sin(angle)+temp_point[1]*math.cos(angle))
 	temp_point = temp_point[0]+centerPoint[0] , temp_point[1]+centerPoint[1]
-	return temp_point
\ No newline at end of file
+	return temp_point
+
+def similarity_matrix_about(center, scale=1.0, angle=0.0, tvec=(0, 0)):
+	"""
+	Homogeneous matrix of a similarity transformation in (x, y) coordinates: scaling and rotation about a center,
+	followed by a translation.
+
+	:param center: (x, y) center of the rotation and scaling
+	:param scale: isotropic scale factor
+	:param angle: rotation angle in degrees, from the x axis towards the y axis
+	:param tvec: (x, y) translation
+	:return: 3x3 array
+	"""
+	import math
+	a = math.radians(angle)
+	c, s = scale * math.cos(a), scale * math.sin(a)
+	cx, cy = center
+	return np.array([[c, -s, cx - c * cx + s * cy + tvec[0]],
+					 [s, c, cy - s * cx - c * cy + tvec[1]],
+					 [0.0, 0.0, 1.0]])
+
+
+def image_pose_matrix(d, pixel_size):
+	"""
+	Matrix mapping the pixel coordinates (column, row) of a workspace image onto the field coordinates, built from
+	the Outline and Rotation of its image dictionary (same convention as ImageBufferInfo.insert_qi).
+
+	:param d: image dictionary
+	:param pixel_size: (width, height) of the image in pixels
+	:return: 3x3 array
+	"""
+	outl = d['Outline']
+	px_w, px_h = pixel_size
+	sx = (outl[1] - outl[0]) / float(px_w)
+	sy = (outl[3] - outl[2]) / float(px_h)
+	center = ((outl[0] + outl[1]) / 2.0, (outl[2] + outl[3]) / 2.0)
+	m = np.array([[sx, 0.0, outl[0]], [0.0, sy, outl[2]], [0.0, 0.0, 1.0]])
+	return similarity_matrix_about(center, 1.0, d.get('Rotation', 0)).dot(m)
+
+
+def pose_to_outline(d, m, pixel_size):
+	"""
+	Updates the Outline, Rotation, Center and Size of an image dictionary from a pose matrix (see
+	image_pose_matrix). The matrix is assumed to be free of shear.
+
+	:param d: image dictionary, updated in place
+	:param m: 3x3 pose matrix
+	:param pixel_size: (width, height) of the image in pixels
+	:return: d
+	"""
+	import math
+	px_w, px_h = pixel_size
+	w = math.hypot(m[0, 0], m[1, 0]) * px_w
+	h = math.hypot(m[0, 1], m[1, 1]) * px_h
+	cx, cy = m.dot([px_w / 2.0, px_h / 2.0, 1.0])[0:2]
+	z = list(d['Outline'][4:6]) if len(d['Outline']) >= 6 else [0, 0]
+	d['Outline'] = [cx - w / 2.0, cx + w / 2.0, cy - h / 2.0, cy + h / 2.0] + z
+	d['Rotation'] = math.degrees(math.atan2(m[1, 0], m[0, 0]))
+	from export_module import update_geometry_from_outline
+	update_geometry_from_outline(d)
+	return d
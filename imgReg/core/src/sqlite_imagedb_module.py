@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# // SQLite storage backend of the image database, alternative to the .imagedb xml files
+import os
+import json
+import sqlite3
+import threading
+
+import numpy as np
+
+sqlite_extensions = ('.sqlite', '.sqlite3', '.db')
+
+# // keys stored in their own columns, all other keys of the image dictionary are stored as json
+_column_keys = ('Path', 'Name', 'Opacity', 'Visible', 'Rotation', 'Outline')
+
+
+def is_sqlite_path(path):
+    return bool(path) and os.path.splitext(str(path))[-1].lower() in sqlite_extensions
+
+
+def _to_json(v):
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(v)))
+
+
+class ImageDB(object):
+    """
+    Image database stored in a SQLite file. There is one row per image, keyed by the image path (unique index), with
+    the outline in indexed columns. Every change is a transactional row update, so edits do not rewrite the database.
+    Rectangle queries use an R*Tree index when the SQLite build provides it, else the index on the outline columns.
+    The connection is shared between threads and guarded by a lock.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.has_rtree = True
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS images (
+                                    id INTEGER PRIMARY KEY,
+                                    path TEXT NOT NULL UNIQUE,
+                                    name TEXT,
+                                    opacity REAL,
+                                    visible INTEGER,
+                                    rotation REAL,
+                                    x0 REAL, x1 REAL, y0 REAL, y1 REAL, z0 REAL, z1 REAL,
+                                    render_order INTEGER,
+                                    attrs TEXT)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS images_outline ON images (x0, x1, y0, y1)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS images_order ON images (render_order)")
+            try:
+                self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS images_rtree USING rtree(id, x0, x1, y0, y1)")
+            except sqlite3.OperationalError:
+                # // sqlite compiled without the rtree module
+                self.has_rtree = False
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _row_values(self, d, render_order=None):
+        o = [float(k) for k in d['Outline']] if 'Outline' in d else [0.0] * 6
+        o = (o + [0.0] * 6)[0:6]
+        extra = {k: v for k, v in d.items() if k not in _column_keys}
+        return (d['Path'], d.get('Name', os.path.basename(d['Path'])), float(d.get('Opacity', 100)),
+                int(bool(d.get('Visible', True))), float(d.get('Rotation', 0)),
+                min(o[0], o[1]), max(o[0], o[1]), min(o[2], o[3]), max(o[2], o[3]), o[4], o[5],
+                render_order, json.dumps(extra, default=_to_json))
+
+    def _upsert(self, d, render_order=None):
+        values = self._row_values(d, render_order)
+        # // insert-or-ignore followed by an update instead of ON CONFLICT ... DO UPDATE, which needs SQLite 3.24
+        self.conn.execute("""INSERT OR IGNORE INTO images (path, name, opacity, visible, rotation,
+                                 x0, x1, y0, y1, z0, z1, render_order, attrs)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                                 COALESCE(?, (SELECT COALESCE(MAX(render_order), -1) + 1 FROM images)), ?)""",
+                          values)
+        cur = self.conn.execute("""UPDATE images SET name=?, opacity=?, visible=?, rotation=?,
+                                       x0=?, x1=?, y0=?, y1=?, z0=?, z1=?,
+                                       render_order=COALESCE(?, render_order), attrs=?
+                                   WHERE path=?""",
+                                values[1:] + (values[0],))
+        if self.has_rtree:
+            row_id = self.conn.execute("SELECT id FROM images WHERE path=?", (d['Path'],)).fetchone()[0]
+            self.conn.execute("INSERT OR REPLACE INTO images_rtree (id, x0, x1, y0, y1) VALUES (?, ?, ?, ?, ?)",
+                              (row_id,) + values[5:9])
+        return cur
+
+    def upsert(self, d):
+        """
+        Inserts an image dictionary, or updates the row with the same path.
+        :param d: image dictionary, it must have a Path key
+        :return:
+        """
+        with self._lock, self.conn:
+            self._upsert(d)
+
+    def upsert_many(self, attrList, replace=False, keep_order=False):
+        """
+        Writes a list of image dictionaries in one transaction, the list order is stored as render order.
+        :param attrList: list of image dictionaries
+        :param replace: when True, the rows of images which are not in the list are deleted
+        :param keep_order: when True, the render order of existing rows is kept (e.g. to update a subset of images)
+        :return:
+        """
+        with self._lock, self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM images")
+                if self.has_rtree:
+                    self.conn.execute("DELETE FROM images_rtree")
+            for i, d in enumerate(attrList):
+                self._upsert(d, render_order=None if keep_order else i)
+
+    def remove(self, path):
+        with self._lock, self.conn:
+            if self.has_rtree:
+                self.conn.execute("DELETE FROM images_rtree WHERE id IN (SELECT id FROM images WHERE path=?)", (path,))
+            self.conn.execute("DELETE FROM images WHERE path=?", (path,))
+
+    def clear(self):
+        self.upsert_many([], replace=True)
+
+    def _row_to_dict(self, row):
+        path, name, opacity, visible, rotation, x0, x1, y0, y1, z0, z1, attrs = row
+        d = json.loads(attrs) if attrs else {}
+        d.update({'Path': path, 'Name': name, 'Opacity': opacity, 'Visible': bool(visible), 'Rotation': rotation,
+                  'Outline': [x0, x1, y0, y1, z0, z1]})
+        for k in ('Center', 'Size'):
+            if k in d:
+                d[k] = np.array(d[k], dtype=np.float64)
+        return d
+
+    _select = "SELECT path, name, opacity, visible, rotation, x0, x1, y0, y1, z0, z1, attrs FROM images"
+
+    def get(self, path):
+        with self._lock:
+            row = self.conn.execute(self._select + " WHERE path=?", (path,)).fetchone()
+        return self._row_to_dict(row) if row is not None else None
+
+    def load_all(self, exclude_file=[]):
+        """
+        :return: list of all image dictionaries, in render order
+        """
+        with self._lock:
+            rows = self.conn.execute(self._select + " ORDER BY render_order, id").fetchall()
+        return [self._row_to_dict(r) for r in rows if r[0] not in exclude_file]
+
+    def query_rect(self, x0, y0, x1, y1):
+        """
+        Lists the images whose outline intersects a rectangle.
+        :return: list of image dictionaries, in render order
+        """
+        with self._lock:
+            if self.has_rtree:
+                rows = self.conn.execute(
+                    self._select + " WHERE id IN (SELECT id FROM images_rtree WHERE x1>=? AND x0<=? AND y1>=? AND y0<=?)"
+                                   " ORDER BY render_order, id", (x0, x1, y0, y1)).fetchall()
+            else:
+                rows = self.conn.execute(self._select + " WHERE x1>=? AND x0<=? AND y1>=? AND y0<=?"
+                                                        " ORDER BY render_order, id", (x0, x1, y0, y1)).fetchall()
+        return [self._row_to_dict(r) for r in rows]
+
+    def import_xml(self, xml_path):
+        """
+        Imports an .imagedb xml file into the database
+        """
+        from importmodule import load_im_xml
+        self.upsert_many(load_im_xml(xml_path, exclude_file=[]))
+
+    def export_xml(self, xml_path, distributed=True):
+        """
+        Exports the database to an .imagedb xml file
+        """
+        from export_module import write_im_xml
+        write_im_xml(xml_path, self.load_all(), distributed=distributed)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# // on-disk multi-resolution tile pyramid for very large workspace images
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+default_cache_dir = os.path.join(tempfile.gettempdir(), 'imgReg_tiles')
+
+
+def pyramid_key(path):
+    """
+    Key of the pyramid of an image file, it changes whenever the file is modified.
+
+    :param path: path of the source image
+    :return: hex digest of the absolute path, modification time and size of the file
+    """
+    st = os.stat(path)
+    s = '{}|{}|{}'.format(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+# // number of rows processed at once while building, this bounds the memory used for any image size
+_band_rows = 2048
+
+
+def _downsample(src, path):
+    """
+    Writes the 2x downsampled version of src to a .npy file, band by band.
+
+    :param src: image array (may be memory mapped)
+    :param path: output .npy file
+    :return: memory map of the output
+    """
+    h, w = max(1, src.shape[0] // 2), max(1, src.shape[1] // 2)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=src.dtype, shape=(h, w) + tuple(src.shape[2:]))
+    for r in range(0, h, _band_rows // 2):
+        r1 = min(h, r + _band_rows // 2)
+        band = np.asarray(src[2 * r:2 * r1, 0:2 * w])
+        # // INTER_AREA averages the 2x2 pixels, this avoids aliasing in the zoomed out levels
+        out[r:r1] = cv2.resize(band, (w, r1 - r), interpolation=cv2.INTER_AREA).reshape(out[r:r1].shape)
+    return out
+
+
+class TilePyramid(object):
+    """
+    Multi-resolution pyramid of an image stored in a cache folder. Level 0 is the full resolution image (in its native
+    data type), every next level is downsampled by a factor 2 until the image fits in one tile. Levels are written
+    band by band, so memory mapped sources of any size can be converted. Each level is stored as one .npy file which is
+    memory mapped, tiles are slices of these maps, so only the tiles being drawn are read from disk.
+    """
+
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.key = meta['key']
+        self.tile_size = meta['tile_size']
+        self.shapes = [tuple(s) for s in meta['shapes']]
+        self.dtype = np.dtype(meta['dtype'])
+        self._levels = {}
+
+    @property
+    def n_levels(self):
+        return len(self.shapes)
+
+    @classmethod
+    def open_cached(cls, path, cache_dir=None):
+        """
+        Opens the pyramid of an image if it was generated before.
+
+        :param path: path of the source image
+        :param cache_dir: folder of the pyramid cache
+        :return: TilePyramid or None if not cached (or if the source file changed)
+        """
+        cache_dir = cache_dir or default_cache_dir
+        try:
+            key = pyramid_key(path)
+        except OSError:
+            return None
+        folder = os.path.join(cache_dir, key)
+        meta_file = os.path.join(folder, 'meta.json')
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        return cls(folder, meta)
+
+    @classmethod
+    def build(cls, path, image, cache_dir=None, tile_size=512):
+        """
+        Generates the pyramid of an image, the meta file is written last so that an interrupted build is not used.
+
+        :param path: path of the source image, used for the key
+        :param image: decoded image array (2D, or 3D with the channels last)
+        :param cache_dir: folder of the pyramid cache
+        :param tile_size: tile size in pixels
+        :return: TilePyramid
+        """
+        cache_dir = cache_dir or default_cache_dir
+        key = pyramid_key(path)
+        folder = os.path.join(cache_dir, key)
+        os.makedirs(folder, exist_ok=True)
+        shapes = []
+        level = image
+        n = 0
+        while True:
+            level_file = os.path.join(folder, 'level_{}.npy'.format(n))
+            tmp_file = level_file + '.tmp.npy'
+            if n == 0:
+                out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=image.dtype, shape=image.shape)
+                for r in range(0, image.shape[0], _band_rows):
+                    out[r:r + _band_rows] = image[r:r + _band_rows]
+            else:
+                out = _downsample(level, tmp_file)
+            out.flush()
+            del out
+            os.replace(tmp_file, level_file)
+            level = np.load(level_file, mmap_mode='r')
+            shapes.append(level.shape)
+            if max(level.shape[0:2]) <= tile_size:
+                break
+            n += 1
+        meta = {'key': key, 'source': os.path.abspath(path), 'tile_size': tile_size,
+                'shapes': shapes, 'dtype': str(image.dtype)}
+        tmp_meta = os.path.join(folder, 'meta.json.tmp')
+        with open(tmp_meta, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, os.path.join(folder, 'meta.json'))
+        return cls(folder, meta)
+
+    @classmethod
+    def open_or_build(cls, path, image, cache_dir=None, tile_size=512):
+        pyramid = cls.open_cached(path, cache_dir)
+        if pyramid is None:
+            pyramid = cls.build(path, image, cache_dir, tile_size)
+        return pyramid
+
+    def level(self, n):
+        """
+        :param n: level index, 0 is full resolution
+        :return: read-only memory map of the level
+        """
+        if n not in self._levels:
+            self._levels[n] = np.load(os.path.join(self.folder, 'level_{}.npy'.format(n)), mmap_mode='r')
+        return self._levels[n]
+
+    def level_for_scale(self, scale):
+        """
+        Selects the coarsest level which still has at least one level pixel per screen pixel.
+
+        :param scale: screen pixels per full resolution pixel
+        :return: level index
+        """
+        if scale <= 0:
+            return self.n_levels - 1
+        n = int(np.floor(np.log2(1.0 / scale))) if scale < 1 else 0
+        return int(np.clip(n, 0, self.n_levels - 1))
+
+    def tiles_in_rect(self, n, rect):
+        """
+        Lists the tiles of a level which intersect a rectangle given in full resolution pixel coordinates.
+
+        :param n: level index
+        :param rect: (x0, y0, x1, y1) in full resolution pixels
+        :return: list of ((ty, tx), (x, y, w, h)), the second item is the tile area in full resolution pixels
+        """
+        h, w = self.shapes[n][0:2]
+        ts = self.tile_size
+        x0, y0, x1, y1 = rect
+        # // full resolution pixels per level pixel (close to 2**n, odd sizes lose their last pixel when downsampling)
+        sx = self.shapes[0][1] / float(w)
+        sy = self.shapes[0][0] / float(h)
+        tx0, ty0 = max(0, int(x0 // (ts * sx))), max(0, int(y0 // (ts * sy)))
+        tx1 = min((w - 1) // ts, int(x1 // (ts * sx)))
+        ty1 = min((h - 1) // ts, int(y1 // (ts * sy)))
+        tiles = []
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                tw = min(ts, w - tx * ts)
+                th = min(ts, h - ty * ts)
+                tiles.append(((ty, tx), (tx * ts * sx, ty * ts * sy, tw * sx, th * sy)))
+        return tiles
+
+    def tile(self, n, ty, tx):
+        """
+        :return: contiguous copy of one tile of a level
+        """
+        ts = self.tile_size
+        return np.ascontiguousarray(self.level(n)[ty * ts:(ty + 1) * ts, tx * ts:(tx + 1) * ts])
+
+
+class TileCache(object):
+    """
+    LRU cache of tiles shared by all pyramids, bounded by the total number of bytes.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pyramid, n, ty, tx):
+        key = (pyramid.key, n, ty, tx)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                return tile
+        tile = pyramid.tile(n, ty, tx)
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile
+                self.n_bytes += tile.nbytes
+            # // evict the least recently used tiles
+            while self.n_bytes > self.max_bytes and len(self._tiles) > 1:
+                _, old = self._tiles.popitem(last=False)
+                self.n_bytes -= old.nbytes
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.n_bytes = 0
+
+
+tile_cache = TileCache()
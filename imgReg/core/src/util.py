@@ -88,6 +88,66 @@ def qt_image_to_array(img, share_memory=False):
     else:
         return copy.deepcopy(arr)
 
+def array_to_qimage(arr):
+    """ Creates a QImage which is a view on a uint8 numpy array (gray, RGB or RGBA), no pixel data is copied.
+
+        Be careful: the QImage does not own the buffer, keep a reference to the array as long as the image is used.
+    """
+    assert arr.dtype == np.uint8, "array must be of type uint8, got: {}".format(arr.dtype)
+    assert arr.flags['C_CONTIGUOUS'], "array must be C contiguous"
+    h, w = arr.shape[0:2]
+    if arr.ndim == 2:
+        fmt = QtGui.QImage.Format_Grayscale8
+    elif arr.shape[2] == 3:
+        fmt = QtGui.QImage.Format_RGB888
+    else:
+        fmt = QtGui.QImage.Format_RGBA8888
+    return QtGui.QImage(arr.data, w, h, arr.strides[0], fmt)
+
+def gray_array(arr):
+    """ Returns the grayscale version of an image array. A 2D array is returned as is (no copy), RGB(A) arrays
+        are converted with the same weights as qt_image_to_array.
+    """
+    if arr.ndim == 2:
+        return arr
+    import cv2
+    if arr.shape[2] == 4:
+        return cv2.cvtColor(arr, cv2.COLOR_RGBA2GRAY)
+    return cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
+
+def _subsample(data, max_size=1e6):
+    # // halve the largest spatial axis until the array is small enough, these are strided views (no copy)
+    while data.size > max_size:
+        ax = np.argmax(data.shape[0:min(data.ndim, 3)])
+        sl = [slice(None)] * data.ndim
+        sl[ax] = slice(None, None, 2)
+        data = data[tuple(sl)]
+    return data
+
+def quick_level(data, low=2.5, high=97.5):
+    """ Display levels of an image, taken as the low and high percentiles of a subsample of the data. Only the
+        subsample is read, so this is cheap on memory mapped arrays as well.
+    """
+    data = np.asarray(_subsample(data))
+    return np.nanpercentile(data, low), np.nanpercentile(data, high)
+
+def quick_min_max(data):
+    data = np.asarray(_subsample(data))
+    return np.nanmin(data), np.nanmax(data)
+
+def to_uint8(arr, levels=None):
+    """ Converts an image array to uint8 for display, uint8 arrays are returned as is.
+        levels: (low, high) mapped to 0 and 255, defaults to quick_level(arr)
+    """
+    if arr.dtype == np.uint8:
+        return arr
+    if levels is None:
+        levels = quick_level(arr)
+    low, high = float(levels[0]), float(levels[1])
+    scale = 255.0 / (high - low) if high > low else 1.0
+    import cv2
+    return cv2.convertScaleAbs(np.asarray(arr, dtype=np.float32), alpha=scale, beta=-low * scale)
+
 class PandasModel(QtCore.QAbstractTableModel):
     """
     Class to populate a table view with a pandas dataframe
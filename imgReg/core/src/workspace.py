@@ -4,12 +4,15 @@
 # // module to manage the field view
 # from ui.workspace_widget import Ui_workspace_widget
 import sys, os, cv2
+import html
 import tifffile
 import qimage2ndarray
 from pathlib import Path
 import numpy as np
 import pandas as pd
-from functools import partialmethod
+from functools import partial, partialmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pyqtgraph as pg
 import pyqtgraph.functions as fn
 from PyQt5 import QtGui, QtCore, QtWidgets, uic
@@ -20,13 +23,21 @@ from settings_unit import ScaleBar
 from geometry_unit import geometry_widget_wrapper
 from field_dft_registration import mdi_field_imreg_show, MdiFieldImreg_Wrapper
 from spatial_registration_module import rotatePoint
+from batch_registration_module import BatchRegistration
+from mosaic_module import MosaicAlignment
 from field_fiducial_markers_unit import FiducialMarkerWidget, FiducialMarkerWidget_wrapper
 from camera_control_module import camera_control_panel
 from particle_tool import particle_widget_wrapper
 from field_tools import FieldViewBox
 from utility_widgets import check_true, MoveMotorTool, GaussianFitTool, GaussianSimTool
-from importmodule import load_im_xml, load_align_xml
-from util import PandasModel, submit_jobs
+from importmodule import load_im_xml, iter_im_xml, load_align_xml
+from image_loader_module import ImageLoader, load_image, read_image_shape
+from tile_pyramid_module import tile_cache
+import imreg_fft
+from registration_cache_module import registration_cache
+from diagnostics_module import diagnostics
+from sqlite_imagedb_module import ImageDB, is_sqlite_path
+from util import PandasModel, submit_jobs, array_to_qimage, gray_array, quick_level, quick_min_max, to_uint8
 from taurus.qt.qtgui.container import TaurusMainWindow
 from sardana.taurus.qt.qtgui.extra_macroexecutor.macroexecutor import MacroExecutionWindow, ParamEditorManager
 from taurus import Device
@@ -36,23 +47,6 @@ setting_file = str(Path(__file__).parent.parent.parent / 'config' / 'appsettings
 ui_file_folder = Path(__file__).parent.parent / 'ui'
 sys.path.append(str(Path(__file__).parent))
 
-def quick_level(data):
-    while data.size > 1e6:
-        ax = np.argmax((data.shape[0],data.shape[1],data.shape[2]))
-        sl = [slice(None)] * data.ndim
-        sl[ax] = slice(None, None, 2)
-        data = data[sl]
-    return np.percentile(data, 2.5), np.percentile(data, 97.5)
-
-def quick_min_max(data):
-    from numpy import nanmin, nanmax
-    while data.size > 1e6:
-        ax = np.argmax((data.shape[0],data.shape[1],data.shape[2]))
-        sl = [slice(None)] * data.ndim
-        sl[ax] = slice(None, None, 2)
-        data = data[sl]
-    return nanmin(data), nanmax(data)
-
 # class WorkSpace(TaurusMainWindow, MdiFieldImreg_Wrapper, geometry_widget_wrapper, FiducialMarkerWidget_wrapper, particle_widget_wrapper, camera_control_panel):
 class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wrapper, FiducialMarkerWidget_wrapper, particle_widget_wrapper, camera_control_panel):
 # class WorkSpace(MacroExecutionWindow):
@@ -147,6 +141,17 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         self.bt_dft_registration.setText("DFT position refinement")
         self.bt_dft_registration.clicked.connect(self.launch_dft)
 
+        self.bt_orb_registration = QtWidgets.QPushButton(self)
+        action = QtWidgets.QWidgetAction(self.bt_alignMenu)
+        action.setDefaultWidget(self.bt_orb_registration)
+        self.bt_alignMenu.menu().addAction(action)
+        icon1 = QtGui.QIcon()
+        icon1.addPixmap(QtGui.QPixmap(str(ui_file_folder / 'icons' / 'Viewing' / 'coordinates_128x128.png')), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        self.bt_orb_registration.setIcon(icon1)
+        self.bt_orb_registration.setIconSize(QtCore.QSize(32, 32))
+        self.bt_orb_registration.setText("Feature based position refinement")
+        self.bt_orb_registration.clicked.connect(self.launch_orb)
+
         self.bt_fiducial_markers = QtWidgets.QPushButton(self)
         action = QtWidgets.QWidgetAction(self.bt_alignMenu)
         action.setDefaultWidget(self.bt_fiducial_markers)
@@ -158,6 +163,28 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         self.bt_fiducial_markers.setText("Add fiducial markers")
         self.bt_fiducial_markers.clicked.connect(self.show_fiducial_alignment)
 
+        self.bt_batch_registration = QtWidgets.QPushButton(self)
+        action = QtWidgets.QWidgetAction(self.bt_alignMenu)
+        action.setDefaultWidget(self.bt_batch_registration)
+        self.bt_alignMenu.menu().addAction(action)
+        icon1 = QtGui.QIcon()
+        icon1.addPixmap(QtGui.QPixmap(str(ui_file_folder / 'icons' / 'Viewing' / 'coordinates_128x128.png')), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        self.bt_batch_registration.setIcon(icon1)
+        self.bt_batch_registration.setIconSize(QtCore.QSize(32, 32))
+        self.bt_batch_registration.setText("Register selected images to current")
+        self.bt_batch_registration.clicked.connect(self.launch_batch_registration)
+
+        self.bt_mosaic_alignment = QtWidgets.QPushButton(self)
+        action = QtWidgets.QWidgetAction(self.bt_alignMenu)
+        action.setDefaultWidget(self.bt_mosaic_alignment)
+        self.bt_alignMenu.menu().addAction(action)
+        icon1 = QtGui.QIcon()
+        icon1.addPixmap(QtGui.QPixmap(str(ui_file_folder / 'icons' / 'Viewing' / 'coordinates_128x128.png')), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        self.bt_mosaic_alignment.setIcon(icon1)
+        self.bt_mosaic_alignment.setIconSize(QtCore.QSize(32, 32))
+        self.bt_mosaic_alignment.setText("Global mosaic alignment")
+        self.bt_mosaic_alignment.clicked.connect(self.launch_mosaic_alignment)
+
         from pyqtgraph import GraphicsLayoutWidget
         self.graphicsView_field = GraphicsLayoutWidget(self)
         self.graphicsView_field_color_bar = GraphicsLayoutWidget(self)
@@ -248,12 +275,49 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         self.imageBuffer = ImageBufferInfo(self,
                                            self.img_backup_path)
         self.tbl_render_order.imageBuffer = self.imageBuffer
+        # // registration of the selected images against the current image, in a background thread
+        self.batch_registration = BatchRegistration(
+            canvas_size=int(self.settings_object.value('Registration/batchCanvasSize', 1024)),
+            max_workers=int(self.settings_object.value('Hardware/registrationThreads', os.cpu_count() or 4)),
+            cache=registration_cache, parent=self)
+        # // global alignment of all overlapping images
+        self.mosaic_alignment = MosaicAlignment(
+            canvas_size=int(self.settings_object.value('Registration/mosaicCanvasSize', 512)),
+            max_workers=int(self.settings_object.value('Hardware/registrationThreads', os.cpu_count() or 4)),
+            parent=self)
+        # // image items of the running batch registration and mosaic alignment, keyed by path
+        self._batch_targets = {}
+        self._mosaic_targets = {}
+        # // registration results are cached on disk, keyed by the content of the registered frames
+        registration_cache.cache_dir = self.settings_object.value('FileManager/registrationCacheDir',
+                                                                  registration_cache.cache_dir)
+        registration_cache.max_entries = int(self.settings_object.value('Registration/cacheEntries', 2000))
+        # // debug capture of the intermediate registration frames, written in the background
+        diagnostics.configure(
+            folder=self.settings_object.value('Diagnostics/folder', os.path.join(
+                str(self.settings_object.value('FileManager/currentimagedbDir', '')), 'diagnostics')),
+            enabled=check_true(self.settings_object.value('Diagnostics/enabled', False)),
+            ring_size=int(self.settings_object.value('Diagnostics/ringSize', 16)),
+            quota_bytes=int(float(self.settings_object.value('Diagnostics/quotaMB', 200)) * 2 ** 20))
+        # // FFT backend of the registrations: threads per transform, padding to fast lengths, reference spectra cache
+        imreg_fft.set_fft_backend(workers=int(self.settings_object.value('Hardware/fftWorkers', os.cpu_count() or 1)),
+                                  pad=check_true(self.settings_object.value('Hardware/fftPad', True)))
+        imreg_fft.spectrum_cache_bytes = int(float(self.settings_object.value('Hardware/spectrumCacheMB', 256)) * 2 ** 20)
+
+        # // progressbar and cancel button in the statusbar, used by the background image loading
+        self.progressbar = QtWidgets.QProgressBar(self)
+        self.progressbar.setRange(0, 100)
+        self.progressbar.setMaximumWidth(200)
+        self.progressbar.hide()
+        self.statusbar.addPermanentWidget(self.progressbar)
+        self.bt_cancel_loading = QtWidgets.QPushButton("Cancel loading", self)
+        self.bt_cancel_loading.hide()
+        self.statusbar.addPermanentWidget(self.bt_cancel_loading)
 
         # // draw scalebar
         self.draw_scalebar()
         self.connect_slots()
-        self.imageBuffer.recallImgBackup()
-        self.highlightFirstImg()
+        self.imageBuffer.recallImgBackup(callback=self.highlightFirstImg)
 
     def init_taurus(self):
         #ui is a *.ui file from qt designer
@@ -395,6 +459,20 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         self.widget_online_monitor.manager.newShortMessage.connect(self.statusbar.showMessage) 
         #save image buffer sig
         self.saveimagedb_sig.connect(self.imageBuffer.writeImgBackup)
+        #image buffer loading
+        self.imageBuffer.progressUpdate_sig.connect(self.progressUpdate)
+        self.imageBuffer.statusMessage_sig.connect(self.statusUpdate)
+        self.bt_cancel_loading.clicked.connect(self.imageBuffer.cancel_loading)
+        self.batch_registration.sig_progress.connect(self.progressUpdate)
+        self.batch_registration.sig_status.connect(self.statusUpdate)
+        # // each job has its own map of target items, so a job finishing does not affect the other one
+        self.batch_registration.sig_finished.connect(
+            lambda results: self.apply_batch_registration(results, self._batch_targets))
+        self.mosaic_alignment.sig_progress.connect(self.progressUpdate)
+        self.mosaic_alignment.sig_status.connect(self.statusUpdate)
+        self.mosaic_alignment.sig_finished.connect(
+            lambda results: self.apply_batch_registration(results, self._mosaic_targets))
+        self.tbl_render_order.itemClicked.connect(self.on_table_order_clicked)
         #tabwidget signal
         self.tabWidget.tabBarClicked.connect(self.switch_mode)
         #dft slots
@@ -708,7 +786,7 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
             except:
                 QtCore.qDebug("Error: invalid directory")
         source_path_list, _ = dialog.getOpenFileName(self, "Open .imagedb file to be imported", os.getcwd(), \
-                                                     "imagedb files (*.imagedb);;All Files (*)")
+                                                     "imagedb files (*.imagedb *.sqlite);;All Files (*)")
 
         # // select files based on tumbnails
         exclude_file_list = []
@@ -730,10 +808,7 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         else:
             self.statusMessage_sig.emit("Invalid path for the .imagedb file")
             return None
-
-        if dict_list:
-            self.imageBuffer.attrList += dict_list
-            self.imageBuffer.writeImgBackup()
+        # // the images are added to the image buffer (and the backup file) by load_imagedb once they are decoded
 
     def saveImageBuffer(self):
         import os
@@ -742,7 +817,7 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         if os.path.exists(path):
             os.chdir(path)
         source_path_list, _ = dialog.getSaveFileName(self, "Open .imagedb file to be imported", os.getcwd(), \
-                                                     "imagedb files (*.imagedb);;All Files (*)")
+                                                     "imagedb files (*.imagedb *.sqlite);;All Files (*)")
         if os.path.exists(os.path.dirname(source_path_list)):
             # self.imageBuffer.writeimagedb(xml_path=source_path_list)
             self.imageBuffer.writeImgBackup(path=source_path_list)
@@ -759,9 +834,91 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
 
     def launch_orb(self):
         """
-        Launches the ORB registration tool to register images using feature detection
+        Launches the ORB registration tool to register images using feature detection. The target is registered
+        against the reference on the sub frames selected in the registration panel, see prepare_orb.
+        :return:
+        """
+        if not (hasattr(self, 'reference_sub_outline') and hasattr(self, 'target_sub_outline')):
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       """<p>Select the reference and target regions in the registration panel first.<p>""")
+            return None
+        self.prepare_orb()
+
+    def launch_batch_registration(self):
+        """
+        Registers the images selected in the render table against the current image. All images are registered in
+        parallel against the same reference spectra, the results are applied by apply_batch_registration.
+        :return:
+        """
+        reference = self.update_field_current
+        if reference is None or not isinstance(reference.loc, dict):
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       """<p>No reference image selected. Click the reference image first.<p>""")
+            return None
+        rows = sorted(set(item.row() for item in self.tbl_render_order.selectedItems()))
+        targets = [self.field_img[row] for row in rows if self.field_img[row] is not reference]
+        if len(targets) == 0:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       """<p>Select the images to be registered in the render table.<p>""")
+            return None
+        if self.batch_registration.is_running():
+            self.batch_registration.cancel()
+        self._batch_targets = {img.loc['Path']: img for img in targets}
+        # // the pixels are read in the worker threads, not here
+        self.batch_registration.start(reference.gray_loader(), reference.loc,
+                                      [(img.loc, img.gray_loader()) for img in targets])
+
+    def launch_mosaic_alignment(self):
+        """
+        Aligns all images of the workspace (or the images selected in the render table) globally: every overlapping
+        pair is registered and the poses are solved at once, so the errors do not accumulate across the mosaic. The
+        current image is held in place. The results are applied by apply_batch_registration.
         :return:
         """
+        rows = sorted(set(item.row() for item in self.tbl_render_order.selectedItems()))
+        images = [self.field_img[row] for row in rows] if len(rows) > 1 else list(self.field_img)
+        images = [img for img in images if isinstance(img.loc, dict)]
+        if len(images) < 2:
+            QtWidgets.QMessageBox.critical(self, "Error",
+                                       """<p>At least two images are needed for the mosaic alignment.<p>""")
+            return None
+        anchor = images.index(self.update_field_current) if self.update_field_current in images else 0
+        self._mosaic_targets = {img.loc['Path']: img for img in images}
+        # // the pixels are read in the worker threads and released once registered, the sizes are known without them
+        self.mosaic_alignment.start([(img.loc, img.gray_loader(), img.pixel_size()) for img in images], anchor)
+
+    def apply_batch_registration(self, results, targets):
+        """
+        Applies the poses found by the batch registration and writes them to the imagedb in one go
+        :param results: list of (d, new_d, error) tuples, see batch_registration_module.register_batch and
+                        mosaic_module.align_mosaic
+        :param targets: image items of the job keyed by path, the map is cleared once the results are applied
+        :return:
+        """
+        updated = []
+        failed = []
+        messages = []
+        for d, new_d, error in results:
+            img = targets.get(d['Path'])
+            if new_d is None or img is None:
+                failed.append(d)
+                messages.append('{}: {}'.format(d.get('Name', d['Path']), error))
+                continue
+            if error:
+                # // aligned, but some of its pairs could not be registered (mosaic alignment)
+                messages.append('{} (aligned with its other pairs): {}'.format(d.get('Name', d['Path']), error))
+            img.loc.update(new_d)
+            img.set_geometry(img.loc)
+            updated.append(img.loc)
+        self.imageBuffer.updateImgBackupMany(updated)
+        targets.clear()
+        self.statusUpdate('{} images registered, {} failed'.format(len(updated), len(failed)))
+        if messages:
+            QtCore.qDebug('\n'.join(messages))
+            # // the first errors are listed, the complete list is in the debug output
+            shown = messages[:20] + (['... and {} more'.format(len(messages) - 20)] if len(messages) > 20 else [])
+            QtWidgets.QMessageBox.critical(self, "Error", "<p>{} images could not be registered:</p><p>{}</p>".format(
+                len(failed), '<br>'.join(html.escape(m) for m in shown)))
 
     def show_fiducial_alignment(self):
         """
@@ -970,6 +1127,8 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         Clear the workspace by removing all images.
         :return:
         """
+        # // stop any image still being loaded in the background
+        self.imageBuffer.cancel_loading()
         # // clear internal list
         self.field.clear()
         # // alternative is to delete all items in the field view
@@ -1726,7 +1885,9 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
 
     def progressUpdate(self, v):
         # slot for updating the progressbar
-        self.progressbar.setValue(v)
+        self.progressbar.setVisible(v < 100)
+        self.bt_cancel_loading.setVisible(v < 100 and self.imageBuffer.is_loading())
+        self.progressbar.setValue(int(v))
 
     def statusUpdate(self, m):
         # slot for showing a message in the statusbar.
@@ -1738,13 +1899,14 @@ class WorkSpace(MacroExecutionWindow, MdiFieldImreg_Wrapper, geometry_widget_wra
         reply = QMessageBox.question(self, 'Message', 
                         quit_msg, QMessageBox.Yes, QMessageBox.No)
         if reply == QMessageBox.Yes:        
+            self.imageBuffer.cancel_loading()
             reply2 = QMessageBox.question(self, 'Message', 
                         "Do you want to save the image setting to db before exit?", QMessageBox.Yes, QMessageBox.No)
             if reply2 == QMessageBox.Yes:
                 self.saveimagedb_sig.emit()
-                event.accept()
-            else:
-                event.accept()
+            # // the backup writes are delayed, make sure the pending one is on disk
+            self.imageBuffer.flushImgBackup()
+            event.accept()
         elif reply == QMessageBox.No:
             event.ignore()
 
@@ -1793,21 +1955,159 @@ class ImageBufferInfo(QtCore.QObject):
 
     def __init__(self, parent, img_backup_path):
         super(ImageBufferInfo, self).__init__()
-        self.attrList = []
+        # // image dictionaries keyed by path, in insertion order (see the attrList property)
+        self._attrs = OrderedDict()
         self._parent = parent
         self.img_backup_path = img_backup_path
+        # // a .sqlite backup file is kept up to date with row updates instead of full rewrites
+        self.db = ImageDB(img_backup_path) if is_sqlite_path(img_backup_path) else None
+        self._load_callback = None
+        # // images are decoded in a pool of worker threads, only the insertion in the field view is done here
+        settings = parent.settings_object
+        max_workers = None
+        if settings.contains('Hardware/imageLoaderThreads'):
+            max_workers = int(settings.value('Hardware/imageLoaderThreads'))
+        # // images with more pixels than this are drawn from an on-disk tile pyramid (0 disables it)
+        self.pyramid_threshold = int(float(settings.value('Visuals/tilePyramidThreshold', 4e7)))
+        self.tile_cache_dir = settings.value('FileManager/tileCacheDir', None)
+        tile_cache.max_bytes = int(float(settings.value('Visuals/tileCacheMB', 512)) * 2 ** 20)
+        self.load_func = partial(load_image, pyramid_threshold=self.pyramid_threshold, cache_dir=self.tile_cache_dir)
+        # // with lazy loading, load_imagedb only creates placeholders from the xml geometry (and the pixel dimensions
+        # // from the file headers), the pixels are decoded once the image becomes visible or a tool needs them
+        self.lazy_loading = str(settings.value('Visuals/lazyLoading', '1')) == '1'
+        if self.lazy_loading:
+            self.loader = ImageLoader(max_workers=max_workers, batch_size=64,
+                                      func=partial(read_image_shape, cache_dir=self.tile_cache_dir))
+        else:
+            self.loader = ImageLoader(max_workers=max_workers, func=self.load_func)
+        self.loader.sig_batch_ready.connect(self._on_batch_ready)
+        self.loader.sig_progress.connect(self.progressUpdate_sig)
+        self.loader.sig_finished.connect(self._on_loading_finished)
+        # // loader of the pixel data of the placeholders in the view, a new request supersedes the running one
+        self.pixel_loader = ImageLoader(max_workers=max_workers, batch_size=1, func=self.load_func)
+        self.pixel_loader.sig_batch_ready.connect(self._on_pixels_ready)
+        self._pending_pixels = {}
+        self.viewport_timer = QtCore.QTimer(self)
+        self.viewport_timer.setSingleShot(True)
+        self.viewport_timer.setInterval(150)
+        self.viewport_timer.timeout.connect(self.load_visible_pixels)
+        parent.field.sigRangeChanged.connect(lambda *args: self.viewport_timer.start())
+        # // write-behind of the backup file: changes within the delay are coalesced into one write, done by a single
+        # // background thread so that the writes stay in order
+        self.backup_timer = QtCore.QTimer(self)
+        self.backup_timer.setSingleShot(True)
+        self.backup_timer.setInterval(int(settings.value('FileManager/backupWriteDelay', 500)))
+        self.backup_timer.timeout.connect(self._write_backup_now)
+        self._backup_executor = ThreadPoolExecutor(max_workers=1)
+        self._backup_future = None
+
+    @property
+    def attrList(self):
+        """
+        Read-only snapshot of the image dictionaries, use addImgBackup/updateImgBackup/removeImgBackup (or assign a new
+        list) to change the buffer. There is one entry per image path, like in the sqlite backup where the path is
+        unique: an image added again with the same path replaces the previous entry.
+        """
+        return tuple(self._attrs.values())
+
+    @attrList.setter
+    def attrList(self, attr_list):
+        self._attrs = OrderedDict()
+        for d in attr_list:
+            if d['Path'] in self._attrs:
+                QtCore.qDebug("Duplicate image path {}, only the last entry is kept".format(d['Path']))
+            self._attrs[d['Path']] = d
 
-    def load_imagedb(self, xml_path, exclude_file_list=[]):
-        tempAttrList = load_im_xml(xml_path, exclude_file=exclude_file_list,
-                                   progressbar=None)
+    def load_imagedb(self, xml_path, exclude_file_list=[], callback=None):
+        """
+        Loads an imagedb file. The images are decoded in the background and added to the field view in batches.
+        :param xml_path: path of the imagedb file
+        :param exclude_file_list: list of files to be skipped
+        :param callback: optional function called once all images are added to the field view
+        :return: list of the image dictionaries (sqlite) or the iterator streaming them from the xml file
+        """
+        if is_sqlite_path(xml_path):
+            db = self.db if xml_path == self.img_backup_path else ImageDB(xml_path)
+            tempAttrList = db.load_all(exclude_file=exclude_file_list)
+        else:
+            # // the xml file is parsed while the images are loaded, so the first images show up right away
+            tempAttrList = iter_im_xml(xml_path, exclude_file=exclude_file_list)
         self.logMessage_sig.emit({"type": "info",
                                   "message": "imagedb data files loaded into project.",
                                   "class": "ImportDialog"})
-        for d in tempAttrList[::-1]:
-            self.load_qi(d)
+        self._load_callback = callback
+        # // the images are streamed in file order, each one is inserted below the previous one
+        self._insert_row = 0
+        self.statusMessage_sig.emit("Loading images ...")
+        self.progressUpdate_sig.emit(0)
+        self.loader.start(tempAttrList)
+        return tempAttrList
+
+    def is_loading(self):
+        return self.loader.is_running()
+
+    def cancel_loading(self):
+        # // stop the background loading, images already in the field view are kept
+        if self.loader.is_running():
+            self.loader.cancel()
+        self.pixel_loader.cancel()
+        self._pending_pixels = {}
+
+    def _on_batch_ready(self, batch):
+        for d, result in batch:
+            if self.loader.is_cancelled():
+                return
+            if self.lazy_loading:
+                inserted = self.insert_qi(d, None, shape=result, bulk=True, row=self._insert_row)
+            else:
+                image, pyramid = result or (None, None)
+                inserted = self.insert_qi(d, image, pyramid=pyramid, bulk=True, row=self._insert_row)
+            if inserted:
+                self._insert_row += 1
+        self._parent.tbl_render_order.field_order_update()
+
+    def load_visible_pixels(self):
+        """
+        Requests the pixel data of the placeholders intersecting the visible part of the field view.
+        :return:
+        """
+        view_rect = self._parent.field.viewRect()
+        items = [img for img in self._parent.field_img
+                 if isinstance(img, ImageBufferObject) and not img.is_loaded() and img.isVisible()
+                 and view_rect.intersects(img.mapRectToView(img.boundingRect()))]
+        if not items:
+            return
+        # // the previous request is superseded, its images which are still visible are requested again
+        self._pending_pixels = {id(img.loc): img for img in items}
+        self.pixel_loader.start([img.loc for img in items])
+
+    def _on_pixels_ready(self, batch):
+        for d, result in batch:
+            img = self._pending_pixels.pop(id(d), None)
+            if img is None or result is None or img.is_loaded():
+                continue
+            image, pyramid = result
+            if image is not None:
+                img.set_pixels(image, pyramid)
+
+    def _on_loading_finished(self, cancelled):
+        if self._parent.update_field_current is not None:
+            self._parent.hist.setImageItem(self._parent.update_field_current)
+        self._parent.field.autoRange(padding=0.02)
+        if self.lazy_loading:
+            self.load_visible_pixels()
         self._parent.tbl_render_order.resizeRowsToContents()
         self._parent.tbl_render_order.setColumnWidth(0, 55)
-        return tempAttrList
+        # // one single write of the backup file for the whole database
+        self.writeImgBackup()
+        self.progressUpdate_sig.emit(100)
+        if cancelled:
+            self.statusMessage_sig.emit("Image loading cancelled.")
+        else:
+            self.statusMessage_sig.emit("Image loading finished.")
+        if self._load_callback is not None:
+            callback, self._load_callback = self._load_callback, None
+            callback()
 
     def load_qi(self, d, showGUI=False):
         """
@@ -1816,57 +2116,26 @@ class ImageBufferInfo(QtCore.QObject):
         :param d: the dictionary. It must have a Path, Center, Size, and Name keys as minimum
         :return:
         """
-        import os
-        image = None
-        if os.path.exists(d['Path']):
-            if os.path.splitext(d['Path'])[-1].lower() == ".bmp":
-                qi = QtGui.QPixmap(d['Path'])
-                image = cv2.imread(d['Path'])
-            elif os.path.splitext(d['Path'])[-1].lower() == ".jpg" or os.path.splitext(d['Path'])[
-                -1].lower() == ".jpeg":
-                qi = QtGui.QPixmap(d['Path'])
-                image = cv2.imread(d['Path'])
-            elif os.path.splitext(d['Path'])[-1].lower() == ".png":
-                qi = QtGui.QPixmap(d['Path'])
-                image = cv2.imread(d['Path'])
-                if not qi:
-                    # // try to copy the png to bmp and import it. This is a workaround as the PNG is actually a BMP
-                    import shutil
-                    new_file = os.path.join(os.path.splitext(d['Path'])[0] + ".bmp")
-                    shutil.copy(d['Path'], new_file)
-                    qi = QtGui.QPixmap()
-                    ret = qi.load(new_file, format="BMP")
-            elif os.path.splitext(d['Path'])[-1].lower() == ".tif" or os.path.splitext(d['Path'])[
-                -1].lower() == ".tiff":
-                image = tifffile.imread(d['Path'])
-                image = cv2.convertScaleAbs(image, alpha=0.001, beta=50)
-                # image= qimage2ndarray.array2qimage(adjusted_image, normalize=(0,255))
-                qimage= qimage2ndarray.array2qimage(image)
-                """
-                w, h = image.shape[::-1][0:2]
-                image_dim = image.ndim
-                if image_dim<3:
-                    frame = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-                else:
-                    frame = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                # image = QtGui.QImage(image, w,\
-                            # h, w * 2,QtGui.QImage.Format_RGB888)
-                image = QtGui.QImage(image, w,\
-                            h, w * 2,QtGui.QImage.Format_Grayscale8)
-                """
-                qi = QtGui.QPixmap(qimage)
-                # self._temp_qi = qi
-                # self._temp = d
-            else:
-                QtCore.qDebug("Image format not supported")
-                qi = None
-                # self.statusMessage_sig.emit("Image {} format not supported.".format(os.path.splitext(d['Path'])[-1].lower()))
-        else:
-            QtCore.qDebug("Path not found")
-            # self.statusMessage_sig.emit("{} does not exist.".format(d['Path']))
-            qi = None
+        image, pyramid = load_image(d, self.pyramid_threshold, self.tile_cache_dir)
+        self.insert_qi(d, image, pyramid=pyramid, showGUI=showGUI)
 
-        if qi:
+    def insert_qi(self, d, image, pyramid=None, shape=None, showGUI=False, bulk=False, row=0):
+        """
+        Adds a decoded image to the field view, the render list and the image buffer. Must run on the Qt thread.
+        :param d: the image dictionary
+        :param image: the numpy array of the image, as returned by load_image
+        :param pyramid: the TilePyramid of the image, None for images drawn at full resolution
+        :param shape: (height, width) of the image, used to create a placeholder when image is None
+        :param showGUI: show the geometry dialog after insertion
+        :param bulk: when True the autorange, histogram update and backup writing are left to the caller
+        :param row: position in the render list, 0 is on top
+        :return: True if the image was added
+        """
+        if image is not None or shape is not None:
+            # // pixel dimensions of the decoded image (or of the placeholder)
+            if image is not None:
+                shape = image.shape
+            px_width, px_height = shape[1], shape[0]
             # // load the center and size keys into the dict using the aspect reatio tool (if needed)
             if ("Center" not in d.keys()):
                 if ("Outline" not in d.keys()):
@@ -1883,7 +2152,7 @@ class ImageBufferInfo(QtCore.QObject):
                     d["Center"][2] = abs(d["Outline"][5] - d["Outline"][4]) / 2.0 + d["Outline"][4]
 
             if ("Size" not in d.keys()) and ("Outline" not in d.keys()):
-                d["Size"] = (qi.size().width(), qi.size().height(), 1)
+                d["Size"] = (px_width, px_height, 1)
 
             if "Outline" not in d.keys():
                 if "Center" in d.keys() and "Size" in d.keys():
@@ -1901,8 +2170,8 @@ class ImageBufferInfo(QtCore.QObject):
             aspect_ratio.append(d["Outline"][3] - d["Outline"][2])
             aspect_ratio.append(d["Outline"][5] - d["Outline"][4])
             try:
-                aspect_ratio[0] /= qi.size().width()
-                aspect_ratio[1] /= qi.size().height()
+                aspect_ratio[0] /= px_width
+                aspect_ratio[1] /= px_height
             except:
                 aspect_ratio[0] /= d['Size'][0]
                 aspect_ratio[1] /= d['Size'][1]
@@ -1921,13 +2190,14 @@ class ImageBufferInfo(QtCore.QObject):
 
             # // calculate the outline based on the center and size
             img = ImageBufferObject(image = image, width=d['Size'][0], height=d['Size'][1],
-                                    pos=(d["Outline"][0], d["Outline"][2]), pixmap=qi, opacity=opa,
-                                    attrs=d)
+                                    pos=(d["Outline"][0], d["Outline"][2]), opacity=opa, pyramid=pyramid,
+                                    attrs=d, shape=(px_height, px_width), load_func=self.load_func)
             self._parent.field.addItem(img)
             # if os.path.splitext(d['Path'])[-1].lower() == ".tif" or os.path.splitext(d['Path'])[
                 # -1].lower() == ".tiff":
                 # img.setImage(image)
-            self._parent.hist.setImageItem(img)
+            if not bulk:
+                self._parent.hist.setImageItem(img)
             # // reset the scale for rotation
             s = list(img._scale)
             if s[0] == 0:
@@ -1954,23 +2224,23 @@ class ImageBufferInfo(QtCore.QObject):
             v = rotatePoint(centerPoint=d['Center'], point=[d["Outline"][0], d["Outline"][2]],
                             angle=d['Rotation'])
             img.setPos(pg.Point(v[0], v[1]))
-            self._parent.field.autoRange(padding=0.02)
-            self._parent.field_img.insert(0, img)
+            if not bulk:
+                self._parent.field.autoRange(padding=0.02)
+            self._parent.field_img.insert(row, img)
             # // set current image in the field view
             self._parent.update_field_current = img
             # // attach the label to the image
             img.loc = d
 
             # // add to the renderlist
-            rowPosition = 0
+            rowPosition = row
             self._parent.tbl_render_order.insertRow(rowPosition)
 
             cb = QtWidgets.QTableWidgetItem()
             cb.setBackground(QtGui.QColor("#368AD4"))
             cb.setCheckState(QtCore.Qt.CheckState.Checked)
             self._parent.tbl_render_order.setItem(rowPosition, 0, cb)
-            self._parent.field_list.insert(0, img.loc)
-            self._parent.tbl_render_order.itemClicked.connect(lambda item: self._parent.on_table_order_clicked(item))
+            self._parent.field_list.insert(row, img.loc)
 
             sb = QtWidgets.QSpinBox()
             sb.setRange(0, 100)
@@ -1986,10 +2256,10 @@ class ImageBufferInfo(QtCore.QObject):
 
             if showGUI:
                 # geometry_window = geometry_dialog(parent=self._parent, attrs=d,
-                                                #   shape=(qi.size().width() * 10, qi.size().height() * 10, 1),
+                                                #   shape=(px_width * 10, px_height * 10, 1),
                                                 #   axis=(0, 1, 2))
                 geometry_window = geometry_dialog(parent=self._parent, attrs=d,
-                                                  shape=(qi.size().width(), qi.size().height(), 1),
+                                                  shape=(px_width, px_height, 1),
                                                   axis=(0, 1, 2))
                 geometry_window.show()
                 ret = geometry_window.exec_()
@@ -1997,7 +2267,12 @@ class ImageBufferInfo(QtCore.QObject):
             # self._parent.update_geo()
             # self.addImgBackup(self._parent.attrs_geo)
             img.loc = d
-            self.addImgBackup(d)
+            if bulk:
+                self._attrs[d['Path']] = d
+            else:
+                self.addImgBackup(d)
+            return True
+        return False
 
     def update_opacity(self):
         sb = self.sender()
@@ -2005,35 +2280,92 @@ class ImageBufferInfo(QtCore.QObject):
             ind = self._parent.field_list.index(sb.loc)
             self._parent.field_img[ind].setOpacity(sb.value() / 100.0)
             sb.loc["Opacity"] = sb.value()
-            self.writeImgBackup()
+            self.updateImgBackup(sb.loc)
 
     def addImgBackup(self, dict_image):
         # // function to add a dataset to current backup file
-        self.attrList.append(dict_image)
-        self.writeImgBackup()
+        self._attrs[dict_image['Path']] = dict_image
+        self._write_row(dict_image)
 
     def writeImgBackup(self, path = None):
-        # // flushes the current image buffer to the backup file
-        from export_module import write_im_xml
+        # // flushes the current image buffer to the backup file, the write is delayed so that bursts of changes
+        # // result in one single write. An explicit path (export) is written right away.
         if path == None:
-            write_im_xml(self.img_backup_path, self.attrList, distributed=True)
+            self.backup_timer.start()
+        else:
+            self._write_backup_now(path)
+
+    def flushImgBackup(self):
+        # // writes any pending change and waits for the write to finish
+        if self.backup_timer.isActive():
+            self._write_backup_now()
+        if self._backup_future is not None:
+            self._backup_future.result()
+
+    def _write_backup_now(self, path=None):
+        from export_module import write_im_xml
+        self.backup_timer.stop()
+        if path is None:
+            path = self.img_backup_path
+        if not path:
+            return
+        # // the geometry is updated here on the gui thread, the writer works on a snapshot of the buffer
+        snapshot = [self._snapshot(d) for d in self.attrList]
+        if is_sqlite_path(path):
+            db = self.db if path == self.img_backup_path else ImageDB(path)
+            self._backup_future = self._backup_executor.submit(db.upsert_many, snapshot, True)
+        else:
+            self._backup_future = self._backup_executor.submit(write_im_xml, path, snapshot, True)
+        self._backup_future.add_done_callback(self._on_backup_written)
+
+    def _snapshot(self, d):
+        from export_module import update_geometry_from_outline
+        update_geometry_from_outline(d)
+        return {k: (list(v) if isinstance(v, (list, tuple, np.ndarray)) else v) for k, v in d.items()}
+
+    def _write_row(self, d, remove=False):
+        # // sqlite backend: O(1) row update in the writer thread, xml backend: delayed rewrite of the file
+        if self.db is None:
+            self.writeImgBackup()
+            return
+        if remove:
+            self._backup_future = self._backup_executor.submit(self.db.remove, d['Path'])
         else:
-            write_im_xml(path, self.attrList, distributed=True)
+            self._backup_future = self._backup_executor.submit(self.db.upsert, self._snapshot(d))
+        self._backup_future.add_done_callback(self._on_backup_written)
+
+    def _on_backup_written(self, future):
+        # // runs in the writer thread, the signal is queued to the gui thread
+        if future.exception() is not None:
+            self.statusMessage_sig.emit("Failed to write the image database: {}".format(future.exception()))
 
     def updateImgBackup(self, newDict):
         """
         Function to update a ImageBufferObject in the backup file
         :return:
         """
-        # //  search every image to remove from active list
-        for i, n in enumerate(self.attrList):
-            # // search for name match
-            if n["Path"] == newDict["Path"]:
-                # // found match
-                self.attrList[i] = newDict
+        # // images are keyed by path, replacing keeps the position in the buffer
+        if newDict["Path"] in self._attrs:
+            self._attrs[newDict["Path"]] = newDict
 
-        # // update the backup file by refreshing
-        self.writeImgBackup()
+        # // update the backup file
+        self._write_row(newDict)
+
+    def updateImgBackupMany(self, dicts):
+        """
+        Updates a list of ImageBufferObjects in the backup file, in one single write (one transaction for sqlite)
+        :param dicts: list of image dictionaries
+        :return:
+        """
+        for d in dicts:
+            if d["Path"] in self._attrs:
+                self._attrs[d["Path"]] = d
+        if self.db is None:
+            self.writeImgBackup()
+            return
+        snapshot = [self._snapshot(d) for d in dicts]
+        self._backup_future = self._backup_executor.submit(self.db.upsert_many, snapshot, False, True)
+        self._backup_future.add_done_callback(self._on_backup_written)
 
     def removeImgBackup(self, d):
         """
@@ -2041,15 +2373,10 @@ class ImageBufferInfo(QtCore.QObject):
         :param d:
         :return:
         """
-        # //  search every image to remove from active list
-        for i, n in enumerate(self.attrList):
-            # // search for name match
-            if n["Path"] == d["Path"]:
-                # // found match
-                del self.attrList[i]
+        self._attrs.pop(d["Path"], None)
 
-        # // remove from the backup file by refreshing
-        self.writeImgBackup()
+        # // remove from the backup file
+        self._write_row(d, remove=True)
 
     def writeimagedb(self, xml_path):
         # // save the image buffer to a specified location
@@ -2105,47 +2432,62 @@ class ImageBufferInfo(QtCore.QObject):
         else:
             pass
 
-    def recallImgBackup(self):
+    def recallImgBackup(self, callback=None):
         import os
         # // recall the previous imagedb if the path is valid
         if self.img_backup_path:
             if os.path.exists(self.img_backup_path):
-                dict_list = self.load_imagedb(xml_path=self.img_backup_path)
+                dict_list = self.load_imagedb(xml_path=self.img_backup_path, callback=callback)
                 # self.attrList = dict_list
 
 
 # class ImageBufferObject(pg.GraphicsObject):
+def load_gray(load_func, d):
+    """
+    :param load_func: loader of the pixels of an image dictionary, see image_loader_module.load_image
+    :param d: image dictionary
+    :return: grayscale array of the image
+    """
+    image, pyramid = load_func(d)
+    if image is None:
+        raise IOError("Can not read {}".format(d['Path']))
+    return gray_array(image)
+
+
 class ImageBufferObject(pg.ImageItem):
     """
     This class is meant for displaying a picture in the field view, without listing it in the field render list
     """
 
-    def __init__(self, image = None, width=None, height=None, pos=(0, 0), rot=0, Visible=True, pixmap=None, attrs={}, opacity=100):
+    def __init__(self, image = None, width=None, height=None, pos=(0, 0), rot=0, Visible=True, attrs={}, opacity=100,
+                 pyramid=None, shape=None, load_func=None):
+        # // image is the only copy of the pixel data, the QImage and the grayscale array are derived from it
+        # // for very large images, image is the memory mapped level 0 of the pyramid and only visible tiles are drawn
+        # // without image the item is a placeholder of the given (height, width) shape, load_func loads the pixels
+        self.pyramid = pyramid
+        self.load_func = load_func
+        self._shape = tuple(image.shape[0:2]) if image is not None else tuple(shape[0:2])
         pg.ImageItem.__init__(self, image)
         self.width = width
         self.height = height
         self.axisOrder = 'row-major'
         self._scale = [1, 1]
         self.attrs = attrs
-        if not image.any() and (pixmap is not None):
-            self.setPixmap(pixmap)
-            self.pixmap = pixmap
-        else:
-            self.pixmap = pixmap
+        px_width, px_height = self.pixel_size()
 
         if width is not None and height is None:
             # s = float(width) / self.pixmap.width()
-            s = float(width) / self.image.shape[1]
+            s = float(width) / px_width
             self.scale(s, s)
             self._scale = (s, s)
         elif height is not None and width is None:
             # s = float(height) / self.pixmap.height()
-            s = float(height) / self.image.shape[0]
+            s = float(height) / px_height
             self.scale(s, s)
             self._scale = (s, s)
-        elif width is not None and height is not None and (self.image.shape[0] > 0) and (self.image.shape[1] > 0):
+        elif width is not None and height is not None and (px_height > 0) and (px_width > 0):
             # self._scale = (float(width) / self.pixmap.width(), float(height) / self.pixmap.height())
-            self._scale = (float(width) / self.image.shape[1], float(height) / self.image.shape[0])
+            self._scale = (float(width) / px_width, float(height) / px_height)
             # self.scale(self._scale[0], self._scale[1])
             tr = QtGui.QTransform()
             tr.scale(self._scale[0], self._scale[1])
@@ -2155,25 +2497,134 @@ class ImageBufferObject(pg.ImageItem):
             self.scale(self._scale[0], self._scale[1])
             
 
+        self._set_display_levels()
         self.setOpacity(opacity / 100)
         self.border = None
 
+    def _set_display_levels(self):
+        # // high dynamic range data is mapped to the display through the item levels, from sampled percentiles
+        if self.image is not None and self.image.dtype != np.uint8:
+            self.setLevels(quick_level(self.image))
+
     def update_dim(self, new_dims):
         self.width, self.height = new_dims
 
-    def setPixmap(self, pixmap):
-        self.pixmap = pixmap
-        self.update()
+    def set_geometry(self, d):
+        """
+        Places the item according to the Outline and Rotation of an image dictionary (as done by insert_qi)
+        :param d: image dictionary
+        :return:
+        """
+        px_width, px_height = self.pixel_size()
+        outl = d['Outline']
+        self.update_dim((abs(outl[1] - outl[0]), abs(outl[3] - outl[2])))
+        self._scale = (self.width / px_width, self.height / px_height)
+        d['AspectRatio'] = [self._scale[0], self._scale[1]] + list(d.get('AspectRatio', [0, 0, 1])[2:3])
+        tr = QtGui.QTransform()
+        tr.scale(self._scale[0], self._scale[1])
+        self.setTransform(tr)
+        self.setRotation(d.get('Rotation', 0))
+        center = ((outl[0] + outl[1]) / 2.0, (outl[2] + outl[3]) / 2.0)
+        v = rotatePoint(centerPoint=center, point=[outl[0], outl[2]], angle=d.get('Rotation', 0))
+        self.setPos(pg.Point(v[0], v[1]))
+
+    def pixel_size(self):
+        """
+        :return: (width, height) of the image in pixels
+        """
+        return self._shape[1], self._shape[0]
+
+    def is_loaded(self):
+        return self.image is not None
+
+    def set_pixels(self, image, pyramid=None):
+        """
+        Sets the pixel data of a placeholder
+        :param image: the numpy array of the image, as returned by load_image
+        :param pyramid: the TilePyramid of the image
+        :return:
+        """
+        self.pyramid = pyramid
+        self._shape = tuple(image.shape[0:2])
+        self.setImage(image)
+        self._set_display_levels()
+
+    def ensure_loaded(self):
+        """
+        Loads the pixel data of a placeholder, to be called by the tools which need the pixels
+        :return: True if the pixel data is available
+        """
+        if self.image is None and self.load_func is not None:
+            image, pyramid = self.load_func(self.attrs)
+            if image is not None:
+                self.set_pixels(image, pyramid)
+        return self.image is not None
+
+    def qimage(self):
+        """
+        :return: QImage sharing the pixel buffer of this item, valid as long as the item keeps its image
+        """
+        self.ensure_loaded()
+        if self.image.dtype != np.uint8:
+            # // the view is only possible on 8 bit data, other data is converted with the current levels
+            self._qimage_buffer = np.ascontiguousarray(to_uint8(self.image, self.levels))
+            return array_to_qimage(self._qimage_buffer)
+        return array_to_qimage(self.image)
+
+    def gray_array(self):
+        """
+        :return: grayscale array of the image, a view on the pixel buffer for grayscale images
+        """
+        self.ensure_loaded()
+        return gray_array(self.image)
+
+    def gray_loader(self):
+        """
+        :return: function returning the grayscale array of the image, to be called in a worker thread. The pixels
+                 already loaded are used, otherwise the file is read without keeping the pixels in the item, so they
+                 are released once the caller is done
+        """
+        if self.image is not None:
+            return partial(gray_array, self.image)
+        return partial(load_gray, self.load_func, dict(self.attrs))
+
+    def paint(self, p, *args):
+        if self.image is None:
+            # // placeholder, the pixels are not loaded yet
+            p.setPen(fn.mkPen(color=(128, 128, 128), cosmetic=True))
+            p.drawRect(self.boundingRect())
+            return
+        if self.pyramid is None:
+            return pg.ImageItem.paint(self, p, *args)
+        # // only draw the tiles in the visible part of the view, at the level matching the current zoom
+        rect = self.boundingRect()
+        vb = self.getViewBox()
+        if vb is not None:
+            rect = rect.intersected(self.mapRectFromView(vb.viewRect()))
+        if rect.isEmpty():
+            return
+        t = p.transform()
+        level = self.pyramid.level_for_scale(np.hypot(t.m11(), t.m12()))
+        for (ty, tx), (x, y, w, h) in self.pyramid.tiles_in_rect(level, (rect.left(), rect.top(),
+                                                                          rect.right(), rect.bottom())):
+            tile = tile_cache.get(self.pyramid, level, ty, tx)
+            lut = self.lut(tile) if callable(self.lut) else self.lut
+            argb, alpha = fn.makeARGB(tile, lut=lut, levels=self.levels)
+            p.drawImage(QtCore.QRectF(x, y, w, h), fn.makeQImage(argb, alpha, transpose=False))
+        if self.border is not None:
+            p.setPen(self.border)
+            p.drawRect(self.boundingRect())
 
     def paint_(self, p, *args):
         p.setRenderHint(p.Antialiasing)
-        p.drawPixmap(0, 0, self.pixmap)
+        p.drawImage(0, 0, self.qimage())
         if self.border is not None:
             p.setPen(self.border)
             p.drawRect(self.boundingRect())
 
     def boundingRect(self):
-        return QtCore.QRectF(self.pixmap.rect())
+        w, h = self.pixel_size()
+        return QtCore.QRectF(0, 0, w, h)
 
     def setBorder(self, b):
         self.border = fn.mkPen(b)